@@ -0,0 +1,226 @@
+#
+# benchmark of TileScheme.make_bundles on synthetic DEMs
+# python -m benchmarks.make_bundles -sizes 1024,2048 -save baseline.json
+# python -m benchmarks.make_bundles -sizes 1024,2048 -baseline baseline.json
+#
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import make_dem
+from pyterrainmaker.TileDatabase import TileDatabase, database_path, is_database
+
+# source DEM variants: overviews, no data holes filled by a coarser raster, no overviews built in pyramid mode
+SCENARIOS = {
+    'overviews': {'overviews': True, 'holes': False, 'fill': False, 'pyramid': False},
+    'holes-fill': {'overviews': True, 'holes': True, 'fill': True, 'pyramid': False},
+    'pyramid': {'overviews': False, 'holes': False, 'fill': False, 'pyramid': True},
+}
+FORMATS = ('heightmap', 'mesh')
+MODES = ('single', 'compact', 'sqlite')
+# full resolution pixels per pixel of fill rasters
+FILL_SCALE = 4
+
+
+def case_key(case):
+    return '{0}/{1}/{2}/{3}'.format(case['size'], case['scenario'], case['format'], case['mode'])
+
+
+def dem_path(work_dir, size, scenario):
+    """
+    write the DEM and fill raster of a scenario once per work directory
+    :return: (DEM path, fill raster path or None)
+    """
+    settings = SCENARIOS[scenario]
+    path = os.path.join(work_dir, 'dem_{0}_{1}{2}.tif'.format(
+        size, 'ov' if settings['overviews'] else 'noov', '_holes' if settings['holes'] else ''))
+    if not os.path.exists(path):
+        make_dem(path, size, settings['overviews'], settings['holes'])
+    fill_path = None
+    if settings['fill']:
+        fill_path = os.path.join(work_dir, 'fill_{0}.tif'.format(size))
+        if not os.path.exists(fill_path):
+            make_dem(fill_path, max(size // FILL_SCALE, 1), True, False, FILL_SCALE)
+    return path, fill_path
+
+
+def peak_rss(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def output_size(out_dir):
+    """
+    :return: (tiles in layer.json, bytes of all files)
+    """
+    if is_database(database_path(out_dir)):
+        with TileDatabase(database_path(out_dir), readonly=True) as db:
+            layer = json.loads(db.get_metadata('json'))
+    else:
+        with open(os.path.join(out_dir, 'layer.json')) as f:
+            layer = json.load(f)
+    tiles = 0
+    for ranges in layer['available']:
+        for r in ranges:
+            tiles += (r['endX'] - r['startX'] + 1) * (r['endY'] - r['startY'] + 1)
+    size = 0
+    for root, dirs, files in os.walk(out_dir):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return tiles, size
+
+
+def run_case(case):
+    """
+    make the bundles of one case in this process, workers are children of it
+    :return: dict of the results
+    """
+    from pyterrainmaker.TileScheme import TileScheme
+
+    out_dir = case['out_dir']
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    ts = TileScheme(case['dem'], case['mode'] == 'compact')
+    ts.is_sqlite = case['mode'] == 'sqlite'
+    ts.out_no_data = 0
+    ts.pyramid = SCENARIOS[case['scenario']]['pyramid']
+    if case['fill'] is not None:
+        ts.set_fill_raster(case['fill'])
+    ts.generate_scheme()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        failures = ts.make_bundles(out_dir, decode_type=case['format'], thread_count=case['jobs'])
+    seconds = time.perf_counter() - start
+
+    (tiles, size) = output_size(out_dir)
+    if not case['keep']:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return {
+        'seconds': seconds,
+        'tiles': tiles,
+        'tiles_per_second': tiles / seconds,
+        'bytes': size,
+        'peak_rss': peak_rss(resource.RUSAGE_SELF),
+        'peak_worker_rss': peak_rss(resource.RUSAGE_CHILDREN),
+        'stage_times': ts.metrics.stage_times,
+        'failures': len(failures),
+    }
+
+
+def run_in_subprocess(case):
+    """
+    peak RSS is per process, every case runs in a fresh interpreter
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.make_bundles', '-case', json.dumps(case)],
+                                     cwd=repo_dir)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    """
+    print the change of each case from the baseline
+    :return: keys of cases slower or larger in memory by more than tolerance, or with more failed bundles
+    """
+    previous = dict((r['case'], r) for r in baseline['results'])
+    regressions = []
+    print('\ncompared to baseline:')
+    for result in results:
+        old = previous.get(result['case'])
+        if old is None:
+            print('  {0:<32} not in baseline'.format(result['case']))
+            continue
+        speed = result['tiles_per_second'] / old['tiles_per_second'] - 1
+        rss = max(result['peak_rss'], result['peak_worker_rss']) / max(old['peak_rss'], old['peak_worker_rss']) - 1
+        size = result['bytes'] / max(old['bytes'], 1) - 1
+        regressed = speed < -tolerance or rss > tolerance or result['failures'] > old['failures']
+        if regressed:
+            regressions.append(result['case'])
+        print('  {0:<32} tiles/s {1:+7.1%}  peak rss {2:+7.1%}  bytes {3:+7.1%}{4}'.format(
+            result['case'], speed, rss, size, '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of TileScheme.make_bundles on synthetic DEMs')
+    parser.add_argument('-sizes', default='1024', help='comma separated DEM sizes in pixels per side')
+    parser.add_argument('-scenarios', default=','.join(sorted(SCENARIOS)), help='comma separated of ' +
+                        '/'.join(sorted(SCENARIOS)))
+    parser.add_argument('-formats', default=','.join(FORMATS))
+    parser.add_argument('-modes', default=','.join(MODES))
+    parser.add_argument('-jobs', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('-work-dir', help='directory of DEMs and outputs, DEMs are reused, default is a temp dir')
+    parser.add_argument('-keep', action='store_true', help='keep the outputs in the work directory')
+    parser.add_argument('-save', help='write the results as JSON, to be used as a baseline')
+    parser.add_argument('-baseline', help='results JSON to compare with')
+    parser.add_argument('-tolerance', type=float, default=0.1, help='allowed slowdown and memory growth, default 0.1')
+    parser.add_argument('-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    # cases run from the repository directory
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='pyterrainmaker_bench_'))
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    print('{0:<32} {1:>8} {2:>8} {3:>9} {4:>10} {5:>9}  {6}'.format(
+        'case', 'seconds', 'tiles', 'tiles/s', 'MB', 'rss MB', 'seconds by stage'))
+    try:
+        for size in [int(s) for s in args.sizes.split(',')]:
+            for scenario in args.scenarios.split(','):
+                (dem, fill) = dem_path(work_dir, size, scenario)
+                for decode_type in args.formats.split(','):
+                    for mode in args.modes.split(','):
+                        case = {'size': size, 'scenario': scenario, 'format': decode_type, 'mode': mode,
+                                'dem': dem, 'fill': fill, 'jobs': args.jobs, 'keep': args.keep}
+                        case['out_dir'] = os.path.join(work_dir, case_key(case).replace('/', '_'))
+                        result = run_in_subprocess(case)
+                        result['case'] = case_key(case)
+                        results.append(result)
+                        print('{0:<32} {1:>8.2f} {2:>8} {3:>9.1f} {4:>10.2f} {5:>9.1f}  {6}'.format(
+                            result['case'], result['seconds'], result['tiles'], result['tiles_per_second'],
+                            result['bytes'] / 1024 / 1024,
+                            max(result['peak_rss'], result['peak_worker_rss']) / 1024 / 1024,
+                            ' '.join('{0} {1:.2f}'.format(stage, seconds)
+                                     for stage, seconds in result['stage_times'].items())))
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'cpu_count': multiprocessing.cpu_count(),
+                'jobs': args.jobs,
+                'results': results,
+            }, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#
+# load test of the terrain tile server
+# python -m benchmarks.server_load <terrain output dir> -url http://127.0.0.1:8000
+#
+
+import argparse
+import asyncio
+import random
+import time
+from urllib.parse import urlsplit
+
+from pyterrainmaker.TilesetConverter import read_layer_json
+
+
+def tile_paths(root, max_count):
+    """
+    tile urls of the available ranges in layer.json, or in the json metadata of a tile database
+    """
+    layer = read_layer_json(root)
+    paths = []
+    for level, ranges in enumerate(layer['available']):
+        for r in ranges:
+            for x in range(r['startX'], r['endX'] + 1):
+                for y in range(r['startY'], r['endY'] + 1):
+                    paths.append('/{0}/{1}/{2}.terrain'.format(level, x, y))
+    random.shuffle(paths)
+    return paths[:max_count]
+
+
+async def client(host, port, paths, deadline, stats):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.time() < deadline:
+            path = random.choice(paths)
+            start = time.perf_counter()
+            writer.write('GET {0} HTTP/1.1\r\nHost: {1}\r\nAccept-Encoding: gzip\r\n\r\n'.format(path, host).encode())
+            head = await reader.readuntil(b'\r\n\r\n')
+            lines = head.decode('latin-1').split('\r\n')
+            status = lines[0].split(' ')[1]
+            length = 0
+            for line in lines[1:]:
+                if line.lower().startswith('content-length:'):
+                    length = int(line.split(':', 1)[1])
+            await reader.readexactly(length)
+            stats['latencies'].append(time.perf_counter() - start)
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            stats['bytes'] += length
+    finally:
+        writer.close()
+
+
+async def run(host, port, paths, connections, duration):
+    stats = {'latencies': [], 'status': {}, 'bytes': 0}
+    deadline = time.time() + duration
+    await asyncio.gather(*[client(host, port, paths, deadline, stats) for _ in range(connections)])
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load test of the terrain tile server')
+    parser.add_argument('root', help='terrain output directory or tile database served by the server')
+    parser.add_argument('-url', default='http://127.0.0.1:8000')
+    parser.add_argument('-connections', type=int, default=32)
+    parser.add_argument('-duration', type=float, default=10.0)
+    parser.add_argument('-tiles', type=int, default=100000, help='number of distinct tiles to request')
+    args = parser.parse_args()
+
+    url = urlsplit(args.url)
+    paths = tile_paths(args.root, args.tiles)
+    stats = asyncio.run(run(url.hostname, url.port or 80, paths, args.connections, args.duration))
+
+    latencies = sorted(stats['latencies'])
+    count = len(latencies)
+    print('requests:   {0}'.format(count))
+    print('req/s:      {0:.0f}'.format(count / args.duration))
+    print('MB/s:       {0:.2f}'.format(stats['bytes'] / args.duration / 1024 / 1024))
+    print('status:     {0}'.format(stats['status']))
+    if count:
+        for p in (50, 90, 99):
+            print('p{0} ms:     {1:.2f}'.format(p, latencies[min(count - 1, count * p // 100)] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#
+# synthetic GeoTIFF DEMs for benchmarks
+# python -m benchmarks.synthetic dem.tif -size 2048 [-holes] [-no-overviews]
+#
+
+import argparse
+import numpy as np
+from osgeo import gdal
+from osgeo import gdalconst
+from osgeo import osr
+
+NO_DATA = -9999.0
+# north west corner and pixel size of the full resolution DEMs, about 30 m
+ORIGIN = (100.0, 30.0)
+RESOLUTION = 1.0 / 3600
+ROWS_PER_WRITE = 512
+# overviews are built down to this many pixels per side
+MIN_OVERVIEW_SIZE = 256
+
+
+def terrain(x, y, seed=1):
+    """
+    hills of six octaves at pixel coordinates of the full resolution DEM, in meters
+    """
+    rng = np.random.RandomState(seed)
+    heights = np.full(np.broadcast(x, y).shape, 1500.0)
+    amplitude = 800.0
+    wavelength = 2048.0
+    for octave in range(6):
+        (phase_x, phase_y, angle) = rng.uniform(0, 2 * np.pi, 3)
+        u = (x * np.cos(angle) + y * np.sin(angle)) * 2 * np.pi / wavelength
+        v = (y * np.cos(angle) - x * np.sin(angle)) * 2 * np.pi / wavelength
+        heights += amplitude * np.sin(u + phase_x) * np.cos(v + phase_y)
+        amplitude /= 2
+        wavelength /= 2
+    return heights.astype(np.float32)
+
+
+def holes(x, y):
+    """
+    mask of round no data holes, about 10 percent of the area
+    """
+    return (x % 700 - 350) ** 2 + (y % 500 - 250) ** 2 < 105 ** 2
+
+
+def make_dem(path, size, overviews=True, with_holes=False, scale=1, seed=1):
+    """
+    write a size * size float32 GeoTIFF in EPSG:4326
+    :param overviews: build overviews down to MIN_OVERVIEW_SIZE
+    :param with_holes: set holes to NO_DATA
+    :param scale: full resolution pixels per pixel, a fill raster of a DEM has the same extent at a coarser scale
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, size, size, 1, gdalconst.GDT_Float32, ['TILED=YES', 'COMPRESS=DEFLATE'])
+    ds.SetGeoTransform((ORIGIN[0], RESOLUTION * scale, 0.0, ORIGIN[1], 0.0, -RESOLUTION * scale))
+    sr_84 = osr.SpatialReference()
+    sr_84.ImportFromEPSG(4326)
+    ds.SetProjection(sr_84.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(NO_DATA)
+
+    for start in range(0, size, ROWS_PER_WRITE):
+        (y, x) = np.mgrid[start:min(start + ROWS_PER_WRITE, size), 0:size] * scale
+        block = terrain(x, y, seed)
+        if with_holes:
+            block[holes(x, y)] = NO_DATA
+        band.WriteArray(block, 0, start)
+
+    if overviews:
+        factors = []
+        factor = 2
+        while size // factor >= MIN_OVERVIEW_SIZE:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            ds.BuildOverviews('AVERAGE', factors)
+    ds.FlushCache()
+    ds = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='write a synthetic GeoTIFF DEM')
+    parser.add_argument('path')
+    parser.add_argument('-size', type=int, default=2048, help='pixels per side')
+    parser.add_argument('-holes', action='store_true', help='add no data holes')
+    parser.add_argument('-no-overviews', action='store_true')
+    parser.add_argument('-scale', type=int, default=1, help='full resolution pixels per pixel')
+    args = parser.parse_args()
+    make_dem(args.path, args.size, not args.no_overviews, args.holes, args.scale)
+
+
+if __name__ == '__main__':
+    main()
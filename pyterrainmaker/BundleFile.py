@@ -0,0 +1,334 @@
+#
+# BundleFile
+# read and write compact .bundle files
+#
+# version 1 layout:
+#   header (32 bytes): magic 'PTMB', version, bundle size, level, first tile x, first tile y
+#   index (bundle size * bundle size entries of <QI): tile offset and length, length 0 for no tile
+#   tile data
+# the index entry of tile (x, y) is (x - first x) * bundle size + (first y - y).
+#
+# legacy layout (version 0) has no header and no index:
+#   repeated <3i (tile x, tile y, tile length) followed by the tile data
+#
+
+import mmap
+import os
+import struct
+
+from .GlobalGeodetic import GlobalGeodetic
+
+BUNDLE_MAGIC = b'PTMB'
+BUNDLE_VERSION = 1
+HEADER_FORMAT = '<4sHHiii'
+HEADER_SIZE = 32
+INDEX_FORMAT = '<QI'
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_FORMAT)
+LEGACY_HEADER_FORMAT = '<3i'
+LEGACY_HEADER_SIZE = struct.calcsize(LEGACY_HEADER_FORMAT)
+
+
+def bundle_file_name(from_tile):
+    return '{0}_{1}.bundle'.format(from_tile[0], from_tile[1])
+
+
+def bundle_origin(bundle_info, level, x, y):
+    """
+    first tile of the bundle holding tile (x, y)
+    :param bundle_info: content of bundle.json of a compact tileset
+    :return: (x, y) of the north west tile of the bundle
+    """
+    bundle_size = bundle_info.get('bundle_sizes', {}).get(str(level), bundle_info.get('bundle_size', 32))
+    if bundle_info.get('aligned', False):
+        return x // bundle_size * bundle_size, y // bundle_size * bundle_size + bundle_size - 1
+    extent = bundle_info['extent']
+    gg = GlobalGeodetic(True, 64)
+    left_tx, top_ty = gg.LonLatToTile(extent['x_min'], extent['y_max'], level)
+    return left_tx + (x - left_tx) // bundle_size * bundle_size, top_ty - (top_ty - y) // bundle_size * bundle_size
+
+
+class BundleWriter(object):
+
+    def __init__(self, path, level, from_tile, bundle_size):
+        """
+        create a version 1 bundle file
+        :param from_tile: (x, y) of the north west tile of the bundle
+        """
+        self.path = path
+        self.level = level
+        self.from_tile = from_tile
+        self.bundle_size = bundle_size
+        self.__index = [(0, 0)] * (bundle_size * bundle_size)
+        # content digest -> (offset, length) of tiles already written
+        self.__written = {}
+        # written aside and renamed on close, an interrupted write never leaves a torn bundle
+        self.__temp_path = path + '.tmp'
+        self.__file = open(self.__temp_path, 'wb')
+        header = struct.pack(HEADER_FORMAT, BUNDLE_MAGIC, BUNDLE_VERSION, bundle_size, level,
+                             from_tile[0], from_tile[1])
+        self.__file.write(header.ljust(HEADER_SIZE, b'\0'))
+        self.__file.write(b'\0' * (INDEX_ENTRY_SIZE * len(self.__index)))
+        self.__offset = HEADER_SIZE + INDEX_ENTRY_SIZE * len(self.__index)
+
+    def index_slot(self, x, y):
+        index_x = x - self.from_tile[0]
+        index_y = self.from_tile[1] - y
+        if not 0 <= index_x < self.bundle_size or not 0 <= index_y < self.bundle_size:
+            raise Exception('tile {0}/{1} is outside bundle {2}'.format(x, y, self.path))
+        return index_x * self.bundle_size + index_y
+
+    def write_tile(self, x, y, data, digest=None):
+        """
+        :param digest: content digest of the tile, tiles with the digest of an
+                       already written tile share its data
+        """
+        slot = self.index_slot(x, y)
+        if digest is not None and digest in self.__written:
+            self.__index[slot] = self.__written[digest]
+            return
+        self.__file.write(data)
+        self.__index[slot] = (self.__offset, len(data))
+        if digest is not None:
+            self.__written[digest] = self.__index[slot]
+        self.__offset += len(data)
+
+    def close(self):
+        if self.__file is None:
+            return
+        self.__file.seek(HEADER_SIZE)
+        self.__file.write(b''.join(struct.pack(INDEX_FORMAT, offset, length) for offset, length in self.__index))
+        self.__file.close()
+        self.__file = None
+        os.replace(self.__temp_path, self.path)
+
+    def abort(self):
+        if self.__file is None:
+            return
+        self.__file.close()
+        self.__file = None
+        os.remove(self.__temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BundleUpdater(object):
+
+    def __init__(self, path, level, from_tile, bundle_size):
+        """
+        replace tiles of a bundle file in place.
+        new tile data is appended and the index is rewritten on close, the data of
+        replaced tiles stays in the file unreferenced. readers holding the old index
+        still read the old tiles. legacy bundles are rewritten as version 1, a
+        missing bundle is created.
+        :param from_tile: (x, y) of the north west tile of the bundle
+        """
+        self.path = path
+        self.from_tile = from_tile
+        self.bundle_size = bundle_size
+        self.__file = None
+        self.__writer = None
+        self.__legacy = None
+        self.__written = {}
+        if os.path.exists(path):
+            with BundleReader(path) as reader:
+                in_place = (reader.version == BUNDLE_VERSION and reader.bundle_size == bundle_size
+                            and reader.level == level and tuple(reader.from_tile) == tuple(from_tile))
+                if not in_place:
+                    self.__legacy = dict(((x, y), data) for x, y, data in reader.iter_tiles())
+        else:
+            in_place = False
+
+        if not in_place:
+            self.__writer = BundleWriter(path, level, from_tile, bundle_size)
+            return
+
+        self.__file = open(path, 'r+b')
+        self.__file.seek(HEADER_SIZE)
+        self.__index = list(struct.iter_unpack(INDEX_FORMAT,
+                                               self.__file.read(INDEX_ENTRY_SIZE * bundle_size * bundle_size)))
+        self.__length = self.__file.seek(0, os.SEEK_END)
+        self.__offset = self.__length
+
+    def index_slot(self, x, y):
+        index_x = x - self.from_tile[0]
+        index_y = self.from_tile[1] - y
+        if not 0 <= index_x < self.bundle_size or not 0 <= index_y < self.bundle_size:
+            raise Exception('tile {0}/{1} is outside bundle {2}'.format(x, y, self.path))
+        return index_x * self.bundle_size + index_y
+
+    def write_tile(self, x, y, data, digest=None):
+        """
+        :param digest: content digest of the tile, tiles with the digest of a tile
+                       written by this updater share its data
+        """
+        if self.__writer is not None:
+            self.__writer.write_tile(x, y, data, digest)
+            if self.__legacy is not None:
+                self.__legacy.pop((x, y), None)
+            return
+        slot = self.index_slot(x, y)
+        if digest is not None and digest in self.__written:
+            self.__index[slot] = self.__written[digest]
+            return
+        self.__file.write(data)
+        self.__index[slot] = (self.__offset, len(data))
+        if digest is not None:
+            self.__written[digest] = self.__index[slot]
+        self.__offset += len(data)
+
+    def close(self):
+        if self.__writer is not None:
+            # tiles of a rewritten bundle which are not updated
+            for (x, y), data in sorted((self.__legacy or {}).items()):
+                self.__writer.write_tile(x, y, data)
+            self.__writer.close()
+            return
+        if self.__file is None:
+            return
+        # the appended data is durable before the index points to it
+        self.__file.flush()
+        os.fsync(self.__file.fileno())
+        self.__file.seek(HEADER_SIZE)
+        self.__file.write(b''.join(struct.pack(INDEX_FORMAT, offset, length) for offset, length in self.__index))
+        self.__file.close()
+        self.__file = None
+
+    def abort(self):
+        if self.__writer is not None:
+            self.__writer.abort()
+            return
+        if self.__file is None:
+            return
+        # the index is untouched, dropping the appended data restores the bundle
+        self.__file.truncate(self.__length)
+        self.__file.close()
+        self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BundleReader(object):
+
+    def __init__(self, path, use_mmap=False):
+        """
+        open a bundle file of version 1 or legacy layout
+        :param use_mmap: memory map the file, tiles are then slices of the map
+        """
+        self.path = path
+        self.version = 0
+        self.level = None
+        self.from_tile = None
+        self.bundle_size = None
+        self.__file = open(path, 'rb')
+        self.__map = None
+        # an empty file, a legacy bundle without tiles, can not be mapped
+        if use_mmap and os.fstat(self.__file.fileno()).st_size > 0:
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.__index = None
+        self.__legacy_index = None
+        head = self.__read(0, HEADER_SIZE)
+        if len(head) == HEADER_SIZE and head[:4] == BUNDLE_MAGIC:
+            (_, self.version, self.bundle_size, self.level, from_x, from_y) = \
+                struct.unpack_from(HEADER_FORMAT, head)
+            if self.version != BUNDLE_VERSION:
+                raise Exception('unsupported bundle version {0} of {1}'.format(self.version, path))
+            self.from_tile = (from_x, from_y)
+            self.__index = self.__read(HEADER_SIZE, INDEX_ENTRY_SIZE * self.bundle_size * self.bundle_size)
+        else:
+            self.__legacy_index = self.__scan_legacy()
+
+    def __read(self, offset, length):
+        if self.__map is not None:
+            return self.__map[offset:offset + length]
+        self.__file.seek(offset)
+        return self.__file.read(length)
+
+    def __scan_legacy(self):
+        # headers are unpacked from one map of the file instead of a read per tile
+        index = {}
+        size = os.fstat(self.__file.fileno()).st_size
+        if size == 0:
+            return index
+        data = self.__map if self.__map is not None else mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset + LEGACY_HEADER_SIZE <= size:
+                (tile_x, tile_y, tile_len) = struct.unpack_from(LEGACY_HEADER_FORMAT, data, offset)
+                offset += LEGACY_HEADER_SIZE
+                index[(tile_x, tile_y)] = (offset, tile_len)
+                offset += tile_len
+        finally:
+            if data is not self.__map:
+                data.close()
+        return index
+
+    def locate(self, x, y):
+        """
+        :return: (offset, length) of tile (x, y), None if the bundle does not have it
+        """
+        if self.__legacy_index is not None:
+            return self.__legacy_index.get((x, y))
+        index_x = x - self.from_tile[0]
+        index_y = self.from_tile[1] - y
+        if not 0 <= index_x < self.bundle_size or not 0 <= index_y < self.bundle_size:
+            return None
+        offset, length = struct.unpack_from(INDEX_FORMAT, self.__index,
+                                            (index_x * self.bundle_size + index_y) * INDEX_ENTRY_SIZE)
+        if length == 0:
+            return None
+        return offset, length
+
+    def get_tile(self, x, y):
+        location = self.locate(x, y)
+        if location is None:
+            return None
+        return self.__read(location[0], location[1])
+
+    def tiles(self):
+        """
+        :return: list of (x, y) of all tiles in the bundle, in file order
+        """
+        if self.__legacy_index is not None:
+            return sorted(self.__legacy_index.keys(), key=lambda t: self.__legacy_index[t][0])
+        tiles = []
+        for slot, (offset, length) in enumerate(struct.iter_unpack(INDEX_FORMAT, self.__index)):
+            if length > 0:
+                index_x, index_y = divmod(slot, self.bundle_size)
+                tiles.append((offset, (self.from_tile[0] + index_x, self.from_tile[1] - index_y)))
+        return [tile for offset, tile in sorted(tiles)]
+
+    def iter_tiles(self):
+        """
+        yield (x, y, tile bytes) of all tiles in the bundle
+        """
+        for (x, y) in self.tiles():
+            yield x, y, self.get_tile(x, y)
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,80 @@
+#
+# BundleJournal
+# on-disk record of completed bundles, used to resume interrupted runs
+#
+
+import hashlib
+import json
+import os
+
+JOURNAL_NAME = 'bundles.journal'
+
+
+def params_hash(params):
+    """
+    digest of the parameters a bundle is generated with
+    :param params: dict of json serializable values
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class BundleJournal(object):
+
+    def __init__(self, out_loc, in_params_hash, resume=False):
+        """
+        open the journal of an output directory
+        :param in_params_hash: bundles recorded with another hash are not complete for this run
+        :param resume: keep the records of previous runs, otherwise the journal is started again
+        """
+        self.path = os.path.join(out_loc, JOURNAL_NAME)
+        self.params_hash = in_params_hash
+        self.__done = {}
+        if resume:
+            self.__load()
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if not resume:
+            flags |= os.O_TRUNC
+        self.__fd = os.open(self.path, flags, 0o644)
+
+    def __load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                    key = (record['level'], record['x'], record['y'])
+                    if record['hash'] == self.params_hash:
+                        self.__done[key] = record.get('bundles', 1)
+                except (ValueError, KeyError, UnicodeDecodeError):
+                    # a line torn by an interrupted write
+                    continue
+
+    def __len__(self):
+        return len(self.__done)
+
+    def is_done(self, level, from_tile):
+        return (level, from_tile[0], from_tile[1]) in self.__done
+
+    def done_bundles(self, level, from_tile):
+        """
+        :return: number of bundles written by the recorded task
+        """
+        return self.__done.get((level, from_tile[0], from_tile[1]), 0)
+
+    def record(self, level, from_tile, bundles=1):
+        """
+        durably record a completed bundle task
+        :param bundles: number of bundles the task wrote
+        """
+        record = {'level': level, 'x': from_tile[0], 'y': from_tile[1], 'hash': self.params_hash, 'bundles': bundles}
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        # one write of the whole line, so a crash can only leave a torn last line
+        os.write(self.__fd, line)
+        os.fsync(self.__fd)
+        self.__done[(level, from_tile[0], from_tile[1])] = bundles
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
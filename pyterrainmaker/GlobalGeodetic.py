@@ -1,5 +1,6 @@
 
 import math
+import numpy as np
 
 class GlobalGeodetic(object):
     r"""
@@ -99,3 +100,29 @@ class GlobalGeodetic(object):
         b = self.TileBounds(tx, ty, zoom)
         return (b[1], b[0], b[3], b[2])
 
+    def LonLatToTileArray(self, lon, lat, zoom):
+        "Returns arrays of tiles for zoom which cover given arrays of lon/lat coordinates"
+
+        res = self.resFact / 2**zoom
+        px = (180 + np.asarray(lon)) / res
+        py = (90 + np.asarray(lat)) / res
+        tx = np.ceil(px / float(self.tileSize)).astype(np.int64) - 1
+        ty = np.ceil(py / float(self.tileSize)).astype(np.int64) - 1
+        return tx, ty
+
+    def TileBoundsArray(self, tx, ty, zoom):
+        "Returns bounds of the given arrays of tiles as arrays"
+        res = self.resFact / 2**zoom
+        tx = np.asarray(tx, dtype=np.int64)
+        ty = np.asarray(ty, dtype=np.int64)
+        return (
+            tx*self.tileSize*res - 180,
+            ty*self.tileSize*res - 90,
+            (tx+1)*self.tileSize*res - 180,
+            (ty+1)*self.tileSize*res - 90
+        )
+
+    def TileLatLonBoundsArray(self, tx, ty, zoom):
+        "Returns bounds of the given arrays of tiles in the SWNE form"
+        b = self.TileBoundsArray(tx, ty, zoom)
+        return (b[1], b[0], b[3], b[2])
@@ -0,0 +1,65 @@
+#
+# MemoryBudget
+# track the bundle arrays alive in a worker, back them by scratch files beyond a limit
+#
+
+import tempfile
+import weakref
+import numpy as np
+
+# bytes of heightmap payload of one tile, encoded for a whole bundle at once
+TILE_PAYLOAD_BYTES = 65 * 65 * 2 + 2
+
+
+def estimate_bundle_memory(bundle_size, source_ratio, source_itemsize, source_pixels=None):
+    """
+    peak bytes of generating one bundle
+    :param source_ratio: source pixels per bundle array pixel along one axis
+    :param source_itemsize: bytes of a source pixel
+    :param source_pixels: pixels of the source band, a window is never larger
+    """
+    pixels = (bundle_size * 64 + 1) ** 2
+    window_pixels = pixels * source_ratio ** 2
+    if source_pixels is not None:
+        window_pixels = min(window_pixels, source_pixels)
+    # source window, resampled float32 bundle array and the payloads of its tiles
+    return int(window_pixels * source_itemsize + pixels * 4 + bundle_size ** 2 * TILE_PAYLOAD_BYTES)
+
+
+class MemoryBudget(object):
+
+    def __init__(self, limit, scratch_dir=None):
+        """
+        :param limit: bytes of arrays kept in memory, None for no limit
+        :param scratch_dir: directory of the files backing arrays beyond the limit
+        """
+        self.limit = limit
+        self.scratch_dir = scratch_dir
+        self.live = 0
+        self.peak = 0
+        self.mapped = 0
+
+    def __release(self, nbytes):
+        self.live -= nbytes
+
+    def empty(self, shape, dtype=np.float32):
+        """
+        an uninitialized array, memory mapped to a scratch file if it does not fit the limit.
+        the array counts as live until it is garbage collected.
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if self.limit is not None and self.live + nbytes > self.limit:
+            self.mapped += 1
+            # the file is unlinked already, the map keeps it until the array is collected
+            with tempfile.TemporaryFile(dir=self.scratch_dir) as f:
+                return np.memmap(f, dtype=dtype, mode='w+', shape=shape)
+        array = np.empty(shape, dtype=dtype)
+        self.live += nbytes
+        self.peak = max(self.peak, self.live)
+        weakref.finalize(array, self.__release, nbytes)
+        return array
+
+    def full(self, shape, fill_value, dtype=np.float32):
+        array = self.empty(shape, dtype)
+        array.fill(fill_value)
+        return array
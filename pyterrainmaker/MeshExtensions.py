@@ -0,0 +1,98 @@
+#
+# MeshExtensions
+# oct encoded vertex normals and water mask extensions of quantized-mesh tiles
+#
+
+import math
+import struct
+import numpy as np
+
+from .Resample import resample
+
+EXTENSION_HEADER_FORMAT = '<BI'
+VERTEX_NORMALS_ID = 1
+WATER_MASK_ID = 2
+WATER_MASK_SIZE = 256
+EARTH_RADIUS = 6378137.0
+# grid rows of normals computed at once, bounds the temporary arrays
+NORMALS_BLOCK_ROWS = 256
+
+
+def extension(extension_id, data):
+    """
+    :return: extension header and data, appended to an encoded mesh
+    """
+    return struct.pack(EXTENSION_HEADER_FORMAT, extension_id, len(data)) + data
+
+
+def oct_encode(x, y, z):
+    """
+    oct encode unit vectors to two 8 bit snorm values
+    :return: uint8 array of shape x.shape + (2,)
+    """
+    l1_norm = np.abs(x) + np.abs(y) + np.abs(z)
+    u = x / l1_norm
+    v = y / l1_norm
+    negative = z < 0
+    u, v = (np.where(negative, (1 - np.abs(v)) * np.where(u >= 0, 1.0, -1.0), u),
+            np.where(negative, (1 - np.abs(u)) * np.where(v >= 0, 1.0, -1.0), v))
+    encoded = np.empty(x.shape + (2,), dtype=np.uint8)
+    encoded[..., 0] = np.round((np.clip(u, -1, 1) * 0.5 + 0.5) * 255)
+    encoded[..., 1] = np.round((np.clip(v, -1, 1) * 0.5 + 0.5) * 255)
+    return encoded
+
+
+def grid_normals(heights, min_x, max_y, res_x, res_y):
+    """
+    oct encoded earth centered normals of a height grid
+    :param heights: grid of at least 2 * 2 heights in meters, north row first
+    :param min_x: longitude of the west column
+    :param max_y: latitude of the north row
+    :param res_x: degrees between columns
+    :param res_y: degrees between rows
+    :return: uint8 array of shape heights.shape + (2,)
+    """
+    (rows, cols) = heights.shape
+    normals = np.empty((rows, cols, 2), dtype=np.uint8)
+    lon = np.radians(min_x + np.arange(cols) * res_x)[np.newaxis, :]
+    sin_lon = np.sin(lon)
+    cos_lon = np.cos(lon)
+    meters_y = math.radians(res_y) * EARTH_RADIUS
+    for start in range(0, rows, NORMALS_BLOCK_ROWS):
+        end = min(start + NORMALS_BLOCK_ROWS, rows)
+        # one row of halo on each side keeps central differences across blocks
+        halo_start = max(start - 1, 0)
+        block = heights[halo_start:min(end + 1, rows)].astype(np.float64)
+        inner = slice(start - halo_start, end - halo_start)
+        (d_row, d_col) = (gradient[inner] for gradient in np.gradient(block))
+
+        lat = np.radians(max_y - np.arange(start, end) * res_y)[:, np.newaxis]
+        sin_lat = np.sin(lat)
+        cos_lat = np.cos(lat)
+        meters_x = np.maximum(math.radians(res_x) * EARTH_RADIUS * cos_lat, 1e-6)
+        # local east, north, up normal, rows run southwards
+        east = -d_col / meters_x
+        north = d_row / meters_y
+        length = np.sqrt(east * east + north * north + 1)
+        east /= length
+        north /= length
+        up = 1 / length
+
+        x = -east * sin_lon - north * sin_lat * cos_lon + up * cos_lat * cos_lon
+        y = east * cos_lon - north * sin_lat * sin_lon + up * cos_lat * sin_lon
+        z = north * cos_lat + up * sin_lat
+        normals[start:end] = oct_encode(x, y, z)
+    return normals
+
+
+def water_mask(water):
+    """
+    :param water: bool grid of a tile, north row first
+    :return: extension data, one byte for a tile of all land or all water, 256 * 256 bytes otherwise
+    """
+    if not water.any():
+        return b'\x00'
+    if water.all():
+        return b'\xff'
+    mask = resample(water.view(np.uint8), WATER_MASK_SIZE, WATER_MASK_SIZE, 'nearest')
+    return (mask * 255).astype(np.uint8).tobytes()
@@ -0,0 +1,91 @@
+#
+# MeshHeader
+# quantized-mesh headers of all tiles of a bundle at once
+#
+
+import struct
+import numpy as np
+
+from .ecef import LLH2ECEF, wgs84_a, wgs84_b
+
+# center, minimum and maximum height, bounding sphere center and radius, horizon occlusion point.
+# the header quantized_mesh_encoder.encode writes, tests compare pack_header with it
+MESH_HEADER_FORMAT = '<3d2f4d3d'
+TILE_SIZE = 65
+SCALED_SPACE = np.array([wgs84_a, wgs84_a, wgs84_b])
+
+
+def _tile_windows(grid, x_offsets):
+    """
+    :param grid: TILE_SIZE rows of a bundle grid
+    :return: copies of the TILE_SIZE * TILE_SIZE windows of grid at x_offsets
+    """
+    (rows, cols) = grid.shape
+    (row_stride, col_stride) = grid.strides
+    windows = np.lib.stride_tricks.as_strided(
+        grid, shape=((cols - 1) // 64, rows, TILE_SIZE), strides=(col_stride * 64, row_stride, col_stride),
+        writeable=False)
+    return windows[x_offsets // 64]
+
+
+def _occlusion_points(windows, center):
+    """
+    horizon occlusion points in the ellipsoid scaled frame, the points of each tile are
+    below the horizon of a viewer who can not see its occlusion point
+    """
+    direction = [c / SCALED_SPACE[axis] for axis, c in enumerate(center)]
+    length = np.sqrt(direction[0] ** 2 + direction[1] ** 2 + direction[2] ** 2)
+    direction = [(d / length)[:, np.newaxis, np.newaxis] for d in direction]
+    scaled = [w / SCALED_SPACE[axis] for axis, w in enumerate(windows)]
+    magnitude_squared = scaled[0] ** 2 + scaled[1] ** 2 + scaled[2] ** 2
+    magnitude = np.sqrt(magnitude_squared)
+    cos_alpha = (scaled[0] * direction[0] + scaled[1] * direction[1] + scaled[2] * direction[2]) / magnitude
+    sin_alpha = np.sqrt(np.maximum(1 - cos_alpha ** 2, 0))
+    magnitude_squared = np.maximum(magnitude_squared, 1)
+    cos_beta = 1 / np.maximum(magnitude, 1)
+    sin_beta = np.sqrt(magnitude_squared - 1) * cos_beta
+    candidates = 1 / (cos_alpha * cos_beta - sin_alpha * sin_beta)
+    farthest = candidates.max(axis=(1, 2))
+    return [d[:, 0, 0] * farthest for d in direction]
+
+
+def bundle_headers(heights, min_x, max_y, res, x_offsets, y_offsets):
+    """
+    centers, bounding spheres and horizon occlusion points of tiles of a bundle, from all grid points of
+    each tile. mesh vertices are grid points, so they hold for any triangulation of the tiles.
+    :param heights: bundle array, north row first
+    :param min_x: longitude of the west column
+    :param max_y: latitude of the north row
+    :param res: degrees between grid points
+    :param x_offsets: array of tile column offsets in heights
+    :param y_offsets: array of tile row offsets in heights
+    :return: float64 array of shape (tile count, 7): center, bounding sphere radius, horizon occlusion point
+    """
+    x_offsets = np.asarray(x_offsets)
+    y_offsets = np.asarray(y_offsets)
+    headers = np.empty((len(x_offsets), 7))
+    lon = min_x + np.arange(heights.shape[1]) * res
+    # one strip of tile rows at a time, the earth centered grid of a strip is small
+    for y_offset in np.unique(y_offsets).tolist():
+        tiles = np.nonzero(y_offsets == y_offset)[0]
+        lat = max_y - np.arange(y_offset, y_offset + TILE_SIZE) * res
+        (lon_grid, lat_grid) = np.meshgrid(lon, lat)
+        strip = heights[y_offset:y_offset + TILE_SIZE].astype(np.float64)
+        windows = [_tile_windows(grid, x_offsets[tiles]) for grid in LLH2ECEF(lon_grid, lat_grid, strip)]
+
+        center = [(w.min(axis=(1, 2)) + w.max(axis=(1, 2))) / 2 for w in windows]
+        distance_squared = sum((w - c[:, np.newaxis, np.newaxis]) ** 2 for w, c in zip(windows, center))
+        headers[tiles, 0:3] = np.stack(center, axis=1)
+        headers[tiles, 3] = np.sqrt(distance_squared.max(axis=(1, 2)))
+        headers[tiles, 4:7] = np.stack(_occlusion_points(windows, center), axis=1)
+    return headers
+
+
+def pack_header(header, min_height, max_height):
+    """
+    :param header: row of bundle_headers
+    :return: 88 bytes of quantized-mesh header, the bounding sphere is centered on the tile center
+    """
+    (x, y, z, radius, occlusion_x, occlusion_y, occlusion_z) = header.tolist()
+    return struct.pack(MESH_HEADER_FORMAT, x, y, z, min_height, max_height, x, y, z, radius,
+                       occlusion_x, occlusion_y, occlusion_z)
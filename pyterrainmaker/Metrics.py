@@ -0,0 +1,220 @@
+#
+# Metrics
+# counters and stage timings of make_bundles, reported to pluggable listeners
+#
+
+import json
+import sys
+import threading
+import time
+
+# stages of writing a bundle, timed by TerrainBundle
+STAGES = ('read', 'nodata', 'fill', 'resample', 'encode', 'compress', 'write')
+# seconds between two lines of JsonLinesProgress
+PROGRESS_INTERVAL = 5.0
+# seconds between two notifications of the ticker, while no task finishes
+TICK_INTERVAL = 1.0
+
+
+def new_level_stats():
+    # bundles, tiles and bytes written at a level
+    return [0, 0, 0]
+
+
+class Metrics(object):
+
+    def __init__(self, level_totals):
+        """
+        totals of a make_bundles run, merged in the parent process from the stats of finished tasks.
+        listeners are called with (metrics, final) after each task, by the ticker while it runs,
+        and once at the end. they are called one at a time.
+        :param level_totals: dict of level -> number of bundles to write
+        """
+        self.level_totals = dict(level_totals)
+        self.total = sum(self.level_totals.values())
+        self.start_time = time.time()
+        self.finished = 0
+        self.skipped = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.stage_times = dict.fromkeys(STAGES, 0.0)
+        # level -> [tiles, triangles, vertices, seconds triangulating, seconds encoding] of mesh tiles
+        self.mesh_stats = {}
+        # level -> new_level_stats()
+        self.levels = {}
+        self.level_skipped = {}
+        # level -> time its first bundle was handed out
+        self.level_started = {}
+        # level -> time its last bundle was merged
+        self.level_updated = {}
+        self.listeners = []
+        self.__lock = threading.RLock()
+        self.__ticker_stop = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def start_level(self, level):
+        with self.__lock:
+            self.level_started.setdefault(level, time.time())
+
+    def skip(self, level, bundles):
+        """
+        bundles completed by a previous run, a pyramid subtree counts only in the totals
+        """
+        with self.__lock:
+            self.skipped += bundles
+            if bundles == 1:
+                self.level_skipped[level] = self.level_skipped.get(level, 0) + 1
+
+    def record(self, written, stats, failed=False):
+        """
+        merge the stats of a finished task and notify the listeners
+        :param written: bundles written by the task
+        :param stats: dict returned by the task
+        """
+        with self.__lock:
+            self.finished += written
+            if failed:
+                self.failures += 1
+            self.cache_hits += stats['cache_hits']
+            self.cache_misses += stats['cache_misses']
+            for stage, seconds in stats['stage_times'].items():
+                self.stage_times[stage] += seconds
+            for level, level_stats in stats['mesh_stats'].items():
+                totals = self.mesh_stats.setdefault(level, [0, 0, 0, 0.0, 0.0])
+                for index, value in enumerate(level_stats):
+                    totals[index] += value
+            for level, level_stats in stats['levels'].items():
+                totals = self.levels.setdefault(level, new_level_stats())
+                for index, value in enumerate(level_stats):
+                    totals[index] += value
+                self.level_updated[level] = time.time()
+            self.notify()
+
+    def notify(self, final=False):
+        with self.__lock:
+            for listener in self.listeners:
+                listener(self, final)
+
+    def start_ticker(self, interval=TICK_INTERVAL):
+        """
+        notify the listeners every interval seconds from a daemon thread until stop_ticker,
+        so that progress is reported while long tasks run
+        """
+        self.stop_ticker()
+        stop = threading.Event()
+
+        def tick():
+            while not stop.wait(interval):
+                self.notify()
+
+        thread = threading.Thread(target=tick, name='MetricsTicker')
+        thread.daemon = True
+        thread.start()
+        self.__ticker_stop = (stop, thread)
+
+    def stop_ticker(self):
+        if self.__ticker_stop is None:
+            return
+        (stop, thread) = self.__ticker_stop
+        stop.set()
+        thread.join()
+        self.__ticker_stop = None
+
+    @staticmethod
+    def eta(remaining, done, seconds):
+        if remaining <= 0:
+            return 0.0
+        if done <= 0 or seconds <= 0:
+            return None
+        return remaining * seconds / done
+
+    def snapshot(self):
+        """
+        :return: JSON serializable dict of the run so far
+        """
+        with self.__lock:
+            return self.__snapshot()
+
+    def __snapshot(self):
+        now = time.time()
+        elapsed = now - self.start_time
+        tiles = sum(level_stats[1] for level_stats in self.levels.values())
+        size = sum(level_stats[2] for level_stats in self.levels.values())
+        levels = {}
+        for level in sorted(self.level_totals):
+            (bundles, level_tiles, level_bytes) = self.levels.get(level, new_level_stats())
+            skipped = self.level_skipped.get(level, 0)
+            remaining = self.level_totals[level] - bundles - skipped
+            # the clock of a level stops at its last bundle
+            end = now if remaining > 0 else self.level_updated.get(level, now)
+            seconds = end - self.level_started[level] if level in self.level_started else 0.0
+            levels[str(level)] = {
+                'bundles': bundles,
+                'skipped': skipped,
+                'total': self.level_totals[level],
+                'tiles': level_tiles,
+                'bytes': level_bytes,
+                'tiles_per_second': level_tiles / seconds if seconds > 0 else 0.0,
+                'eta': self.eta(remaining, bundles, seconds),
+            }
+        done = self.finished + self.skipped
+        return {
+            'time': now,
+            'elapsed': elapsed,
+            'bundles': self.finished,
+            'skipped': self.skipped,
+            'total': self.total,
+            'percent': done * 100.0 / self.total if self.total else 100.0,
+            'failures': self.failures,
+            'tiles': tiles,
+            'bytes': size,
+            'tiles_per_second': tiles / elapsed if elapsed > 0 else 0.0,
+            'bundles_per_second': self.finished / elapsed if elapsed > 0 else 0.0,
+            'eta': self.eta(self.total - done, self.finished, elapsed),
+            'levels': levels,
+            'stage_seconds': dict(self.stage_times),
+            'source_cache': {'hits': self.cache_hits, 'misses': self.cache_misses},
+            'mesh': dict((str(level), dict(zip(('tiles', 'triangles', 'vertices', 'triangulate_seconds',
+                                                 'encode_seconds'), stats)))
+                         for level, stats in sorted(self.mesh_stats.items())),
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=4)
+
+
+def print_percent(metrics, final):
+    """
+    default listener, one line of percentage rewritten in place
+    """
+    done = metrics.finished + metrics.skipped
+    sys.stdout.flush()
+    print('  {0:.0f}/{1} ({2:.0f}%)'.format(done, metrics.total, (done + 0.0) / max(metrics.total, 1) * 100),
+          end='\r')
+
+
+class JsonLinesProgress(object):
+
+    def __init__(self, stream, interval=PROGRESS_INTERVAL):
+        """
+        listener writing a snapshot as one JSON line every interval seconds, and at the end.
+        lines come between tasks only while the ticker of the metrics runs
+        :param stream: text file object
+        """
+        self.stream = stream
+        self.interval = interval
+        self.last_time = 0.0
+
+    def __call__(self, metrics, final):
+        now = time.time()
+        if not final and now - self.last_time < self.interval:
+            return
+        self.last_time = now
+        snapshot = metrics.snapshot()
+        snapshot['event'] = 'done' if final else 'progress'
+        self.stream.write(json.dumps(snapshot) + '\n')
+        self.stream.flush()
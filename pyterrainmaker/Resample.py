@@ -0,0 +1,177 @@
+#
+# Resample
+# resample 2d arrays to another size with NumPy
+#
+
+import numpy as np
+
+RESAMPLE_METHODS = ('nearest', 'bilinear', 'average')
+# destination rows gathered at once by nearest, bounds the temporary copies
+NEAREST_BLOCK_ROWS = 256
+
+
+def _nearest_index(src_size, dst_size):
+    # source pixel holding the center of each destination pixel, exact in integers
+    return (np.arange(dst_size, dtype=np.int64) * 2 + 1) * src_size // (dst_size * 2)
+
+
+def _bilinear_weights(src_size, dst_size):
+    centers = (np.arange(dst_size) + 0.5) * src_size / dst_size - 0.5
+    centers = np.clip(centers, 0, src_size - 1)
+    low = np.floor(centers).astype(np.int64)
+    high = np.minimum(low + 1, src_size - 1)
+    return low, high, (centers - low).astype(np.float32)
+
+
+def _average_bounds(src_size, dst_size):
+    # source pixels overlapped by each destination pixel, at least one
+    index = np.arange(dst_size, dtype=np.int64)
+    start = index * src_size // dst_size
+    end = np.maximum(-(-(index + 1) * src_size // dst_size), start + 1)
+    return start, end
+
+
+def _box_sum(array, start, end, axis):
+    sums = np.cumsum(array, axis=axis, dtype=np.float64)
+    sums = np.insert(sums, 0, 0, axis=axis)
+    return np.take(sums, end, axis=axis) - np.take(sums, start, axis=axis)
+
+
+def resample(array, out_width, out_height, method='nearest', no_data=None, out=None):
+    """
+    resample an array covering an extent to out_width * out_height pixels covering the same extent
+    :param method: nearest, bilinear or average
+    :param no_data: value excluded from bilinear and average kernels
+    :param out: float32 array of out_height * out_width to write the result to
+    :return: float32 array, the input itself if it is float32, has the size already and out is None
+    """
+    (rows, cols) = array.shape
+    if rows == out_height and cols == out_width:
+        if out is None:
+            return array.astype(np.float32, copy=False)
+        out[...] = array
+        return out
+
+    if method == 'nearest':
+        if out is None:
+            out = np.empty((out_height, out_width), dtype=np.float32)
+        row_index = _nearest_index(rows, out_height)
+        col_index = _nearest_index(cols, out_width)
+        for start in range(0, out_height, NEAREST_BLOCK_ROWS):
+            out[start:start + NEAREST_BLOCK_ROWS] = array[row_index[start:start + NEAREST_BLOCK_ROWS]][:, col_index]
+        return out
+
+    result = _resample_kernel(array, out_width, out_height, method, no_data)
+    if out is None:
+        return result
+    out[...] = result
+    return out
+
+
+def _resample_kernel(array, out_width, out_height, method, no_data):
+    (rows, cols) = array.shape
+
+    if method == 'bilinear':
+        (top, bottom, w_y) = _bilinear_weights(rows, out_height)
+        (left, right, w_x) = _bilinear_weights(cols, out_width)
+        return _bilinear(array, top, bottom, w_y, left, right, w_x, no_data,
+                         lambda: resample(array, out_width, out_height, 'nearest'))
+
+    if method == 'average':
+        (top, bottom) = _average_bounds(rows, out_height)
+        (left, right) = _average_bounds(cols, out_width)
+        return _average(array, top, bottom, left, right, no_data)
+
+    raise Exception('unknown resampling method {0}'.format(method))
+
+
+def _bilinear(array, top, bottom, w_y, left, right, w_x, no_data, nearest):
+    """
+    :param nearest: callable returning the nearest resampled array, for kernels touching no data
+    """
+    upper = array[top].astype(np.float32)
+    lower = array[bottom].astype(np.float32)
+    corners = (upper[:, left], upper[:, right], lower[:, left], lower[:, right])
+    w_x = w_x[np.newaxis, :]
+    w_y = w_y[:, np.newaxis]
+    result = (corners[0] * (1 - w_x) + corners[1] * w_x) * (1 - w_y) + (corners[2] * (1 - w_x) + corners[3] * w_x) * w_y
+    if no_data is not None:
+        # a kernel touching no data takes the nearest value
+        blended = np.zeros(result.shape, dtype=bool)
+        for corner in corners:
+            blended |= corner == no_data
+        if blended.any():
+            result[blended] = nearest()[blended]
+    return result
+
+
+def _average(array, top, bottom, left, right, no_data):
+    if no_data is None:
+        sums = _box_sum(_box_sum(array, top, bottom, 0), left, right, 1)
+        counts = (bottom - top)[:, np.newaxis] * (right - left)[np.newaxis, :]
+        return (sums / counts).astype(np.float32)
+    valid = array != no_data
+    sums = _box_sum(_box_sum(np.where(valid, array, 0), top, bottom, 0), left, right, 1)
+    counts = _box_sum(_box_sum(valid, top, bottom, 0), left, right, 1)
+    result = np.full(sums.shape, no_data, dtype=np.float32)
+    np.divide(sums, counts, out=result, where=counts > 0, casting='unsafe')
+    return result
+
+
+def grid_kernel(coords, size, method, scale=1.0):
+    """
+    source pixels read for points at fixed source coordinates. unlike resample, the pixels of a point
+    do not depend on the window read, so arrays of neighbor windows agree where they overlap.
+    :param coords: float array of point coordinates in source pixels, 0 is the edge of the first pixel
+    :param size: pixels of the source
+    :param scale: source pixels per point step, the width of the average box
+    :return: (start, end, weight): int64 arrays of the first and past the last source pixel of each point,
+             and the float32 bilinear weight of its last pixel
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if method == 'nearest':
+        start = np.clip(np.floor(coords), 0, size - 1)
+        end = start + 1
+        weight = np.zeros(coords.shape)
+    elif method == 'bilinear':
+        centers = coords - 0.5
+        start = np.clip(np.floor(centers), 0, size - 1)
+        end = np.minimum(start + 2, size)
+        weight = np.clip(centers - start, 0, 1)
+    elif method == 'average':
+        start = np.clip(np.floor(coords - scale / 2), 0, size - 1)
+        end = np.maximum(np.minimum(np.ceil(coords + scale / 2), size), start + 1)
+        weight = np.zeros(coords.shape)
+    else:
+        raise Exception('unknown resampling method {0}'.format(method))
+    return start.astype(np.int64), end.astype(np.int64), weight.astype(np.float32)
+
+
+def resample_grid(array, x_kernel, y_kernel, method='nearest', no_data=None, out=None):
+    """
+    resample an array to points
+    :param x_kernel: grid_kernel of the point columns, relative to the first column of array
+    :param y_kernel: grid_kernel of the point rows, relative to the first row of array
+    :param out: float32 array of rows * columns of points to write the result to
+    :return: float32 array
+    """
+    (left, right, w_x) = x_kernel
+    (top, bottom, w_y) = y_kernel
+    if out is None:
+        out = np.empty((len(top), len(left)), dtype=np.float32)
+
+    if method == 'nearest':
+        for start in range(0, len(top), NEAREST_BLOCK_ROWS):
+            out[start:start + NEAREST_BLOCK_ROWS] = array[top[start:start + NEAREST_BLOCK_ROWS]][:, left]
+        return out
+
+    if method == 'bilinear':
+        # pixels of the point itself, for kernels touching no data
+        nearest_rows = np.where(w_y < 0.5, top, bottom - 1)
+        nearest_cols = np.where(w_x < 0.5, left, right - 1)
+        out[...] = _bilinear(array, top, bottom - 1, w_y, left, right - 1, w_x, no_data,
+                             lambda: array[nearest_rows][:, nearest_cols])
+        return out
+
+    out[...] = _average(array, top, bottom, left, right, no_data)
+    return out
@@ -0,0 +1,274 @@
+#
+# SourceMosaic
+# many source rasters read as one dataset, through a grid index of their footprints
+# and a bounded LRU of open datasets
+#
+# the mosaic covers the union of the footprints at the finest source resolution.
+# later sources are drawn over earlier ones, their no data pixels are transparent,
+# pixels no source covers are the no data of the mosaic.
+#
+
+import math
+import os
+from collections import OrderedDict, namedtuple
+from osgeo import gdal
+from osgeo import gdalconst
+import numpy as np
+
+from .Resample import resample
+
+RASTER_EXTENSIONS = ('.tif', '.tiff', '.img', '.vrt', '.hgt', '.dem', '.asc', '.bil', '.dt0', '.dt1', '.dt2')
+# datasets kept open by each process
+MAX_OPEN_SOURCES = 64
+# pixels per side of the blocks reported to SourceReader
+MOSAIC_BLOCK_SIZE = 512
+
+NUMPY_TYPES = {
+    gdalconst.GDT_Byte: np.uint8,
+    gdalconst.GDT_UInt16: np.uint16,
+    gdalconst.GDT_Int16: np.int16,
+    gdalconst.GDT_UInt32: np.uint32,
+    gdalconst.GDT_Int32: np.int32,
+    gdalconst.GDT_Float32: np.float32,
+    gdalconst.GDT_Float64: np.float64
+}
+
+# bounds in degrees, pixel sizes of the band and (x size, y size) of each of its overviews
+SourceFootprint = namedtuple('SourceFootprint', ['path', 'min_x', 'min_y', 'max_x', 'max_y', 'res_x', 'res_y',
+                                                 'cols', 'rows', 'overviews', 'no_data', 'data_type'])
+
+
+def list_sources(source):
+    """
+    :param source: raster file, directory of rasters, or list of them
+    :return: list of raster files, the rasters of a directory sorted by name
+    """
+    if not isinstance(source, str):
+        paths = []
+        for item in source:
+            paths.extend(list_sources(item))
+        return paths
+    if os.path.isdir(source):
+        return [os.path.join(source, name) for name in sorted(os.listdir(source))
+                if name.lower().endswith(RASTER_EXTENSIONS) and os.path.isfile(os.path.join(source, name))]
+    return [source]
+
+
+def is_mosaic(source):
+    """
+    :return: True if source is more than one raster file
+    """
+    return not isinstance(source, str) or os.path.isdir(source)
+
+
+def source_name(source):
+    """
+    :return: name of the raster file or directory, or of the common directory of a list
+    """
+    if not isinstance(source, str):
+        paths = [os.path.abspath(path) for path in source]
+        source = os.path.commonpath(paths) if len(paths) > 1 else paths[0]
+    return os.path.splitext(os.path.basename(os.path.abspath(source)))[0]
+
+
+def scan_sources(paths):
+    """
+    :return: list of SourceFootprint of raster files
+    """
+    footprints = []
+    for path in paths:
+        ds = gdal.Open(path, gdal.GA_ReadOnly)
+        if ds is None:
+            raise Exception('Open source raster {0} failed'.format(path))
+        trans = ds.GetGeoTransform()
+        band = ds.GetRasterBand(1)
+        overviews = []
+        for index in range(band.GetOverviewCount()):
+            overview = band.GetOverview(index)
+            overviews.append((overview.XSize, overview.YSize))
+        (cols, rows) = (ds.RasterXSize, ds.RasterYSize)
+        footprints.append(SourceFootprint(path, trans[0], trans[3] - rows * abs(trans[5]), trans[0] + cols * trans[1],
+                                          trans[3], trans[1], abs(trans[5]), cols, rows, tuple(overviews),
+                                          band.GetNoDataValue(), band.DataType))
+        del band, ds
+    return footprints
+
+
+class SourceIndex(object):
+
+    def __init__(self, footprints, cell_size=None):
+        """
+        uniform grid of footprints
+        :param cell_size: degrees per side of the grid cells, default is the median footprint size
+        """
+        self.footprints = footprints
+        if cell_size is None:
+            cell_size = float(np.median([max(f.max_x - f.min_x, f.max_y - f.min_y) for f in footprints]))
+        self.cell_size = cell_size
+        self.__cells = {}
+        for index, footprint in enumerate(footprints):
+            for cell in self.__cells_of(footprint.min_x, footprint.min_y, footprint.max_x, footprint.max_y):
+                self.__cells.setdefault(cell, []).append(index)
+
+    def __cells_of(self, min_x, min_y, max_x, max_y):
+        for cx in range(int(math.floor(min_x / self.cell_size)), int(math.floor(max_x / self.cell_size)) + 1):
+            for cy in range(int(math.floor(min_y / self.cell_size)), int(math.floor(max_y / self.cell_size)) + 1):
+                yield cx, cy
+
+    def query(self, min_x, min_y, max_x, max_y):
+        """
+        :return: sorted indexes of the footprints overlapping the extent
+        """
+        found = set()
+        for cell in self.__cells_of(min_x, min_y, max_x, max_y):
+            for index in self.__cells.get(cell, ()):
+                f = self.footprints[index]
+                if f.min_x < max_x and f.max_x > min_x and f.min_y < max_y and f.max_y > min_y:
+                    found.add(index)
+        return sorted(found)
+
+
+class DatasetCache(object):
+
+    def __init__(self, max_open=MAX_OPEN_SOURCES):
+        """
+        LRU of open source datasets, the least recently read is closed first
+        """
+        self.max_open = max_open
+        self.opens = 0
+        self.__datasets = OrderedDict()
+
+    def band(self, path, overview):
+        """
+        :param overview: 0 for the band, i for its overview i - 1
+        """
+        ds = self.__datasets.get(path)
+        if ds is None:
+            ds = gdal.Open(path, gdal.GA_ReadOnly)
+            if ds is None:
+                raise Exception('Open source raster {0} failed'.format(path))
+            self.opens += 1
+            self.__datasets[path] = ds
+            while len(self.__datasets) > self.max_open:
+                self.__datasets.popitem(last=False)
+        else:
+            self.__datasets.move_to_end(path)
+        band = ds.GetRasterBand(1)
+        return band if overview == 0 else band.GetOverview(overview - 1)
+
+
+class MosaicBand(object):
+
+    def __init__(self, mosaic, overview):
+        """
+        band lookalike of the mosaic, or of one of its overviews
+        :param overview: 0 for full resolution, i for 1 / 2 ** i of it
+        """
+        self.mosaic = mosaic
+        self.overview = overview
+        self.XSize = max(1, int(round(mosaic.RasterXSize / 2.0 ** overview)))
+        self.YSize = max(1, int(round(mosaic.RasterYSize / 2.0 ** overview)))
+        self.DataType = mosaic.data_type
+        # square pixels, as TerrainBundle reads them
+        self.res = (mosaic.max_x - mosaic.min_x) / self.XSize
+
+    def GetNoDataValue(self):
+        return self.mosaic.no_data
+
+    def GetBlockSize(self):
+        return [MOSAIC_BLOCK_SIZE, MOSAIC_BLOCK_SIZE]
+
+    def GetOverviewCount(self):
+        return self.mosaic.overview_count if self.overview == 0 else 0
+
+    def GetOverview(self, index):
+        return MosaicBand(self.mosaic, index + 1)
+
+    def __source_band(self, footprint):
+        """
+        the coarsest band of a source still as fine as this band
+        :return: (overview index, x resolution, y resolution, x size, y size)
+        """
+        chosen = (0, footprint.res_x, footprint.res_y, footprint.cols, footprint.rows)
+        for index, (x_size, y_size) in enumerate(footprint.overviews):
+            res_x = footprint.res_x * footprint.cols / x_size
+            # overview sizes are rounded, an overview may be a fraction of a pixel coarser
+            if res_x > self.res * 1.01:
+                break
+            chosen = (index + 1, res_x, footprint.res_y * footprint.rows / y_size, x_size, y_size)
+        return chosen
+
+    def ReadAsArray(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None):
+        """
+        :return: array of the window, read from the sources overlapping it, None if it is not inside the band
+        """
+        if win_xsize is None:
+            win_xsize = self.XSize - xoff
+        if win_ysize is None:
+            win_ysize = self.YSize - yoff
+        if xoff < 0 or yoff < 0 or xoff + win_xsize > self.XSize or yoff + win_ysize > self.YSize:
+            return None
+
+        mosaic = self.mosaic
+        res = self.res
+        window = np.full((win_ysize, win_xsize), mosaic.fill_value, dtype=NUMPY_TYPES[self.DataType])
+        for index in mosaic.index.query(mosaic.min_x + xoff * res, mosaic.max_y - (yoff + win_ysize) * res,
+                                        mosaic.min_x + (xoff + win_xsize) * res, mosaic.max_y - yoff * res):
+            f = mosaic.footprints[index]
+            # pixels of the window covered by the source
+            x0 = max(xoff, int(round((f.min_x - mosaic.min_x) / res)))
+            x1 = min(xoff + win_xsize, int(round((f.max_x - mosaic.min_x) / res)))
+            y0 = max(yoff, int(round((mosaic.max_y - f.max_y) / res)))
+            y1 = min(yoff + win_ysize, int(round((mosaic.max_y - f.min_y) / res)))
+            if x0 >= x1 or y0 >= y1:
+                continue
+            (overview, s_res_x, s_res_y, s_cols, s_rows) = self.__source_band(f)
+            s_x0 = min(max(int(round((mosaic.min_x + x0 * res - f.min_x) / s_res_x)), 0), s_cols - 1)
+            s_x1 = min(max(int(round((mosaic.min_x + x1 * res - f.min_x) / s_res_x)), s_x0 + 1), s_cols)
+            s_y0 = min(max(int(round((f.max_y - mosaic.max_y + y0 * res) / s_res_y)), 0), s_rows - 1)
+            s_y1 = min(max(int(round((f.max_y - mosaic.max_y + y1 * res) / s_res_y)), s_y0 + 1), s_rows)
+            array = mosaic.datasets.band(f.path, overview).ReadAsArray(s_x0, s_y0, s_x1 - s_x0, s_y1 - s_y0)
+            if array.shape != (y1 - y0, x1 - x0):
+                array = resample(array, x1 - x0, y1 - y0, 'nearest')
+            target = window[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff]
+            np.copyto(target, array, casting='unsafe', where=True if f.no_data is None else array != f.no_data)
+        return window
+
+
+class SourceMosaic(object):
+
+    def __init__(self, footprints, max_open=MAX_OPEN_SOURCES):
+        """
+        dataset lookalike of many sources, only the sources overlapping a read are opened
+        :param footprints: list of SourceFootprint, from scan_sources
+        :param max_open: datasets kept open
+        """
+        if not footprints:
+            raise Exception('no source raster is found')
+        self.footprints = footprints
+        self.index = SourceIndex(footprints)
+        self.datasets = DatasetCache(max_open)
+        self.min_x = min(f.min_x for f in footprints)
+        self.min_y = min(f.min_y for f in footprints)
+        self.max_x = max(f.max_x for f in footprints)
+        self.max_y = max(f.max_y for f in footprints)
+        res = min(f.res_x for f in footprints)
+        self.RasterXSize = int(round((self.max_x - self.min_x) / res))
+        self.RasterYSize = int(round((self.max_y - self.min_y) / res))
+        # overviews of the mosaic halve the resolution, as far as the sources have overviews
+        self.overview_count = max(len(f.overviews) for f in footprints)
+        data_types = set(f.data_type for f in footprints)
+        self.data_type = data_types.pop() if len(data_types) == 1 else gdalconst.GDT_Float32
+        if self.data_type not in NUMPY_TYPES:
+            self.data_type = gdalconst.GDT_Float32
+        no_data = [f.no_data for f in footprints if f.no_data is not None]
+        self.no_data = no_data[0] if no_data else None
+        # pixels outside all sources, 0 if no source has no data
+        self.fill_value = self.no_data if self.no_data is not None else 0
+
+    def GetGeoTransform(self):
+        res = (self.max_x - self.min_x) / self.RasterXSize
+        return self.min_x, res, 0.0, self.max_y, 0.0, -res
+
+    def GetRasterBand(self, index):
+        return MosaicBand(self, 0)
@@ -0,0 +1,131 @@
+#
+# SourceReader
+# read windows of a source band through an LRU cache of whole internal blocks
+#
+
+from collections import OrderedDict
+import numpy as np
+
+# cached chunks are whole blocks, grouped to at least this many pixels per side
+MIN_CHUNK_SIZE = 256
+
+
+class BlockCache(object):
+
+    def __init__(self, max_bytes):
+        """
+        LRU of source chunks shared by the readers of a process
+        :param max_bytes: budget of cached pixel data
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.__chunks = OrderedDict()
+
+    def get(self, key):
+        chunk = self.__chunks.get(key)
+        if chunk is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__chunks.move_to_end(key)
+        return chunk
+
+    def put(self, key, chunk):
+        self.__chunks[key] = chunk
+        self.size += chunk.nbytes
+        while self.size > self.max_bytes and len(self.__chunks) > 1:
+            _, evicted = self.__chunks.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def take_stats(self):
+        """
+        :return: (hits, misses) since the last call
+        """
+        stats = (self.hits, self.misses)
+        self.hits = self.misses = 0
+        return stats
+
+
+class SourceReader(object):
+
+    def __init__(self, band, cache, key):
+        """
+        band lookalike reading whole internal blocks, windows are assembled from cached chunks
+        :param band: gdal band or overview
+        :param cache: BlockCache
+        :param key: identifies the band in the cache
+        """
+        self.band = band
+        self.cache = cache
+        self.key = key
+        self.XSize = band.XSize
+        self.YSize = band.YSize
+        (block_x, block_y) = band.GetBlockSize()
+        self.chunk_x = min(self.XSize, -(-MIN_CHUNK_SIZE // block_x) * block_x)
+        self.chunk_y = min(self.YSize, -(-MIN_CHUNK_SIZE // block_y) * block_y)
+
+    def __chunk(self, col, row):
+        key = (self.key, col, row)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            x_off = col * self.chunk_x
+            y_off = row * self.chunk_y
+            chunk = self.band.ReadAsArray(x_off, y_off, min(self.chunk_x, self.XSize - x_off),
+                                          min(self.chunk_y, self.YSize - y_off))
+            self.cache.put(key, chunk)
+        return chunk
+
+    def ReadAsArray(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None):
+        """
+        :return: array of the window, None if it is not inside the band
+        """
+        if win_xsize is None:
+            win_xsize = self.XSize - xoff
+        if win_ysize is None:
+            win_ysize = self.YSize - yoff
+        if xoff < 0 or yoff < 0 or xoff + win_xsize > self.XSize or yoff + win_ysize > self.YSize:
+            return None
+        if win_xsize == 0 or win_ysize == 0:
+            # an empty window, as GDAL reads it, in the type of the band
+            chunk = self.__chunk(min(xoff, self.XSize - 1) // self.chunk_x, min(yoff, self.YSize - 1) // self.chunk_y)
+            return np.empty((win_ysize, win_xsize), dtype=chunk.dtype)
+
+        window = None
+        for row in range(yoff // self.chunk_y, (yoff + win_ysize - 1) // self.chunk_y + 1):
+            for col in range(xoff // self.chunk_x, (xoff + win_xsize - 1) // self.chunk_x + 1):
+                chunk = self.__chunk(col, row)
+                if window is None:
+                    window = np.empty((win_ysize, win_xsize), dtype=chunk.dtype)
+                # overlap of the chunk and the window, in band pixels
+                x0 = max(xoff, col * self.chunk_x)
+                x1 = min(xoff + win_xsize, col * self.chunk_x + chunk.shape[1])
+                y0 = max(yoff, row * self.chunk_y)
+                y1 = min(yoff + win_ysize, row * self.chunk_y + chunk.shape[0])
+                window[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = \
+                    chunk[y0 - row * self.chunk_y:y1 - row * self.chunk_y, x0 - col * self.chunk_x:x1 - col * self.chunk_x]
+        return window
+
+    def read_points(self, xs, ys):
+        """
+        values of single pixels, each chunk is looked up once
+        :param xs: int array of pixel columns inside the band
+        :param ys: int array of pixel rows inside the band
+        :return: array of the pixel values
+        """
+        chunk_cols = -(-self.XSize // self.chunk_x)
+        keys = (ys // self.chunk_y) * chunk_cols + xs // self.chunk_x
+        order = np.argsort(keys, kind='stable')
+        (chunk_keys, starts) = np.unique(keys[order], return_index=True)
+        values = None
+        for chunk_key, start, end in zip(chunk_keys.tolist(), starts.tolist(), starts[1:].tolist() + [len(order)]):
+            (row, col) = divmod(chunk_key, chunk_cols)
+            chunk = self.__chunk(col, row)
+            if values is None:
+                values = np.empty(len(xs), dtype=chunk.dtype)
+            points = order[start:end]
+            values[points] = chunk[ys[points] - row * self.chunk_y, xs[points] - col * self.chunk_x]
+        if values is None:
+            values = np.empty(0, dtype=np.float32)
+        return values
@@ -6,26 +6,38 @@
 #
 
 import os
+import time
+import functools
+import hashlib
+import threading
+from collections import namedtuple
 import numpy as np
-from osgeo import gdalconst
-from osgeo import gdal
-import struct
 
 from .GlobalGeodetic import GlobalGeodetic
-from .TerrainTile import TerrainTile
+from .TerrainTile import TerrainTile, encode_heightmap_bundle
+from .BundleFile import BundleWriter, BundleUpdater, bundle_file_name
+from .Resample import grid_kernel, resample_grid
+from .MeshExtensions import grid_normals
+from .MeshHeader import bundle_headers
+from .TileWriter import TileWriter
+from .Metrics import STAGES
 
-import sys
-if sys.version_info >= (3, 0):
-    xrange = range
 
+# lightweight description of a bundle, consumed by workers to build a TerrainBundle
+BundlePlan = namedtuple('BundlePlan', ['level', 'from_tile', 'resolution', 'has_next_level', 'band_index'])
+
+
+# tiles of a bundle as struct of arrays, bounds are (min_x, min_y, max_x, max_y)
+TileTable = namedtuple('TileTable', ['x', 'y', 'x_offset', 'y_offset', 'flag', 'min_x', 'min_y', 'max_x', 'max_y'])
+
+# Cesium format neighbor tiles flags
+HAS_SW = 0x01
+HAS_SE = 0x02
+HAS_NW = 0x04
+HAS_NE = 0x08
 
-def make_child_flags(N, S, E, W):
-    # Cesium format neighbor tiles flags
-    HAS_SW = 0x01
-    HAS_SE = 0x02
-    HAS_NW = 0x04
-    HAS_NE = 0x08
 
+def make_child_flags(N, S, E, W):
     NB_FLAGS = 0x00
 
     if N & W:
@@ -40,23 +52,112 @@ def make_child_flags(N, S, E, W):
     return NB_FLAGS
 
 
+def _window_kernel(kernel, offset):
+    """
+    grid_kernel relative to a window starting at source pixel offset
+    """
+    (start, end, weight) = kernel
+    return start - offset, end - offset, weight
+
+
 class TerrainBundle(object):
 
     def __init__(self, in_source_band, bundle_size, is_compact):
         self.bundle_size = bundle_size
         self.data_band = in_source_band
         self.is_compact = is_compact
-        self.__tiles = []
+        self.tiles = None
         self.has_next_level = True
         self.level = 0
         self.resolution = None
         self.from_tile = None
         self.source_range = None
-        self.data_band = None
+        self.band_index = 0
         self.no_data = None
         self.out_no_data = None
         self.bundle_array = None
         self.fill_raster = None
+        # kernel resampling source windows to the bundle array: nearest, bilinear or average
+        self.resampling = 'nearest'
+        # cover all bundle_size * bundle_size tiles, not only the ones inside source range
+        self.full_extent = False
+        self.compression_level = 9
+        # optional thread pool executor to encode and compress tiles concurrently
+        self.compress_pool = None
+        # store identical tiles once: shared data in compact bundles, hardlinks in single mode
+        self.dedup = False
+        # TileWriter of single mode or TileDatabase of sqlite mode, shared by the bundles of a worker,
+        # None writes tile files in this thread
+        self.tile_writer = None
+        # update mode: (min_x, min_y, max_x, max_y), only tiles intersecting it are written
+        self.update_region = None
+        # MemoryBudget allocating the bundle array, None allocates it in memory
+        self.memory_budget = None
+        # mesh water mask extension: water is where water_raster is not 0, or where the source has no data
+        self.water_mask = False
+        self.water_raster = None
+        self.water_array = None
+        # mesh tiles encoded: [tiles, triangles, vertices, seconds triangulating, seconds encoding]
+        self.mesh_stats = [0, 0, 0, 0.0, 0.0]
+        # seconds spent in each of STAGES, summed over the threads of the compress pool
+        self.stage_times = dict.fromkeys(STAGES, 0.0)
+        self.__stage_lock = threading.Lock()
+        self.tiles_written = 0
+        self.bytes_written = 0
+
+    def timed(self, stage, func):
+        """
+        wrap func to add its run time to stage_times[stage], safe to call from the compress pool
+        """
+        def timed_func(*args):
+            start = time.perf_counter()
+            result = func(*args)
+            elapsed = time.perf_counter() - start
+            with self.__stage_lock:
+                self.stage_times[stage] += elapsed
+            return result
+        return timed_func
+
+    def lap(self, stage, start):
+        """
+        add the seconds since start to stage_times[stage]
+        :return: now, the start of the next lap
+        """
+        now = time.perf_counter()
+        self.stage_times[stage] += now - start
+        return now
+
+    @property
+    def fill_value(self):
+        return self.out_no_data if self.out_no_data is not None else 0
+
+    @staticmethod
+    def merge_quarters(quarters, bundle_size, fill_value, memory_budget=None):
+        """
+        merge downsampled child bundle arrays into the array of their parent bundle
+        :param quarters: dict of (quadrant x, quadrant y) -> array, (0, 0) is the north west child
+        :param memory_budget: MemoryBudget allocating the merged array
+        """
+        half = bundle_size * 32
+        shape = (bundle_size * 64 + 1, bundle_size * 64 + 1)
+        if memory_budget is not None:
+            merged = memory_budget.full(shape, fill_value)
+        else:
+            merged = np.full(shape, fill_value, dtype=np.float32)
+        for (q_x, q_y), quarter in sorted(quarters.items()):
+            if quarter is None:
+                continue
+            merged[q_y * half:q_y * half + half + 1, q_x * half:q_x * half + half + 1] = quarter
+        return merged
+
+    def half_array(self):
+        """
+        bundle array at half resolution, the heightmap grid points of the parent
+        level are every second point of this level.
+        """
+        if self.bundle_array is None:
+            return None
+        return np.array(self.bundle_array[::2, ::2], dtype=np.float32)
 
     def calculate_tiles(self):
         cols = self.data_band.XSize
@@ -64,39 +165,44 @@ class TerrainBundle(object):
         (data_min_x, data_min_y, data_max_x, data_max_y) = self.source_range
         band_res = (data_max_x - data_min_x) / cols
         gg = GlobalGeodetic(True, 64)
-        tile_x = self.from_tile[0]
-        tile_y = self.from_tile[1]
-        tile_max_x = tile_x
-        tile_min_y = tile_y
-        (t_min_y, t_min_x, t_max_y, t_max_x) = gg.TileLatLonBounds(tile_x, tile_y, self.level)
-
-        for index_x in xrange(0, self.bundle_size):
-            tile_x = self.from_tile[0] + index_x
-            for index_y in xrange(0, self.bundle_size):
-                tile_y = self.from_tile[1] - index_y
-                tile_range = (t_min_y, t_min_x, t_max_y, t_max_x) = gg.TileLatLonBounds(tile_x, tile_y, self.level)
-
-                if self.is_in_source_range(t_min_x, t_min_y, t_max_x, t_max_y):
-                    tile_max_x = max(tile_max_x, tile_x)
-                    tile_min_y = min(tile_min_y, tile_y)
-                    if self.has_next_level:
-                        flag = self.calc_tile_flag(tile_range)
-                    else:
-                        flag = 0x00
-                    tile = TerrainTile(index_x * 64, index_y*64, flag, (t_min_x, t_min_y, t_max_x, t_max_y), self.resolution)
-                    tile.x = tile_x
-                    tile.y = tile_y
-
-                    if self.level < 4:
-                        tile.fake = True
-
-                    self.__tiles.append(tile)
+
+        # all tiles of the bundle, column by column
+        index_x, index_y = np.meshgrid(np.arange(self.bundle_size), np.arange(self.bundle_size), indexing='ij')
+        index_x = index_x.ravel()
+        index_y = index_y.ravel()
+        tile_x = self.from_tile[0] + index_x
+        tile_y = self.from_tile[1] - index_y
+        (t_min_y, t_min_x, t_max_y, t_max_x) = gg.TileLatLonBoundsArray(tile_x, tile_y, self.level)
+
+        in_range = self.in_source_range(t_min_x, t_min_y, t_max_x, t_max_y)
+        if self.has_next_level:
+            flags = self.calc_tile_flags(t_min_y, t_min_x, t_max_y, t_max_x)
+        else:
+            flags = np.zeros(tile_x.shape, dtype=np.uint8)
+
+        # tiles outside the update region still size the bundle array, so that the
+        # updated tiles are resampled exactly as a full run does
+        array_tiles = in_range
+        if self.update_region is not None:
+            in_range = in_range & self.in_update_region(t_min_x, t_min_y, t_max_x, t_max_y)
+
+        self.tiles = TileTable(tile_x[in_range], tile_y[in_range], index_x[in_range] * 64, index_y[in_range] * 64,
+                               flags[in_range], t_min_x[in_range], t_min_y[in_range], t_max_x[in_range],
+                               t_max_y[in_range])
+        tile_max_x = max(self.from_tile[0], int(tile_x[array_tiles].max())) if array_tiles.any() else self.from_tile[0]
+        tile_min_y = min(self.from_tile[1], int(tile_y[array_tiles].min())) if array_tiles.any() else self.from_tile[1]
 
         if self.level < 4:
             return
 
+        # already built from child bundles
+        if self.bundle_array is not None:
+            return
+
         bundle_tiles_x = tile_max_x - self.from_tile[0] + 1
         bundle_tiles_y = self.from_tile[1] - tile_min_y + 1
+        if self.full_extent:
+            bundle_tiles_x = bundle_tiles_y = self.bundle_size
         bundle_px_width = bundle_tiles_x * 64 + 1
         bundle_px_height = bundle_tiles_y * 64 + 1
 
@@ -110,121 +216,211 @@ class TerrainBundle(object):
             f_max_x + (f_max_x - f_min_x) * (bundle_tiles_x - 1)
         )
 
-        b_px_min_x = int((b_min_x - data_min_x) / band_res)
-        b_px_max_x = int((b_max_x - data_min_x) / band_res) + 1
-        b_px_min_y = int((data_max_y - b_max_y) / band_res)
-        b_px_max_y = int((data_max_y - b_min_y) / band_res) + 1
-
-        b_real_min_x, b_real_max_x, b_real_min_y, b_real_max_y = b_min_x, b_max_x, b_min_y, b_max_y
-        shift_left = shift_right = shift_top = shift_bottom = 0
-        if b_px_min_x < 0:
-            shift_left = abs(b_px_min_x)
-            b_real_min_x += shift_left * band_res
-            b_px_min_x = 0
-        if b_px_max_x >= cols:
-            shift_right = b_px_max_x - cols
-            b_real_max_x -= shift_right * band_res
-            b_px_max_x = cols
-        if b_px_min_y < 0:
-            shift_top = abs(b_px_min_y)
-            b_real_min_y += shift_top * band_res
-            b_px_min_y = 0
-        if b_px_max_y >= rows:
-            shift_bottom = b_px_max_y - rows
-            b_real_max_y -= shift_bottom * band_res
-            b_px_max_y = rows
-        w_x = b_px_max_x - b_px_min_x
-        w_y = b_px_max_y - b_px_min_y
-
-        tile_array = self.data_band.ReadAsArray(b_px_min_x, b_px_min_y, w_x, w_y)
-
-        fill_blank_value = self.out_no_data
+        # points of the bundle array on the grid of the level, in source pixels. they are computed from
+        # global point indexes, so that a point reads the same source pixels whatever bundle it is in
+        step = gg.Resolution(self.level)
+        point_x = -180.0 + (self.from_tile[0] * 64 + np.arange(bundle_px_width)) * step
+        point_y = -90.0 + ((self.from_tile[1] + 1) * 64 - np.arange(bundle_px_height)) * step
+        source_x = (point_x - data_min_x) / band_res
+        source_y = (data_max_y - point_y) / band_res
+        # points less than half a pixel outside the source take its edge pixels
+        inside_x = np.flatnonzero((source_x >= -0.5) & (source_x <= cols + 0.5))
+        inside_y = np.flatnonzero((source_y >= -0.5) & (source_y <= rows + 0.5))
+
+        out_shape = (bundle_px_height, bundle_px_width)
+        if self.memory_budget is not None:
+            self.bundle_array = self.memory_budget.full(out_shape, self.fill_value)
+        else:
+            self.bundle_array = np.full(out_shape, self.fill_value, dtype=np.float32)
+        if self.water_mask and self.water_raster is not None:
+            water = self.water_raster.get_array((b_min_x, b_min_y, b_max_x, b_max_y), bundle_px_width,
+                                                bundle_px_height)
+            if water is not None:
+                self.water_array = water > 0
+        if len(inside_x) == 0 or len(inside_y) == 0:
+            return
+        (x0, x1) = (inside_x[0], inside_x[-1] + 1)
+        (y0, y1) = (inside_y[0], inside_y[-1] + 1)
+
+        x_kernel = grid_kernel(source_x[x0:x1], cols, self.resampling, step / band_res)
+        y_kernel = grid_kernel(source_y[y0:y1], rows, self.resampling, step / band_res)
+        (b_px_min_x, b_px_max_x) = (int(x_kernel[0].min()), int(x_kernel[1].max()))
+        (b_px_min_y, b_px_max_y) = (int(y_kernel[0].min()), int(y_kernel[1].max()))
+
+        start = time.perf_counter()
+        tile_array = self.data_band.ReadAsArray(b_px_min_x, b_px_min_y, b_px_max_x - b_px_min_x,
+                                                b_px_max_y - b_px_min_y)
+        start = self.lap('read', start)
+
+        if self.water_mask and self.water_raster is None and self.no_data is not None:
+            # the nearest pixels are inside the window of any kernel
+            water_array = (tile_array == self.no_data).view(np.uint8)
+            self.water_array = np.zeros(out_shape, dtype=bool)
+            self.water_array[y0:y1, x0:x1] = resample_grid(
+                water_array, _window_kernel(grid_kernel(source_x[x0:x1], cols, 'nearest'), b_px_min_x),
+                _window_kernel(grid_kernel(source_y[y0:y1], rows, 'nearest'), b_px_min_y), 'nearest') > 0
+
         if self.out_no_data is not None and self.no_data is not None:
-            fill_blank_value = self.out_no_data
             np.place(tile_array, tile_array == self.no_data, self.out_no_data)
-
-        shift_obj = (shift_obj_v, shift_obj_h) = ((shift_top, shift_bottom), (shift_left, shift_right))
-
-        if shift_obj != ((0, 0), (0, 0)):
-            tile_array = np.lib.pad(tile_array, shift_obj, 'constant', constant_values=[fill_blank_value])
+        start = self.lap('nodata', start)
 
         if self.fill_raster:
             h,w = tile_array.shape
-            fill_array = self.fill_raster.get_array((b_real_min_x, b_real_min_y, b_real_max_x, b_real_max_y), w, h)
+            fill_array = self.fill_raster.get_array((data_min_x + b_px_min_x * band_res, data_max_y - b_px_max_y * band_res,
+                                                     data_min_x + b_px_max_x * band_res, data_max_y - b_px_min_y * band_res),
+                                                    w, h)
             if fill_array is not None:
                 tile_array = np.where(tile_array==0, fill_array, tile_array)
+            start = self.lap('fill', start)
 
-
-        (m_rows, m_cols) = tile_array.shape
-
-        mem_drv = gdal.GetDriverByName('MEM')
-
-        dst_bundle_ds = mem_drv.Create('', bundle_px_width, bundle_px_height, 1, gdalconst.GDT_Float32)
-
-        if m_cols == bundle_px_width and m_rows == bundle_px_height:
-            dst_bundle_ds.WriteRaster(0, 0, m_cols, m_rows, np.frombuffer(tile_array, tile_array.dtype).tostring())
-            self.bundle_array = np.array(dst_bundle_ds.GetRasterBand(1).ReadAsArray(0, 0, bundle_px_width, bundle_px_height))
-        else:
-            prj_ds = mem_drv.Create('', m_cols, m_rows, 1, gdalconst.GDT_Float32)
-            prj_band = prj_ds.GetRasterBand(1)
-            prj_band.WriteArray(tile_array, 0, 0)
-            dst_bundle_ds.SetGeoTransform((0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
-            prj_ds.SetGeoTransform(
-                (0.0, bundle_px_width / float(m_cols), 0.0, 0.0, 0.0, bundle_px_height / float(m_rows)))
-            res = gdal.ReprojectImage(prj_ds, dst_bundle_ds, None, None, eResampleAlg=gdalconst.GRIORA_NearestNeighbour)
-            if res != 0:
-                self.error("ReprojectImage() failed on %s, error %d" % ('aa', res))
-            else:
-                self.bundle_array = np.array(dst_bundle_ds.GetRasterBand(1).ReadAsArray(0, 0, bundle_px_width, bundle_px_height))
-            
-            del prj_ds
-
+        kernel_no_data = self.out_no_data if self.out_no_data is not None else self.no_data
+        resample_grid(tile_array, _window_kernel(x_kernel, b_px_min_x), _window_kernel(y_kernel, b_px_min_y),
+                      self.resampling, kernel_no_data, self.bundle_array[y0:y1, x0:x1])
         del tile_array
-        del dst_bundle_ds
+        self.lap('resample', start)
 
-    def calc_tile_flag(self, bound):
-        (t_min_y, t_min_x, t_max_y, t_max_x) = bound
-        N = S = W = E = False
+    def calc_tile_flags(self, t_min_y, t_min_x, t_max_y, t_max_x):
+        """
+        child flags of arrays of tile bounds
+        """
         mid_x = (t_min_x + t_max_x) / 2
         mid_y = (t_min_y + t_max_y) / 2
         s_min_x, s_min_y, s_max_x, s_max_y = self.source_range
-        if s_min_x <= mid_x and s_max_x >= t_min_x:
-            W = True
-        if s_min_x <= t_max_x and s_max_x >= mid_x:
-            E = True
-        if s_min_y <= t_max_y and s_max_y >= mid_y:
-            N = True
-        if s_min_y <= mid_y and s_max_y >= t_min_y:
-            S = True
-
-        return make_child_flags(N, S, E, W)
-
-    def is_in_source_range(self, min_x, min_y, max_x, max_y):
+        W = (s_min_x <= mid_x) & (s_max_x >= t_min_x)
+        E = (s_min_x <= t_max_x) & (s_max_x >= mid_x)
+        N = (s_min_y <= t_max_y) & (s_max_y >= mid_y)
+        S = (s_min_y <= mid_y) & (s_max_y >= t_min_y)
+
+        flags = np.zeros(np.shape(t_min_x), dtype=np.uint8)
+        flags[N & W] |= HAS_NW
+        flags[N & E] |= HAS_NE
+        flags[S & W] |= HAS_SW
+        flags[S & E] |= HAS_SE
+        return flags
+
+    def in_source_range(self, min_x, min_y, max_x, max_y):
+        """
+        mask of the tiles in arrays of tile bounds which intersect the source range
+        """
         s_min_x, s_min_y, s_max_x, s_max_y = self.source_range
-        if min_x > s_max_x or max_x < s_min_x or min_y > s_max_y or max_y < s_min_y:
-            return False
-        return True
+        return ~((min_x > s_max_x) | (max_x < s_min_x) | (min_y > s_max_y) | (max_y < s_min_y))
+
+    def in_update_region(self, min_x, min_y, max_x, max_y):
+        """
+        mask of the tiles in arrays of tile bounds which intersect the update region
+        """
+        u_min_x, u_min_y, u_max_x, u_max_y = self.update_region
+        return ~((min_x > u_max_x) | (max_x < u_min_x) | (min_y > u_max_y) | (max_y < u_min_y))
+
+    def iter_tiles(self, normals=None, headers=None):
+        """
+        yield a TerrainTile for each row of the tile table
+        :param normals: oct encoded normals of the bundle array
+        :param headers: mesh headers of the rows of the tile table
+        """
+        table = self.tiles
+        columns = zip(table.x.tolist(), table.y.tolist(), table.x_offset.tolist(), table.y_offset.tolist(),
+                      table.flag.tolist(), table.min_x.tolist(), table.min_y.tolist(), table.max_x.tolist(),
+                      table.max_y.tolist())
+        for row, (x, y, x_offset, y_offset, flag, min_x, min_y, max_x, max_y) in enumerate(columns):
+            tile = TerrainTile(x_offset, y_offset, flag, (min_x, min_y, max_x, max_y), self.resolution)
+            if headers is not None:
+                tile.header = headers[row]
+            tile.x = x
+            tile.y = y
+            tile.compression_level = self.compression_level
+            tile.normals_source = normals
+            tile.water_source = self.water_array
+            tile.with_water_mask = self.water_mask
+            if self.level < 4:
+                tile.fake = True
+            yield tile
+
+    def iter_encoded(self, decode_type, mesh_max_error):
+        """
+        yield (x, y, compressed tile, content digest) for each row of the tile table.
+        the digest is None unless dedup is on, identical heightmap payloads are compressed once.
+        with a compress pool tiles are compressed concurrently, the order stays the same.
+        """
+        table = self.tiles
+        map_func = self.compress_pool.map if self.compress_pool is not None else map
+        times = self.stage_times
+        if decode_type == 'heightmap':
+            start = time.perf_counter()
+            source_array = self.bundle_array if self.level >= 4 else None
+            payloads = encode_heightmap_bundle(source_array, table.x_offset, table.y_offset, table.flag)
+            if self.dedup:
+                digests = [hashlib.sha1(payload).digest() for payload in payloads]
+            else:
+                digests = [None] * len(payloads)
+            times['encode'] += time.perf_counter() - start
+            compress = self.timed('compress', functools.partial(TerrainTile.compress_gz, level=self.compression_level))
+            if self.dedup:
+                first_rows = {}
+                for row, digest in enumerate(digests):
+                    first_rows.setdefault(digest, row)
+                unique_rows = sorted(first_rows.values())
+                compressed = dict(zip(unique_rows, map_func(compress, payloads[unique_rows])))
+                binaries = (compressed[first_rows[digest]] for digest in digests)
+            else:
+                binaries = map_func(compress, payloads)
+            for x, y, binary, digest in zip(table.x.tolist(), table.y.tolist(), binaries, digests):
+                yield x, y, binary, digest
+        else:
+            def encode(tile):
+                tile.encode(self.bundle_array, decode_type, mesh_max_error)
+                return tile
+
+            start = time.perf_counter()
+            normals = None
+            headers = None
+            if self.bundle_array is not None and self.level >= 4:
+                # once for the bundle: tiles take the normals at their vertices, and headers
+                # bounding all grid points of a tile hold for its mesh
+                gg = GlobalGeodetic(True, 64)
+                (f_min_y, f_min_x, f_max_y, f_max_x) = gg.TileLatLonBounds(self.from_tile[0], self.from_tile[1],
+                                                                           self.level)
+                res = (f_max_x - f_min_x) / 64
+                normals = grid_normals(self.bundle_array, f_min_x, f_max_y, res, res)
+                headers = bundle_headers(self.bundle_array, f_min_x, f_max_y, res, table.x_offset, table.y_offset)
+            times['encode'] += time.perf_counter() - start
+
+            stats = self.mesh_stats
+            for tile in map_func(encode, self.iter_tiles(normals, headers)):
+                stats[0] += 1
+                stats[1] += tile.triangle_count
+                stats[2] += tile.vertex_count
+                stats[3] += tile.triangulate_time
+                stats[4] += tile.encode_time
+                times['encode'] += tile.triangulate_time + tile.encode_time - tile.compress_time
+                times['compress'] += tile.compress_time
+                digest = hashlib.sha1(tile.binary).digest() if self.dedup else None
+                yield tile.x, tile.y, tile.binary, digest
 
     def write_tiles(self, location, decode_type, mesh_max_error):
         self.calculate_tiles()
-        terrain_level_loc = os.path.join(location, str(self.level))
-        if os.path.isdir(terrain_level_loc) is False:
-            os.mkdir(terrain_level_loc)
-
         if self.is_compact is True:
-            bundle_name = '{0}_{1}.bundle'.format(self.from_tile[0], self.from_tile[1])
-            bundle_file_path = os.path.join(terrain_level_loc, bundle_name)
-            bundle_f = open(bundle_file_path, 'wb')
-            while len(self.__tiles) > 0:
-                tile = self.__tiles.pop(0)
-                tile.encode(self.bundle_array, decode_type, mesh_max_error)
-                header = struct.pack('<3i', tile.x, tile.y, len(tile.binary))
-                bundle_f.write(header)
-                bundle_f.write(tile.binary)
-                del tile
-            bundle_f.close()
+            terrain_level_loc = os.path.join(location, str(self.level))
+            # other workers may create the same directory concurrently
+            if os.path.isdir(terrain_level_loc) is False:
+                os.makedirs(terrain_level_loc, exist_ok=True)
+            bundle_file_path = os.path.join(terrain_level_loc, bundle_file_name(self.from_tile))
+            writer = BundleUpdater if self.update_region is not None else BundleWriter
+            with writer(bundle_file_path, self.level, self.from_tile, self.bundle_size) as bundle_f:
+                write_tile = self.timed('write', bundle_f.write_tile)
+                for x, y, binary, digest in self.iter_encoded(decode_type, mesh_max_error):
+                    write_tile(x, y, binary, digest)
+                    self.tiles_written += 1
+                    self.bytes_written += len(binary)
+                start = time.perf_counter()
+            self.lap('write', start)
         else:
-            while len(self.__tiles) > 0:
-                tile = self.__tiles.pop(0)
-                tile.encode_and_save(self.bundle_array, terrain_level_loc, decode_type, mesh_max_error)
-                del tile
+            writer = self.tile_writer if self.tile_writer is not None else TileWriter(location, 0)
+            for x, y, binary, digest in self.iter_encoded(decode_type, mesh_max_error):
+                writer.put(self.level, x, y, binary, digest)
+                self.tiles_written += 1
+                self.bytes_written += len(binary)
+            # the bundle is complete once its files are written, time blocked on the
+            # queue shows in encode and compress
+            self.stage_times['write'] += writer.flush()
+        self.tiles = None
@@ -2,12 +2,67 @@ import numpy as np
 import struct
 import os
 import zlib
+import time
 from io import BytesIO
 
 import quantized_mesh_encoder
+# not the public api of quantized_mesh_encoder, tests compare write_mesh with its encode byte for byte
+from quantized_mesh_encoder.encode import interp_positions, write_vertices, write_indices, write_edge_indices
 from pydelatin import Delatin
 from pydelatin.util import rescale_positions
 
+from .MeshExtensions import extension, grid_normals, water_mask, VERTEX_NORMALS_ID, WATER_MASK_ID
+from .MeshHeader import pack_header
+
+
+# heightmap-1.0 payload: 65 * 65 int16 heights, child flags byte and water mask byte
+HEIGHTMAP_SIZE = 65
+HEIGHTMAP_PAYLOAD_SIZE = HEIGHTMAP_SIZE * HEIGHTMAP_SIZE * 2 + 2
+
+
+def encode_heightmap_bundle(bundle_array, x_offsets, y_offsets, child_flags):
+    """
+    heightmap payloads of many tiles of a bundle in one pass
+    :param bundle_array: heights of the bundle, None for fake tiles
+    :param x_offsets: array of tile column offsets in bundle_array
+    :param y_offsets: array of tile row offsets in bundle_array
+    :param child_flags: array of child flags
+    :return: uint8 array of shape (tile count, HEIGHTMAP_PAYLOAD_SIZE), one uncompressed payload per row
+    """
+    count = len(x_offsets)
+    payloads = np.empty((count, HEIGHTMAP_PAYLOAD_SIZE), dtype=np.uint8)
+    heights = payloads[:, :-2].view('<i2')
+    if bundle_array is None:
+        # encoded height of 0 m
+        heights[:] = (0 + 1000) * 5
+    else:
+        encoded = ((bundle_array + 1000) * 5).astype('<i2')
+        (rows, cols) = encoded.shape
+        (row_stride, col_stride) = encoded.strides
+        # overlapping 65 * 65 windows every 64 pixels, as views of the encoded bundle
+        windows = np.lib.stride_tricks.as_strided(
+            encoded,
+            shape=((rows - 1) // 64, (cols - 1) // 64, HEIGHTMAP_SIZE, HEIGHTMAP_SIZE),
+            strides=(row_stride * 64, col_stride * 64, row_stride, col_stride),
+            writeable=False)
+        heights[:] = windows[np.asarray(y_offsets) // 64, np.asarray(x_offsets) // 64].reshape(count, -1)
+    payloads[:, -2] = child_flags
+    # the water mask is the mesh extension only, heightmap tiles are all land
+    payloads[:, -1] = 0x00
+    return payloads
+
+
+def decode_heightmap_tiles(payloads):
+    """
+    heights of many heightmap tiles in one pass
+    :param payloads: list of uncompressed heightmap-1.0 payloads
+    :return: float32 array of shape (tile count, 65, 65), north row first
+    """
+    size = HEIGHTMAP_SIZE * HEIGHTMAP_SIZE * 2
+    # the water mask may be a byte or a 256 * 256 grid, only the heights are kept
+    heights = np.frombuffer(b''.join(payload[:size] for payload in payloads), dtype='<i2')
+    return (heights.reshape(len(payloads), HEIGHTMAP_SIZE, HEIGHTMAP_SIZE) / np.float32(5) - 1000).astype(np.float32)
+
 
 class TerrainTile(object):
 
@@ -26,6 +81,22 @@ class TerrainTile(object):
         # bounds: (minx, miny, maxx, maxy)
         self.bounds = tile_bounds
         self.resolution = tile_resolution
+        self.compression_level = 9
+        # mesh extensions: oct encoded normals and water grid of the bundle, sliced to the tile on encode
+        self.normals_source = None
+        self.water_source = None
+        self.normals = None
+        self.water = None
+        self.with_water_mask = False
+        # row of MeshHeader.bundle_headers, None computes the header from the mesh
+        self.header = None
+        # mesh statistics of the last encode: triangles, vertices, seconds triangulating and encoding,
+        # of which compress_time compressing
+        self.triangle_count = 0
+        self.vertex_count = 0
+        self.triangulate_time = 0.0
+        self.encode_time = 0.0
+        self.compress_time = 0.0
 
     def encode(self, in_buddle_array, decodetype='heightmap', mesh_max_error=0.01):
         self.source_array = in_buddle_array
@@ -38,6 +109,10 @@ class TerrainTile(object):
                 self.encode_fake_mesh(mesh_max_error)
         else:
             self.array = self.source_array[self.y_offset:self.y_offset + 65, self.x_offset:self.x_offset + 65]
+            if self.normals_source is not None:
+                self.normals = self.normals_source[self.y_offset:self.y_offset + 65, self.x_offset:self.x_offset + 65]
+            if self.water_source is not None:
+                self.water = self.water_source[self.y_offset:self.y_offset + 65, self.x_offset:self.x_offset + 65]
             if self.decode_type == 'heightmap':
                 self.encode_heightmap()
             else:
@@ -51,11 +126,11 @@ class TerrainTile(object):
         encode_bytes = encode_array_int.tobytes(order='C')
         child_water_bytes = struct.pack('<BB', self.child_flag, self.water_mask)
         encode_bytes += child_water_bytes
-        self.binary = self.compress_gz(encode_bytes)
+        self.binary = self.compress_gz(encode_bytes, self.compression_level)
 
     @staticmethod
-    def compress_gz(in_bytes):
-        gzip_compress = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    def compress_gz(in_bytes, level=9):
+        gzip_compress = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
         gzip_data = gzip_compress.compress(in_bytes) + gzip_compress.flush()
         return gzip_data
 
@@ -65,30 +140,85 @@ class TerrainTile(object):
 
 
     def encode_mesh(self, mesh_max_error):
+        start = time.perf_counter()
         tin = Delatin(self.array, max_error=mesh_max_error)
         vertices = tin.vertices
         triangles = tin.triangles
+        triangulated = time.perf_counter()
         rescaled = rescale_positions(vertices, self.bounds)
         buf = BytesIO()
-        quantized_mesh_encoder.encode(buf, rescaled, triangles)
+        if self.header is None:
+            quantized_mesh_encoder.encode(buf, rescaled, triangles)
+        else:
+            self.write_mesh(buf, rescaled, triangles)
+        buf.write(self.encode_extensions(vertices))
         buf.seek(0)
-        self.binary = self.compress_gz(buf.read())
+        encoded = time.perf_counter()
+        self.binary = self.compress_gz(buf.read(), self.compression_level)
+        end = time.perf_counter()
+        self.triangle_count = len(triangles)
+        self.vertex_count = len(vertices)
+        self.triangulate_time = triangulated - start
+        self.encode_time = end - triangulated
+        self.compress_time = end - encoded
+
+    def write_mesh(self, buf, positions, triangles):
+        """
+        encode a mesh as quantized_mesh_encoder.encode does, with the precomputed header
+        """
+        positions = positions.reshape(-1, 3).astype(np.float32)
+        heights = positions[:, 2]
+        buf.write(pack_header(self.header, heights.min(), heights.max()))
+        quantized = interp_positions(positions)
+        vertex_count = quantized.shape[0]
+        write_vertices(buf, quantized, vertex_count)
+        write_indices(buf, triangles.reshape(-1, 3).astype(np.uint32), vertex_count)
+        write_edge_indices(buf, quantized, vertex_count)
+
+    def encode_extensions(self, vertices):
+        """
+        extensions following the encoded mesh
+        :param vertices: Delatin vertices, the y axis points north
+        """
+        data = b''
+        if self.normals is not None:
+            # a vertex at y is on row (size - y) of the tile grid
+            size = self.array.shape[0] - 1
+            rows = size - vertices[:, 1].astype(np.intp)
+            cols = vertices[:, 0].astype(np.intp)
+            data += extension(VERTEX_NORMALS_ID, self.normals[rows, cols].tobytes())
+        if self.with_water_mask:
+            data += extension(WATER_MASK_ID, water_mask(self.water) if self.water is not None else b'\x00')
+        return data
 
     def encode_fake_mesh(self, mesh_max_error):
         self.array = np.zeros(64).reshape(8, 8)
+        (min_x, min_y, max_x, max_y) = self.bounds
+        self.normals = grid_normals(self.array, min_x, max_y, (max_x - min_x) / 7, (max_y - min_y) / 7)
         self.encode_mesh(mesh_max_error)
 
     def encode_and_save(self, in_buddle_array, location, decodetype='heightmap', mesh_max_error=0.01):
         self.encode(in_buddle_array, decodetype, mesh_max_error)
         if self.binary is not None:
-            # save
-            terrain_x_loc = os.path.join(location, str(self.x))
-            if os.path.isdir(terrain_x_loc) is False:
-                os.mkdir(terrain_x_loc)
-            terrain_file_name = terrain_x_loc + '/' + str(self.y) + '.terrain'
-            with open(terrain_file_name, 'wb+') as f:
-                f.write(self.binary)
-
+            self.save_binary(location, self.x, self.y, self.binary)
             self.binary = None
 
+    @staticmethod
+    def tile_path(location, x, y):
+        return os.path.join(location, str(x)) + '/' + str(y) + '.terrain'
+
+    @staticmethod
+    def save_binary(location, x, y, binary):
+        """
+        write a tile file aside and rename it over the existing one, which may be
+        a hardlink shared with other tiles
+        """
+        terrain_x_loc = os.path.join(location, str(x))
+        if os.path.isdir(terrain_x_loc) is False:
+            os.makedirs(terrain_x_loc, exist_ok=True)
+        terrain_file_name = TerrainTile.tile_path(location, x, y)
+        with open(terrain_file_name + '.tmp', 'wb') as f:
+            f.write(binary)
+        os.replace(terrain_file_name + '.tmp', terrain_file_name)
+
 
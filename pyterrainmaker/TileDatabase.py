@@ -0,0 +1,209 @@
+#
+# TileDatabase
+# all tiles of a tileset in one SQLite database, in the MBTiles layout
+#
+# plain layout: tiles (zoom_level, tile_column, tile_row, tile_data)
+# dedup layout: images (tile_id, tile_data) holds each distinct tile once, map (zoom_level,
+#   tile_column, tile_row, tile_id) points tiles to it, and the view tiles joins them.
+# rows are TMS rows, as the y of terrain tiles. metadata holds name/value pairs,
+# 'json' is the layer.json of the tileset.
+#
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import urllib.request
+
+DATABASE_NAME = 'terrain.mbtiles'
+# seconds a writer waits for the lock held by the transaction of another worker
+BUSY_TIMEOUT = 600
+
+PLAIN_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+                                  PRIMARY KEY (zoom_level, tile_column, tile_row));
+'''
+DEDUP_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT,
+                                PRIMARY KEY (zoom_level, tile_column, tile_row));
+CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id);
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, map.tile_row AS tile_row,
+           images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+'''
+
+
+def database_path(loc):
+    """
+    :param loc: output directory, or the path of a database
+    """
+    if os.path.isdir(loc):
+        return os.path.join(loc, DATABASE_NAME)
+    return loc
+
+
+def layer_metadata(name, layer_json):
+    """
+    :return: metadata rows of a tileset described by layer_json
+    """
+    return {
+        'name': name,
+        'format': layer_json['format'],
+        'scheme': 'tms',
+        'bounds': ','.join(str(v) for v in layer_json['bounds']),
+        'minzoom': layer_json.get('minzoom', 0),
+        'maxzoom': layer_json['maxzoom'],
+        'json': json.dumps(layer_json)
+    }
+
+
+def is_database(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(16) == b'SQLite format 3\0'
+
+
+class TileDatabase(object):
+
+    def __init__(self, path, create=False, dedup=False, readonly=False):
+        """
+        open a tile database
+        :param create: create the tables if they do not exist, in the dedup layout if dedup is on.
+                       an existing database keeps its layout
+        :param readonly: open without taking write locks, for serving and reading tiles
+        """
+        self.path = path
+        if readonly:
+            uri = 'file:{0}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(path)))
+            self.__conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            if not create and not os.path.exists(path):
+                raise Exception('{0} is not found.'.format(path))
+            # transactions are begun explicitly
+            self.__conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            if create:
+                # readers never block the writer, and workers append to one write ahead log
+                self.__conn.execute('PRAGMA journal_mode=WAL')
+                self.__conn.executescript(DEDUP_SCHEMA if dedup else PLAIN_SCHEMA)
+        self.dedup = self.__conn.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'map'").fetchone()[0] > 0
+        self.__pending = []
+
+    def put(self, level, x, y, binary, digest=None):
+        """
+        queue a tile, the tiles put are inserted by flush in one transaction. an existing tile is replaced.
+        :param digest: content digest, computed for the dedup layout if it is None
+        """
+        self.__pending.append((level, x, y, binary, digest))
+
+    def flush(self):
+        """
+        insert the tiles put since the last flush
+        :return: seconds spent inserting
+        """
+        if not self.__pending:
+            return 0.0
+        start = time.perf_counter()
+        (pending, self.__pending) = (self.__pending, [])
+        # take the write lock at once, a deferred transaction could fail to upgrade its read lock
+        self.__conn.execute('BEGIN IMMEDIATE')
+        try:
+            if self.dedup:
+                tile_ids = [(digest or hashlib.sha1(binary).digest()).hex() for _, _, _, binary, digest in pending]
+                self.__conn.executemany('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+                                        ((tile_id, row[3]) for tile_id, row in zip(tile_ids, pending)))
+                self.__conn.executemany('INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) '
+                                        'VALUES (?, ?, ?, ?)',
+                                        ((row[0], row[1], row[2], tile_id) for tile_id, row in zip(tile_ids, pending)))
+            else:
+                self.__conn.executemany('INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) '
+                                        'VALUES (?, ?, ?, ?)', (row[:4] for row in pending))
+            self.__conn.execute('COMMIT')
+        except BaseException:
+            self.__conn.execute('ROLLBACK')
+            raise
+        return time.perf_counter() - start
+
+    def get_tile(self, level, x, y):
+        """
+        :return: stored tile bytes, None if the tile does not exist
+        """
+        row = self.__conn.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND '
+                                  'tile_row = ?', (level, x, y)).fetchone()
+        return bytes(row[0]) if row is not None else None
+
+    def has_tile(self, level, x, y):
+        table = 'map' if self.dedup else 'tiles'
+        query = 'SELECT 1 FROM {0} WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?'.format(table)
+        return self.__conn.execute(query, (level, x, y)).fetchone() is not None
+
+    def iter_tiles(self, level=None, min_x=None, max_x=None):
+        """
+        yield (level, x, y, tile bytes) of all tiles, or of one level and columns min_x to max_x,
+        north row first in each level
+        """
+        query = 'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles'
+        params = ()
+        if level is not None:
+            query += ' WHERE zoom_level = ?'
+            params = (level,)
+            if min_x is not None:
+                query += ' AND tile_column BETWEEN ? AND ?'
+                params += (min_x, max_x)
+        query += ' ORDER BY zoom_level, tile_row DESC, tile_column'
+        for z, x, y, data in self.__conn.execute(query, params):
+            yield z, x, y, bytes(data)
+
+    def levels(self):
+        table = 'map' if self.dedup else 'tiles'
+        return [row[0] for row in self.__conn.execute('SELECT DISTINCT zoom_level FROM {0}'.format(table))]
+
+    def columns(self, level):
+        """
+        :return: sorted columns holding tiles of a level
+        """
+        table = 'map' if self.dedup else 'tiles'
+        query = 'SELECT DISTINCT tile_column FROM {0} WHERE zoom_level = ? ORDER BY tile_column'.format(table)
+        return [row[0] for row in self.__conn.execute(query, (level,))]
+
+    def get_metadata(self, name):
+        row = self.__conn.execute('SELECT value FROM metadata WHERE name = ?', (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_metadata(self, values):
+        """
+        :param values: dict of name -> value, values are stored as text
+        """
+        self.__conn.execute('BEGIN IMMEDIATE')
+        self.__conn.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+                                ((name, str(value)) for name, value in values.items()))
+        self.__conn.execute('COMMIT')
+
+    def remove_orphans(self):
+        """
+        dedup layout: delete the data of tiles no longer referenced by any tile
+        :return: number of deleted rows
+        """
+        if not self.dedup:
+            return 0
+        self.__conn.execute('BEGIN IMMEDIATE')
+        count = self.__conn.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)').rowcount
+        self.__conn.execute('COMMIT')
+        return count
+
+    def close(self):
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
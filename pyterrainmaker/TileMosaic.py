@@ -0,0 +1,124 @@
+#
+# TileMosaic
+# decode the heightmap tiles of a level into one GeoTIFF, window by window
+#
+
+import json
+import time
+import zlib
+import numpy as np
+from osgeo import gdal
+from osgeo import gdalconst
+from osgeo import osr
+
+from .GlobalGeodetic import GlobalGeodetic
+from .TerrainTile import decode_heightmap_tiles
+from .TileServer import TileStore, GZIP_MAGIC
+
+MOSAIC_NO_DATA = -9999.0
+# tiles per side of the windows decoded and written at once
+WINDOW_TILES = 16
+
+
+def level_tile_range(layer_json, level, bbox=None):
+    """
+    :param bbox: (min_x, min_y, max_x, max_y) in degrees to keep only the tiles touching it
+    :return: (min tile x, min tile y, max tile x, max tile y) of the available tiles of a level,
+             None if there is none
+    """
+    available = layer_json.get('available', [])
+    if level >= len(available) or not available[level]:
+        return None
+    ranges = available[level]
+    (min_tx, min_ty) = (min(r['startX'] for r in ranges), min(r['startY'] for r in ranges))
+    (max_tx, max_ty) = (max(r['endX'] for r in ranges), max(r['endY'] for r in ranges))
+    if bbox is not None:
+        gg = GlobalGeodetic(True, 64)
+        (b_min_tx, b_min_ty) = gg.LonLatToTile(bbox[0], bbox[1], level)
+        (b_max_tx, b_max_ty) = gg.LonLatToTile(bbox[2], bbox[3], level)
+        (min_tx, min_ty) = (max(min_tx, b_min_tx), max(min_ty, b_min_ty))
+        (max_tx, max_ty) = (min(max_tx, b_max_tx), min(max_ty, b_max_ty))
+    if min_tx > max_tx or min_ty > max_ty:
+        return None
+    return min_tx, min_ty, max_tx, max_ty
+
+
+def _decompress(tile):
+    if tile[:2] == GZIP_MAGIC:
+        return zlib.decompress(tile, zlib.MAX_WBITS | 16)
+    return tile
+
+
+def mosaic(loc, level, out_tif, bbox=None, window_tiles=WINDOW_TILES, no_data=MOSAIC_NO_DATA):
+    """
+    write the heights of the tiles of a level as one tiled, deflate compressed float32 GeoTIFF.
+    pixels are centered on the grid points of the tiles, neighbor tiles share their edge pixels.
+    only one window of tiles is decoded at a time.
+    :param loc: single, compact or sqlite output of heightmap tiles
+    :param bbox: (min_x, min_y, max_x, max_y) in degrees, None for the whole level
+    :param window_tiles: tiles per side of a window
+    :return: (tiles decoded, tiles missing)
+    """
+    store = TileStore(loc)
+    try:
+        layer_json = json.loads(store.layer_json.decode('utf-8'))
+        if not layer_json.get('format', '').startswith('heightmap'):
+            raise Exception('{0} is {1}, mosaic decodes heightmap tiles only'.format(loc, layer_json.get('format')))
+        tile_range = level_tile_range(layer_json, level, bbox)
+        if tile_range is None:
+            raise Exception('{0} has no tiles at level {1} in the area'.format(loc, level))
+        (min_tx, min_ty, max_tx, max_ty) = tile_range
+        width = (max_tx - min_tx + 1) * 64 + 1
+        height = (max_ty - min_ty + 1) * 64 + 1
+        print('mosaic of {0} x {1} tiles at level {2}: {3} x {4} pixels'.format(
+            max_tx - min_tx + 1, max_ty - min_ty + 1, level, width, height))
+
+        gg = GlobalGeodetic(True, 64)
+        (_, t_min_x, t_max_y, t_max_x) = gg.TileLatLonBounds(min_tx, max_ty, level)
+        res = (t_max_x - t_min_x) / 64
+        driver = gdal.GetDriverByName('GTiff')
+        out_ds = driver.Create(out_tif, width, height, 1, gdalconst.GDT_Float32,
+                               ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER'])
+        out_ds.SetGeoTransform((t_min_x - res / 2, res, 0.0, t_max_y + res / 2, 0.0, -res))
+        sr_84 = osr.SpatialReference()
+        sr_84.ImportFromEPSG(4326)
+        out_ds.SetProjection(sr_84.ExportToWkt())
+        out_band = out_ds.GetRasterBand(1)
+        out_band.SetNoDataValue(no_data)
+
+        start = time.perf_counter()
+        (decoded, missing) = (0, 0)
+        # windows of tile rows north first, so rows of blocks are completed in order
+        for top_ty in range(max_ty, min_ty - 1, -window_tiles):
+            bottom_ty = max(top_ty - window_tiles + 1, min_ty)
+            for left_tx in range(min_tx, max_tx + 1, window_tiles):
+                right_tx = min(left_tx + window_tiles - 1, max_tx)
+                offsets = []
+                payloads = []
+                for tx in range(left_tx, right_tx + 1):
+                    for ty in range(top_ty, bottom_ty - 1, -1):
+                        tile = store.get_tile(level, tx, ty)
+                        if tile is None:
+                            missing += 1
+                            continue
+                        offsets.append(((top_ty - ty) * 64, (tx - left_tx) * 64))
+                        payloads.append(_decompress(tile))
+                window = np.full(((top_ty - bottom_ty + 1) * 64 + 1, (right_tx - left_tx + 1) * 64 + 1), no_data,
+                                 dtype=np.float32)
+                if payloads:
+                    for (row, col), heights in zip(offsets, decode_heightmap_tiles(payloads)):
+                        window[row:row + 65, col:col + 65] = heights
+                decoded += len(payloads)
+                # the shared last row and column are written by the next window, except at the edges
+                rows = window.shape[0] - (1 if bottom_ty > min_ty else 0)
+                cols = window.shape[1] - (1 if right_tx < max_tx else 0)
+                out_band.WriteArray(window[:rows, :cols], (left_tx - min_tx) * 64, (max_ty - top_ty) * 64)
+        out_band.FlushCache()
+        out_band = None
+        out_ds = None
+        seconds = time.perf_counter() - start
+        print('  {0} tiles decoded, {1} missing in {2:.2f} s: {3:.0f} tiles/s'.format(
+            decoded, missing, seconds, decoded / max(seconds, 1e-9)))
+        return decoded, missing
+    finally:
+        store.close()
@@ -8,13 +8,259 @@
 import os
 import sys
 import shutil
+import traceback
+import threading
 from osgeo import gdal
 import multiprocessing
 import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 from .GlobalGeodetic import GlobalGeodetic
-from .TerrainBundle import TerrainBundle
+from .TerrainBundle import TerrainBundle, BundlePlan
+from .TileWriter import TileWriter
+from .TileDatabase import TileDatabase, database_path, layer_metadata
 from .FillRaster import FillRaster
+from .SourceReader import BlockCache, SourceReader
+from .SourceMosaic import SourceMosaic, MAX_OPEN_SOURCES, is_mosaic, list_sources, scan_sources, source_name
+from .MemoryBudget import MemoryBudget, estimate_bundle_memory
+from .BundleJournal import BundleJournal, params_hash
+from .BundleFile import bundle_origin
+from .Metrics import Metrics, STAGES, new_level_stats, print_percent
+
+
+# per-process state of bundle workers, filled by _init_worker
+_worker = {}
+
+
+def _expand_region(region, margin):
+    """
+    grow an update region by margin degrees, tiles next to it resample changed pixels too
+    """
+    (min_x, min_y, max_x, max_y) = region
+    return min_x - margin, min_y - margin, max_x + margin, max_y + margin
+
+
+def _init_worker(context):
+    """
+    open the source dataset in a bundle worker process.
+    GDAL band handles can not be pickled, so every worker opens its own.
+    :param context: dict of picklable scheme settings
+    """
+    if context['source_footprints'] is not None:
+        ds = SourceMosaic(context['source_footprints'], context['max_open_sources'])
+    else:
+        ds = gdal.Open(context['input_tif'])
+    if ds is None:
+        raise Exception('Open input TIFF file failed')
+    band = ds.GetRasterBand(1)
+    bands = {0: band}
+    for x in range(0, band.GetOverviewCount()):
+        bands[x + 1] = band.GetOverview(x)
+
+    _worker.clear()
+    _worker.update(context)
+    _worker['block_cache'] = None
+    if context['source_cache_size'] > 0:
+        _worker['block_cache'] = BlockCache(context['source_cache_size'])
+        bands = dict((index, SourceReader(b, _worker['block_cache'], index)) for index, b in bands.items())
+    _worker['ds'] = ds
+    _worker['bands'] = bands
+    _worker['fill_raster'] = None
+    if context['fill_raster']:
+        _worker['fill_raster'] = FillRaster(context['fill_raster'], context['resampling'])
+    _worker['tile_writer'] = None
+    if context['is_sqlite']:
+        _worker['tile_writer'] = TileDatabase(database_path(context['out_loc']))
+    elif not context['is_compact']:
+        _worker['tile_writer'] = TileWriter(context['out_loc'], context['write_threads'])
+    _worker['mesh_stats'] = {}
+    _worker['stage_times'] = dict.fromkeys(STAGES, 0.0)
+    _worker['level_stats'] = {}
+    _worker['water_raster'] = None
+    if context['water_mask'] not in (None, 'nodata'):
+        _worker['water_raster'] = FillRaster(context['water_mask'], 'nearest')
+    _worker['memory_budget'] = None
+    if context['memory_budget'] is not None:
+        _worker['memory_budget'] = MemoryBudget(context['memory_budget'], context['scratch_dir'])
+    _worker['compress_pool'] = None
+    if context['compress_threads'] > 1:
+        _worker['compress_pool'] = ThreadPoolExecutor(context['compress_threads'])
+
+
+def _take_stats():
+    """
+    :return: dict of source cache hits and misses, mesh stats by level, seconds by stage and bundles, tiles
+        and bytes written by level of the worker since the last task, merged by Metrics.record
+    """
+    (cache_hits, cache_misses) = (0, 0)
+    if _worker['block_cache'] is not None:
+        (cache_hits, cache_misses) = _worker['block_cache'].take_stats()
+    stats = {'cache_hits': cache_hits, 'cache_misses': cache_misses, 'mesh_stats': _worker['mesh_stats'],
+             'stage_times': _worker['stage_times'], 'levels': _worker['level_stats']}
+    _worker['mesh_stats'] = {}
+    _worker['stage_times'] = dict.fromkeys(STAGES, 0.0)
+    _worker['level_stats'] = {}
+    return stats
+
+
+def _record_bundle_stats(bundle):
+    for stage, seconds in bundle.stage_times.items():
+        _worker['stage_times'][stage] += seconds
+    level_stats = _worker['level_stats'].setdefault(bundle.level, new_level_stats())
+    level_stats[0] += 1
+    level_stats[1] += bundle.tiles_written
+    level_stats[2] += bundle.bytes_written
+    if bundle.mesh_stats[0] == 0:
+        return
+    stats = _worker['mesh_stats'].setdefault(bundle.level, [0, 0, 0, 0.0, 0.0])
+    for index, value in enumerate(bundle.mesh_stats):
+        stats[index] += value
+
+
+def _make_bundle(plan):
+    bundle_size = _worker['bundle_sizes'].get(plan.level, _worker['bundle_size'])
+    bundle = TerrainBundle(_worker['bands'][plan.band_index], bundle_size, _worker['is_compact'])
+    bundle.level = plan.level
+    bundle.resolution = plan.resolution
+    bundle.from_tile = plan.from_tile
+    bundle.no_data = _worker['source_no_data']
+    bundle.out_no_data = _worker['out_no_data']
+    bundle.has_next_level = plan.has_next_level
+    bundle.fill_raster = _worker['fill_raster']
+    bundle.resampling = _worker['resampling']
+    bundle.source_range = _worker['source_range']
+    bundle.compression_level = _worker['compression_level']
+    bundle.compress_pool = _worker['compress_pool']
+    bundle.dedup = _worker['dedup']
+    bundle.tile_writer = _worker['tile_writer']
+    bundle.memory_budget = _worker['memory_budget']
+    bundle.water_mask = _worker['water_mask'] is not None
+    bundle.water_raster = _worker['water_raster']
+    if _worker['update_region'] is not None:
+        bundle.update_region = _expand_region(_worker['update_region'], plan.resolution)
+        # bundles of a pyramid output are read as in pyramid mode
+        bundle.full_extent = _worker['pyramid']
+    return bundle
+
+
+def _write_bundle(task):
+    """
+    generate and write one bundle in a worker process
+    :param task: BundlePlan
+    :return: (task, error message or None, number of bundles written, source cache stats)
+    """
+    try:
+        bundle = _make_bundle(task)
+        bundle.write_tiles(_worker['out_loc'], _worker['decode_type'], _worker['mesh_errors'][task.level])
+        _record_bundle_stats(bundle)
+        del bundle
+    except Exception:
+        return task, traceback.format_exc(), 0, _take_stats()
+    return task, None, 1, _take_stats()
+
+
+def _spill_path(level, from_tile):
+    return os.path.join(_worker['spill_dir'], '{0}_{1}_{2}.npy'.format(level, from_tile[0], from_tile[1]))
+
+
+def _save_spill(level, from_tile, array):
+    spill_path = _spill_path(level, from_tile)
+    with open(spill_path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(spill_path + '.tmp', spill_path)
+
+
+def _pyramid_children(plan):
+    """
+    plans of the (up to) four bundles one level down that cover the bundle of plan.
+    bundles of pyramid mode are aligned to multiples of bundle size, so each
+    child bundle is one quadrant of its parent.
+    :return: list of ((quadrant x, quadrant y), BundlePlan)
+    """
+    size = _worker['bundle_size']
+    level = plan.level + 1
+    (left_tx, top_ty, right_tx, bottom_ty) = _worker['level_ranges'][level]
+    (from_x, from_y) = plan.from_tile
+    children = []
+    for q_y, child_y in enumerate((from_y * 2 + 1, from_y * 2 + 1 - size)):
+        for q_x, child_x in enumerate((from_x * 2, from_x * 2 + size)):
+            if child_x > right_tx or child_x + size - 1 < left_tx:
+                continue
+            if child_y < bottom_ty or child_y - size + 1 > top_ty:
+                continue
+            child = BundlePlan(level, (child_x, child_y), _worker['level_resolutions'][level],
+                               level < _worker['max_level'], 0)
+            children.append(((q_x, q_y), child))
+    return children
+
+
+def _write_pyramid_bundle(plan, quarters):
+    """
+    write a bundle of pyramid mode and return its array downsampled for the parent level.
+    :param quarters: downsampled child arrays by quadrant, None to read from source
+    """
+    bundle = _make_bundle(plan)
+    bundle.full_extent = True
+    if quarters is not None:
+        merge = bundle.timed('resample', TerrainBundle.merge_quarters)
+        bundle.bundle_array = merge(quarters, bundle.bundle_size, bundle.fill_value, bundle.memory_budget)
+    bundle.write_tiles(_worker['out_loc'], _worker['decode_type'], _worker['mesh_errors'][plan.level])
+    half_array = bundle.timed('resample', bundle.half_array)()
+    _record_bundle_stats(bundle)
+    del bundle
+    return half_array
+
+
+def _write_pyramid_subtree(plan):
+    """
+    depth first, write the bundle of plan and all bundles below it
+    :return: (downsampled array of the bundle, number of bundles written)
+    """
+    if plan.level >= _worker['max_level']:
+        return _write_pyramid_bundle(plan, None), 1
+    quarters = {}
+    written = 0
+    for quadrant, child in _pyramid_children(plan):
+        quarters[quadrant], child_written = _write_pyramid_subtree(child)
+        written += child_written
+    return _write_pyramid_bundle(plan, quarters), written + 1
+
+
+def _write_subtree(task):
+    """
+    pyramid mode: write the subtree below a bundle of the split level and
+    spill the downsampled root array for the level above
+    """
+    written = 0
+    try:
+        half_array, written = _write_pyramid_subtree(task)
+        if task.level > 4:
+            _save_spill(task.level, task.from_tile, half_array)
+    except Exception:
+        return task, traceback.format_exc(), written, _take_stats()
+    return task, None, written, _take_stats()
+
+
+def _write_from_spill(task):
+    """
+    pyramid mode: write a bundle above the split level from the spilled arrays of its children.
+    spills are removed by the parent process once the whole level is written.
+    """
+    try:
+        quarters = {}
+        for quadrant, child in _pyramid_children(task):
+            child_path = _spill_path(child.level, child.from_tile)
+            # a failed child leaves no spill, the bundle fails too and is rebuilt on resume
+            if not os.path.exists(child_path):
+                raise Exception('child bundle {0} at level {1} is missing'.format(child.from_tile, child.level))
+            quarters[quadrant] = np.load(child_path)
+        half_array = _write_pyramid_bundle(task, quarters)
+        if task.level > 4:
+            _save_spill(task.level, task.from_tile, half_array)
+    except Exception:
+        return task, traceback.format_exc(), 0, _take_stats()
+    return task, None, 1, _take_stats()
 
 
 class TileScheme(object):
@@ -22,21 +268,69 @@ class TileScheme(object):
     def __init__(self, input_tif, is_storage_compact):
         """
         create tiling scheme
-        :param input_tif: input GeoTiff file
+        :param input_tif: input GeoTiff file, or a directory or list of rasters read as their mosaic
         """
 
-        self.bundles = []
-        self.__ds = gdal.Open(input_tif)
+        self.input_tif = input_tif
+        # footprints of the rasters of a mosaic input, None for one GeoTiff file
+        self.source_footprints = None
+        # mosaic input: datasets kept open by each worker
+        self.max_open_sources = MAX_OPEN_SOURCES
+        if is_mosaic(input_tif):
+            self.source_footprints = scan_sources(list_sources(input_tif))
+            self.__ds = SourceMosaic(self.source_footprints)
+        else:
+            self.__ds = gdal.Open(input_tif)
         if self.__ds is None:
             raise Exception('Open input TIFF file failed')
 
         # one bundle has 32*32 tiles
         self.bundle_size = 32
+        # memory limit mode: smaller bundles at levels whose bundles would not fit, level -> bundle size
+        self.__bundle_sizes = {}
 
         # bundle mode
         # explode: save each tile as single .terrain file
         # compact: save all tiles in one bundle as .bundle file
         self.is_compact = is_storage_compact
+        # sqlite: save all tiles in one SQLite database in the output directory, instead of either
+        self.is_sqlite = False
+
+        # gzip level of tiles, and threads compressing tiles of a bundle in each worker
+        self.compression_level = 9
+        self.compress_threads = 1
+        # single mode: threads writing tile files in each worker while tiles are encoded, 0 writes inline
+        self.write_threads = 1
+        # store identical tiles only once
+        self.dedup = False
+        # bytes of source blocks cached by each worker, 0 reads windows straight from the source
+        self.source_cache_size = 256 * 1024 * 1024
+        # kernel resampling source windows to bundle arrays: nearest, bilinear or average
+        self.resampling = 'nearest'
+        # bytes of memory shared by all workers, None for no limit.
+        # arrays beyond the share of a worker are memory mapped to files in scratch_dir
+        self.memory_limit = None
+        self.scratch_dir = None
+        # water mask extension of mesh tiles: None, 'nodata' for water where the source
+        # has no data, or a raster which is not 0 on water
+        self.water_mask = None
+        # mesh error schedule: max_error is scaled by (level resolution / max level resolution) ** error_curve,
+        # 0 keeps max_error at every level, 1 makes it proportional to the ground sample distance
+        self.error_curve = 0.0
+        # callables (metrics, final) notified after each task of make_bundles, None prints the percentage
+        self.metrics_listeners = None
+        # Metrics of the last make_bundles run
+        self.metrics = None
+
+        # pyramid mode: only the max level is read from source, every other
+        # level is downsampled from its child bundles
+        self.pyramid = False
+
+        # update mode: (min_x, min_y, max_x, max_y) of the changed area, only bundles and
+        # tiles intersecting it are written, into an existing output
+        self.update_region = None
+        # bundle.json of the output being updated, bundle origins follow it
+        self.__bundle_info = None
 
         self.__tile_source_bands = {}
         # data extent
@@ -51,12 +345,15 @@ class TileScheme(object):
 
         # TMS levels
         self.__levels = {}
+        # tile range of each level: (left_tx, top_ty, right_tx, bottom_ty)
+        self.__level_ranges = {}
 
         self.__avaliables = {}
 
         self.__get_tif_info()
         self.__compute_levels()
         self.fill_raster = None
+        self.fill_raster_loc = None
 
     def __get_tif_info(self):
         cols = self.__ds.RasterXSize
@@ -88,11 +385,11 @@ class TileScheme(object):
             self.__levels[next_level] = next_res
         self.__max_level = next_level
 
-    def __find_source_band(self, in_res):
+    def __find_source_band_index(self, in_res):
         find_band_index = 0
         while find_band_index + 1 in self.__resolutions and self.__resolutions[find_band_index] < in_res:
             find_band_index += 1
-        return self.__source_bands[find_band_index]
+        return find_band_index
 
     def __write_bundle_info(self, loc):
         with open(os.path.join(loc, 'bundle.json'), 'w') as f:
@@ -105,8 +402,12 @@ class TileScheme(object):
             info = {
                 'width': 128,
                 'height': 128,
-                'extent': extent
+                'extent': extent,
+                'bundle_size': self.bundle_size,
+                'aligned': self.pyramid
             }
+            if self.__bundle_sizes:
+                info['bundle_sizes'] = dict((str(level), size) for level, size in sorted(self.__bundle_sizes.items()))
             json.dump(info, f)
 
     def __gen_avaliables(self):
@@ -133,12 +434,51 @@ class TileScheme(object):
             layer_json["format"] = "heightmap-1.0"
         else:
             layer_json["format"] = "quantized-mesh-1.0"
-            layer_json["extensions"] = ["watermask", "octvertexnormals"]
-
+            layer_json["extensions"] = ["octvertexnormals"]
+            if self.water_mask is not None:
+                layer_json["extensions"].insert(0, "watermask")
+
+        if self.is_sqlite:
+            with TileDatabase(database_path(loc)) as db:
+                previous = db.get_metadata('json')
+                if self.update_region is not None and previous is not None:
+                    self.merge_layer_json(layer_json, json.loads(previous))
+                db.set_metadata(layer_metadata(source_name(self.input_tif), layer_json))
+            return
+
+        layer_path = os.path.join(loc, 'layer.json')
+        if self.update_region is not None and os.path.exists(layer_path):
+            with open(layer_path) as f:
+                self.merge_layer_json(layer_json, json.load(f))
         self.write_layer_json(loc, layer_json)
 
+    @staticmethod
+    def merge_layer_json(layer_json, previous):
+        """
+        add the bounds and tile availability of a previous layer.json to layer_json
+        """
+        def contains(outer, inner):
+            return (outer['startX'] <= inner['startX'] and outer['endX'] >= inner['endX'] and
+                    outer['startY'] <= inner['startY'] and outer['endY'] >= inner['endY'])
+
+        bounds = previous.get('bounds', layer_json['bounds'])
+        layer_json['bounds'] = [min(bounds[0], layer_json['bounds'][0]), min(bounds[1], layer_json['bounds'][1]),
+                                max(bounds[2], layer_json['bounds'][2]), max(bounds[3], layer_json['bounds'][3])]
+        old_available = previous.get('available', [])
+        new_available = layer_json['available']
+        available = []
+        for level in range(max(len(old_available), len(new_available))):
+            ranges = list(old_available[level]) if level < len(old_available) else []
+            for new_range in (new_available[level] if level < len(new_available) else []):
+                if not any(contains(old_range, new_range) for old_range in ranges):
+                    ranges = [r for r in ranges if not contains(new_range, r)] + [new_range]
+            available.append(ranges)
+        layer_json['available'] = available
+        layer_json['maxzoom'] = max(layer_json['maxzoom'], previous.get('maxzoom', 0))
+
     def set_fill_raster(self, raster_loc):
-        self.fill_raster = FillRaster(raster_loc)
+        self.fill_raster = FillRaster(raster_loc, self.resampling)
+        self.fill_raster_loc = raster_loc
 
     @staticmethod
     def write_layer_json(loc, layer_json):
@@ -146,38 +486,204 @@ class TileScheme(object):
             f.write(json.dumps(layer_json, indent=4))
 
     def generate_scheme(self):
+        """
+        compute the tile range of every level.
+        bundles are planned lazily by iter_bundles when make_bundles consumes them.
+        """
+        gg = GlobalGeodetic(True, 64)
+        self.__level_ranges = {}
+        for level in self.__levels.keys():
+            left_tx, top_ty = gg.LonLatToTile(self.__minx, self.__maxy, level)
+            right_tx, bottom_ty = gg.LonLatToTile(self.__maxx, self.__miny, level)
+            self.__avaliables[level] = [{"startX": left_tx, "endX": right_tx, "startY": bottom_ty, "endY": top_ty}]
+            self.__level_ranges[level] = (left_tx, top_ty, right_tx, bottom_ty)
+
+    def __bundle_range(self, level):
+        """
+        first bundle origin and last tile of a level: (left_tx, top_ty, right_tx, bottom_ty).
+        pyramid mode aligns bundle origins to multiples of bundle size, so that
+        every bundle is a quadrant of a bundle one level up.
+        """
+        (left_tx, top_ty, right_tx, bottom_ty) = self.__level_ranges[level]
+        if self.__bundle_info is not None:
+            left_tx, top_ty = bundle_origin(self.__bundle_info, level, left_tx, top_ty)
+        elif self.pyramid:
+            left_tx = left_tx // self.bundle_size * self.bundle_size
+            top_ty = top_ty // self.bundle_size * self.bundle_size + self.bundle_size - 1
+        return left_tx, top_ty, right_tx, bottom_ty
+
+    def level_bundle_size(self, level):
+        return self.__bundle_sizes.get(level, self.bundle_size)
+
+    def level_max_error(self, level, mesh_max_error):
+        """
+        :return: triangulation error of mesh tiles of a level, mesh_max_error at the max level
+        """
+        return mesh_max_error * (self.__levels[level] / self.__levels[self.__max_level]) ** self.error_curve
+
+    def __plan_bundle_sizes(self, thread_count):
+        """
+        memory limit mode: the largest bundle size of each level whose bundles fit the
+        share of a worker. pyramid mode merges child bundles into their parent, so
+        all levels take the smallest size.
+        """
+        self.__bundle_sizes = {}
+        if self.memory_limit is None:
+            return
+        share = self.memory_limit // max(thread_count, 1)
+        # the source cache takes at most a quarter of the share
+        self.source_cache_size = min(self.source_cache_size, share // 4)
+        share -= self.source_cache_size
+        source_itemsize = gdal.GetDataTypeSize(self.__source_bands[0].DataType) // 8
+        if self.fill_raster is not None:
+            # the fill window is float32 at about the bundle resolution
+            source_itemsize += 4
+
+        for level, res in self.__levels.items():
+            if level < 4:
+                continue
+            band_index = self.__find_source_band_index(res)
+            source_ratio = res / self.__resolutions[band_index]
+            source_pixels = self.__source_bands[band_index].XSize * self.__source_bands[band_index].YSize
+            size = self.bundle_size
+            while size > 1 and estimate_bundle_memory(size, source_ratio, source_itemsize, source_pixels) > share:
+                size //= 2
+            if size != self.bundle_size:
+                self.__bundle_sizes[level] = size
+
+        if self.pyramid and self.__bundle_sizes:
+            self.bundle_size = min(self.__bundle_sizes.values())
+            self.__bundle_sizes = {}
+
+    def count_bundles_by_level(self, level):
+        if self.update_region is not None:
+            return sum(1 for _ in self.iter_bundles_by_level(level, False))
+        (left_tx, top_ty, right_tx, bottom_ty) = self.__bundle_range(level)
+        bundle_size = self.level_bundle_size(level)
+        cols = (right_tx - left_tx) // bundle_size + 1
+        rows = (top_ty - bottom_ty) // bundle_size + 1
+        return cols * rows
+
+    def count_bundles(self):
+        return sum(self.count_bundles_by_level(level) for level in self.__level_ranges.keys())
+
+    def iter_bundles(self):
+        """
+        yield bundle plans of all levels, from the max level to level 0
+        """
         has_child = False
         for level in sorted(self.__levels.keys(), reverse=True):
-            self.generate_bundles_by_level(level, has_child)
+            for plan in self.iter_bundles_by_level(level, has_child):
+                yield plan
             has_child = True
 
-    def generate_bundles_by_level(self, level, has_child):
+    def iter_bundles_by_level(self, level, has_child):
         res = self.__levels[level]
+        (left_tx, top_ty, right_tx, bottom_ty) = self.__bundle_range(level)
+        band_index = self.__find_source_band_index(res)
+        update_range = self.__update_tile_range(level)
+        bundle_size = self.level_bundle_size(level)
+        for from_x in range(left_tx, right_tx + 1, bundle_size):
+            for from_y in range(top_ty, bottom_ty - 1, -bundle_size):
+                if update_range is not None:
+                    (u_left_tx, u_top_ty, u_right_tx, u_bottom_ty) = update_range
+                    if from_x > u_right_tx or from_x + bundle_size - 1 < u_left_tx:
+                        continue
+                    if from_y < u_bottom_ty or from_y - bundle_size + 1 > u_top_ty:
+                        continue
+                yield BundlePlan(level, (from_x, from_y), res, has_child, band_index)
+
+    def __update_tile_range(self, level):
+        """
+        tiles of a level touched by the update region: (left_tx, top_ty, right_tx, bottom_ty),
+        None outside update mode
+        """
+        if self.update_region is None:
+            return None
         gg = GlobalGeodetic(True, 64)
-        left_tx, top_ty = gg.LonLatToTile(self.__minx, self.__maxy, level)
-        right_tx, bottom_ty = gg.LonLatToTile(self.__maxx, self.__miny, level)
-        self.__avaliables[level] = [{"startX": left_tx, "endX": right_tx, "startY": bottom_ty, "endY": top_ty}]
-        source_band = self.__find_source_band(res)
-        top_ty1 = top_ty
-        while left_tx <= right_tx:
-            while top_ty >= bottom_ty:
-                g_bundle = TerrainBundle(source_band, self.bundle_size, self.is_compact)
-                g_bundle.level = level
-                g_bundle.resolution = res
-                g_bundle.from_tile = (left_tx, top_ty)
-                g_bundle.no_data = self.source_no_data
-                g_bundle.out_no_data = self.out_no_data
-                g_bundle.has_next_level = has_child
-                g_bundle.fill_raster = self.fill_raster
-                g_bundle.data_band = source_band
-                g_bundle.source_range = (self.__minx, self.__miny, self.__maxx, self.__maxy)
-                self.bundles.append(g_bundle)
-                top_ty -= self.bundle_size
-            top_ty = top_ty1
-            left_tx += self.bundle_size
+        (min_x, min_y, max_x, max_y) = _expand_region(self.update_region, self.__levels[level])
+        left_tx, top_ty = gg.LonLatToTile(max(min_x, -180.0), min(max_y, 90.0), level)
+        right_tx, bottom_ty = gg.LonLatToTile(min(max_x, 180.0), max(min_y, -90.0), level)
+        return left_tx, top_ty, right_tx, bottom_ty
+
+    def diff_region(self, previous_tif):
+        """
+        extent of the pixels which differ between the input and a previous version of it
+        :param previous_tif: raster with the size and geotransform of the input
+        :return: (min_x, min_y, max_x, max_y), None if nothing changed
+        """
+        if self.source_footprints is not None:
+            raise Exception('the changed area of a mosaic input can not be computed, update it by area instead')
+        previous_ds = gdal.Open(previous_tif)
+        if previous_ds is None:
+            raise Exception('Open previous TIFF file failed')
+        if (previous_ds.RasterXSize, previous_ds.RasterYSize) != (self.__ds.RasterXSize, self.__ds.RasterYSize) or \
+                previous_ds.GetGeoTransform() != self.__ds.GetGeoTransform():
+            raise Exception('previous TIFF file must have the size and geotransform of the input')
+
+        band = self.__ds.GetRasterBand(1)
+        previous_band = previous_ds.GetRasterBand(1)
+        cols = self.__ds.RasterXSize
+        rows = self.__ds.RasterYSize
+        # strips of whole blocks, about 16M pixels each
+        block_rows = band.GetBlockSize()[1]
+        strip_rows = max(block_rows, (16 * 1024 * 1024 // cols) // block_rows * block_rows)
+        changed_rows = []
+        changed_cols = np.zeros(cols, dtype=bool)
+        for row in range(0, rows, strip_rows):
+            height = min(strip_rows, rows - row)
+            new_array = band.ReadAsArray(0, row, cols, height)
+            old_array = previous_band.ReadAsArray(0, row, cols, height)
+            changed = new_array != old_array
+            if np.issubdtype(new_array.dtype, np.floating):
+                changed &= ~(np.isnan(new_array) & np.isnan(old_array))
+            changed_in_row = changed.any(axis=1)
+            if changed_in_row.any():
+                changed_rows.extend(row + np.flatnonzero(changed_in_row)[[0, -1]])
+                changed_cols |= changed.any(axis=0)
+        del previous_ds
+        if not changed_rows:
+            return None
+
+        trans = self.__ds.GetGeoTransform()
+        (first_col, last_col) = np.flatnonzero(changed_cols)[[0, -1]]
+        (first_row, last_row) = min(changed_rows), max(changed_rows)
+        return (trans[0] + first_col * trans[1], trans[3] - (last_row + 1) * trans[1],
+                trans[0] + (last_col + 1) * trans[1], trans[3] - first_row * trans[1])
+
+    def __pyramid_split_level(self, thread_count):
+        """
+        the lowest level with enough bundles to keep all workers busy.
+        each worker writes whole subtrees below this level depth first,
+        levels above it are built from spilled arrays.
+        """
+        for level in range(4, self.__max_level):
+            if self.count_bundles_by_level(level) >= thread_count * 4:
+                return level
+        return self.__max_level
+
+    def __phases(self, thread_count):
+        """
+        groups of (task function, plans, level) to run in order, each group finishes
+        before the next one starts. level is None for a group of all levels.
+        """
+        # update mode reads every level from source, untouched child bundles have no arrays to merge
+        if not self.pyramid or self.__max_level < 4 or self.update_region is not None:
+            return [(_write_bundle, self.iter_bundles(), None)]
+
+        split_level = self.__pyramid_split_level(thread_count)
+        phases = [(_write_subtree, self.iter_bundles_by_level(split_level, split_level < self.__max_level), split_level)]
+        for level in range(split_level - 1, 3, -1):
+            phases.append((_write_from_spill, self.iter_bundles_by_level(level, True), level))
+        for level in range(3, -1, -1):
+            phases.append((_write_bundle, self.iter_bundles_by_level(level, True), level))
+        return phases
 
     @staticmethod
-    def fill_zero_level(out_loc, decode_type):
+    def fill_zero_level(out_loc, decode_type, is_sqlite=False):
+        if is_sqlite:
+            TileScheme.__fill_zero_level_database(out_loc, decode_type)
+            return
         base_path = os.path.join(out_loc, '0')
         first_path = os.path.join(base_path, '0')
         second_path = os.path.join(base_path, '1')
@@ -200,22 +706,236 @@ class TileScheme(object):
                 os.mkdir(second_path)
             shutil.copyfile(temp_1, second_t)
 
-    def make_bundles(self, out_loc, decode_type='heightmap', mesh_max_error=0.01, thread_count=multiprocessing.cpu_count()):
+    @staticmethod
+    def __fill_zero_level_database(out_loc, decode_type):
+        module_dir = os.path.abspath(os.path.join(__file__, '..'))
+        templates = ('mesh000.terrain', 'mesh010.terrain')
+        if decode_type == 'heightmap':
+            templates = ('blank_heightmap.terrain', 'blank_heightmap.terrain')
+        with TileDatabase(database_path(out_loc)) as db:
+            for x, template in enumerate(templates):
+                if not db.has_tile(0, x, 0):
+                    with open(os.path.join(module_dir, 'data', template), 'rb') as f:
+                        db.put(0, x, 0, f.read())
+            db.flush()
+
+    def __worker_context(self, out_loc, decode_type, mesh_max_error):
+        return {
+            'input_tif': self.input_tif,
+            'source_footprints': self.source_footprints,
+            'max_open_sources': self.max_open_sources,
+            'fill_raster': self.fill_raster_loc,
+            'bundle_size': self.bundle_size,
+            'bundle_sizes': dict(self.__bundle_sizes),
+            'is_compact': self.is_compact,
+            'is_sqlite': self.is_sqlite,
+            'source_no_data': self.source_no_data,
+            'out_no_data': self.out_no_data,
+            'source_range': (self.__minx, self.__miny, self.__maxx, self.__maxy),
+            'out_loc': out_loc,
+            'decode_type': decode_type,
+            'mesh_max_error': mesh_max_error,
+            'mesh_errors': dict((level, self.level_max_error(level, mesh_max_error)) for level in self.__levels),
+            'max_level': self.__max_level,
+            'level_ranges': dict(self.__level_ranges),
+            'level_resolutions': dict(self.__levels),
+            'spill_dir': None,
+            'compression_level': self.compression_level,
+            'compress_threads': self.compress_threads,
+            'write_threads': self.write_threads,
+            'dedup': self.dedup,
+            'source_cache_size': self.source_cache_size,
+            'resampling': self.resampling,
+            'memory_budget': None,
+            'scratch_dir': self.scratch_dir,
+            'water_mask': self.water_mask,
+            'update_region': self.update_region,
+            'pyramid': self.pyramid
+        }
+
+    def __params_hash(self, context):
+        """
+        digest of everything that changes the content of a bundle
+        """
+        params = dict((key, context[key]) for key in (
+            'fill_raster', 'bundle_size', 'bundle_sizes', 'is_compact', 'is_sqlite', 'source_no_data', 'out_no_data', 'decode_type',
+            'mesh_max_error', 'compression_level', 'dedup', 'update_region', 'resampling', 'water_mask'))
+        params['pyramid'] = self.pyramid
+        params['error_curve'] = self.error_curve
+        for key in ('input_tif', 'fill_raster', 'water_mask'):
+            if context[key] not in (None, 'nodata') and not is_mosaic(context[key]):
+                stat = os.stat(context[key])
+                params[key] = (os.path.abspath(context[key]), stat.st_size, stat.st_mtime)
+        if context['source_footprints'] is not None:
+            params['input_tif'] = [(os.path.abspath(f.path), os.stat(f.path).st_size, os.stat(f.path).st_mtime)
+                                   for f in context['source_footprints']]
+        return params_hash(params)
+
+    def make_bundles(self, out_loc, decode_type='heightmap', mesh_max_error=0.01, thread_count=multiprocessing.cpu_count(),
+                     resume=False):
+        """
+        generate and write all bundles of the scheme
+        :param out_loc: output directory
+        :param decode_type: heightmap or mesh
+        :param mesh_max_error: maximum triangulation error of mesh terrains
+        :param thread_count: number of worker processes, 1 runs in the current process
+        :param resume: skip bundles the journal of a previous run records as complete
+        :return: list of (task, error message) of failed bundles
+        """
+        self.__bundle_info = None
+        bundle_json = os.path.join(out_loc, 'bundle.json')
+        if self.is_compact and self.update_region is not None and os.path.exists(bundle_json):
+            # updated bundles keep the origins of the output
+            with open(bundle_json) as f:
+                self.__bundle_info = json.load(f)
+            self.bundle_size = self.__bundle_info.get('bundle_size', 32)
+            self.pyramid = self.__bundle_info.get('aligned', False)
+            self.__bundle_sizes = dict((int(level), size) for level, size in
+                                       self.__bundle_info.get('bundle_sizes', {}).items())
+        else:
+            self.__plan_bundle_sizes(thread_count)
+        if self.__bundle_sizes or self.memory_limit is not None:
+            print('  bundle sizes by level: {0}'.format(', '.join(
+                '{0}: {1}'.format(level, self.level_bundle_size(level)) for level in sorted(self.__levels))))
+
+        if self.is_sqlite:
+            TileDatabase(database_path(out_loc), create=True, dedup=self.dedup).close()
         self.__write_config(out_loc, decode_type)
-        if self.is_compact:
+        if self.is_compact and self.__bundle_info is None:
             self.__write_bundle_info(out_loc)
 
         print('Start generating tiles...')
-        total = len(self.bundles)
-        while len(self.bundles) > 0:
-            bundle = self.bundles.pop(0)
-            bundle.write_tiles(out_loc, decode_type, mesh_max_error)
-            del bundle
-            sys.stdout.flush()
-            remains = len(self.bundles) + 0.0
-            print('  {0:.0f}/{1} ({2:.0f}%)'.format(total - remains, total, (1.0 - remains/total)*100), end='\r')
-
-        self.fill_zero_level(out_loc, decode_type)
-
+        if not self.__level_ranges:
+            self.generate_scheme()
+        metrics = Metrics(dict((level, self.count_bundles_by_level(level)) for level in self.__level_ranges))
+        for listener in (self.metrics_listeners if self.metrics_listeners is not None else [print_percent]):
+            metrics.add_listener(listener)
+        self.metrics = metrics
+        context = self.__worker_context(out_loc, decode_type, mesh_max_error)
+        if self.memory_limit is not None:
+            context['memory_budget'] = self.memory_limit // max(thread_count, 1) - self.source_cache_size
+
+        journal = BundleJournal(out_loc, self.__params_hash(context), resume)
+        if resume:
+            print('  {0} bundle tasks are complete already'.format(len(journal)))
+
+        pool = None
+        if self.pyramid and self.update_region is None:
+            # kept between runs, a resumed run needs the arrays of completed bundles
+            context['spill_dir'] = os.path.join(out_loc, '.pyramid_spill')
+            if not resume:
+                shutil.rmtree(context['spill_dir'], ignore_errors=True)
+            os.makedirs(context['spill_dir'], exist_ok=True)
+
+        if thread_count > 1:
+            pool = multiprocessing.Pool(thread_count, initializer=_init_worker, initargs=(context,))
+        else:
+            _init_worker(context)
+
+        progress = {'failures': [], 'metrics': metrics}
+        metrics.start_ticker()
+        try:
+            for func, plans, level in self.__phases(thread_count):
+                failure_count = len(progress['failures'])
+                self.__run_phase(pool, func, plans, thread_count, progress, journal)
+                if func is _write_from_spill and len(progress['failures']) == failure_count:
+                    # every bundle of the level is written, the spills below it are not needed anymore
+                    self.__remove_spills(context['spill_dir'], level + 1)
+        except BaseException:
+            if pool is not None:
+                pool.terminate()
+                pool = None
+            raise
+        finally:
+            metrics.stop_ticker()
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if _worker.get('compress_pool') is not None:
+                _worker['compress_pool'].shutdown()
+            if _worker.get('tile_writer') is not None:
+                _worker['tile_writer'].close()
+            _worker.clear()
+            journal.close()
+
+        if context['spill_dir'] is not None and not progress['failures']:
+            shutil.rmtree(context['spill_dir'], ignore_errors=True)
+
+        metrics.notify(final=True)
+        if metrics.cache_misses > 0:
+            print('\r\n  source cache: {0} chunks read, {1} reads served from cache'.format(
+                metrics.cache_misses, metrics.cache_hits))
+        if metrics.mesh_stats:
+            self.__print_mesh_stats(metrics.mesh_stats, context['mesh_errors'])
+        print('\r\n  seconds by stage: {0}'.format(', '.join(
+            '{0} {1:.2f}'.format(stage, metrics.stage_times[stage]) for stage in STAGES)))
+
+        failures = progress['failures']
+        for task, error in failures:
+            print('\r\n  bundle {0} at level {1} failed:'.format(task[1], task[0]))
+            print(error)
+
+        self.fill_zero_level(out_loc, decode_type, self.is_sqlite)
+        if self.is_sqlite:
+            with TileDatabase(database_path(out_loc)) as db:
+                # tiles replaced by this run may leave their data unreferenced
+                db.remove_orphans()
+        return failures
 
+    @staticmethod
+    def __remove_spills(spill_dir, level):
+        prefix = '{0}_'.format(level)
+        for name in os.listdir(spill_dir):
+            if name.startswith(prefix):
+                os.remove(os.path.join(spill_dir, name))
 
+    @staticmethod
+    def __print_mesh_stats(mesh_stats, mesh_errors):
+        print('\r\n  mesh tiles by level:')
+        print('  {0:>5} {1:>10} {2:>8} {3:>14} {4:>13} {5:>14}'.format(
+            'level', 'max_error', 'tiles', 'triangles/tile', 'vertices/tile', 'ms/tile (tin)'))
+        for level in sorted(mesh_stats):
+            (tiles, triangles, vertices, triangulate_time, encode_time) = mesh_stats[level]
+            print('  {0:>5} {1:>10.4g} {2:>8} {3:>14.1f} {4:>13.1f} {5:>7.2f} ({6:.2f})'.format(
+                level, mesh_errors[level], tiles, triangles / tiles, vertices / tiles,
+                (triangulate_time + encode_time) * 1000 / tiles, triangulate_time * 1000 / tiles))
+
+    def __run_phase(self, pool, func, plans, thread_count, progress, journal):
+        # consecutive bundles of a column go to the same worker and share source blocks,
+        # subtrees are large enough to be handed out one by one
+        chunk_size = 4 if func is _write_bundle else 1
+        # bound the plans handed to the pool, the pool would drain the generator otherwise
+        slots = threading.Semaphore(max(thread_count, 1) * 4 * chunk_size)
+        stopped = threading.Event()
+        metrics = progress['metrics']
+
+        def throttled_plans():
+            for plan in plans:
+                if journal.is_done(plan.level, plan.from_tile):
+                    # only this feeder thread writes the skipped counts and level start times
+                    metrics.skip(plan.level, journal.done_bundles(plan.level, plan.from_tile))
+                    continue
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                metrics.start_level(plan.level)
+                yield plan
+
+        if pool is not None:
+            results = pool.imap_unordered(func, throttled_plans(), chunk_size)
+        else:
+            results = (func(plan) for plan in throttled_plans())
+
+        try:
+            for task, error, written, stats in results:
+                slots.release()
+                if error is not None:
+                    progress['failures'].append((task, error))
+                else:
+                    journal.record(task.level, task.from_tile, written)
+                metrics.record(written, stats, error is not None)
+        except BaseException:
+            # wake up the plan feeder so the pool can be torn down
+            stopped.set()
+            slots.release()
+            raise
@@ -0,0 +1,260 @@
+#
+# TileServer
+# serve layer.json and {z}/{x}/{y}.terrain of single, compact and sqlite outputs over HTTP
+#
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .BundleFile import BundleReader, bundle_origin, bundle_file_name
+from .TileDatabase import TileDatabase, database_path, is_database
+
+TILE_PATTERN = re.compile(r'/(\d+)/(\d+)/(\d+)\.terrain$')
+GZIP_MAGIC = b'\x1f\x8b'
+# threads reading tiles of single and sqlite outputs, off the event loop
+READ_THREADS = 8
+
+
+def accepts_gzip(accept_encoding):
+    """
+    :param accept_encoding: value of the Accept-Encoding header
+    :return: True if gzip, or any coding when gzip is not listed, has a q-value above 0
+    """
+    q_values = {}
+    for token in accept_encoding.split(','):
+        params = token.split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            (name, _, value) = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        q_values[coding] = q
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in q_values:
+            return q_values[coding] > 0
+    return False
+
+
+class TileStore(object):
+
+    def __init__(self, root, max_open_bundles=256):
+        """
+        read tiles of a terrain output directory
+        :param root: output directory of terrainmaker, or a tile database
+        :param max_open_bundles: number of memory mapped bundle files kept open
+        """
+        self.root = root
+        self.max_open_bundles = max_open_bundles
+        self.__bundles = OrderedDict()
+        self.bundle_info = None
+        bundle_json = os.path.join(root, 'bundle.json')
+        if os.path.exists(bundle_json):
+            with open(bundle_json) as f:
+                self.bundle_info = json.load(f)
+
+        self.database = None
+        # sqlite connections are not shared between threads, each reading thread opens its own
+        self.__local = threading.local()
+        self.__databases = []
+        self.__databases_lock = threading.Lock()
+        if is_database(database_path(root)):
+            self.database = self.__thread_database()
+            self.layer_json = self.database.get_metadata('json').encode('utf-8')
+        else:
+            with open(os.path.join(root, 'layer.json'), 'rb') as f:
+                self.layer_json = f.read()
+        self.content_type = 'application/octet-stream'
+        if json.loads(self.layer_json.decode('utf-8')).get('format', '').startswith('quantized-mesh'):
+            self.content_type = 'application/vnd.quantized-mesh'
+        # tiles of single and sqlite outputs are read by blocking file reads and queries,
+        # bundles are memory mapped
+        self.blocking_reads = self.database is not None or self.bundle_info is None
+
+    def __thread_database(self):
+        """
+        :return: readonly TileDatabase of the calling thread
+        """
+        database = getattr(self.__local, 'database', None)
+        if database is None:
+            database = TileDatabase(database_path(self.root), readonly=True)
+            self.__local.database = database
+            with self.__databases_lock:
+                self.__databases.append(database)
+        return database
+
+    def __open_bundle(self, path):
+        reader = self.__bundles.get(path)
+        if reader is not None:
+            self.__bundles.move_to_end(path)
+            return reader
+        if not os.path.exists(path):
+            return None
+        reader = BundleReader(path, use_mmap=True)
+        self.__bundles[path] = reader
+        if len(self.__bundles) > self.max_open_bundles:
+            _, evicted = self.__bundles.popitem(last=False)
+            evicted.close()
+        return reader
+
+    def get_tile(self, z, x, y):
+        """
+        :return: stored tile bytes, None if the tile does not exist
+        """
+        if self.database is not None:
+            return self.__thread_database().get_tile(z, x, y)
+
+        if self.bundle_info is not None:
+            from_tile = bundle_origin(self.bundle_info, z, x, y)
+            reader = self.__open_bundle(os.path.join(self.root, str(z), bundle_file_name(from_tile)))
+            if reader is not None:
+                tile = reader.get_tile(x, y)
+                if tile is not None:
+                    return tile
+
+        # single mode, and the level 0 tiles of compact mode
+        tile_path = os.path.join(self.root, str(z), str(x), str(y) + '.terrain')
+        if not os.path.exists(tile_path):
+            return None
+        with open(tile_path, 'rb') as f:
+            return f.read()
+
+    def close(self):
+        with self.__databases_lock:
+            (databases, self.__databases) = (self.__databases, [])
+        for database in databases:
+            database.close()
+        self.database = None
+        while self.__bundles:
+            _, reader = self.__bundles.popitem()
+            reader.close()
+
+
+class TileServer(object):
+
+    def __init__(self, store, read_threads=READ_THREADS):
+        """
+        :param read_threads: threads running the requests of stores with blocking reads,
+                             so that one slow read does not stall the other connections
+        """
+        self.store = store
+        self.executor = None
+        if store.blocking_reads:
+            self.executor = ThreadPoolExecutor(read_threads, thread_name_prefix='TileRead')
+
+    @staticmethod
+    def __response(writer, status, headers, body, send_body):
+        lines = ['HTTP/1.1 {0}'.format(status)]
+        headers['Content-Length'] = str(len(body))
+        headers['Access-Control-Allow-Origin'] = '*'
+        for name, value in headers.items():
+            lines.append('{0}: {1}'.format(name, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if send_body:
+            writer.write(body)
+
+    def handle_request(self, method, path, headers):
+        """
+        :return: (status, headers, body)
+        """
+        if method not in ('GET', 'HEAD'):
+            return '405 Method Not Allowed', {}, b''
+        path = path.split('?', 1)[0]
+        if path.endswith('/layer.json'):
+            return '200 OK', {'Content-Type': 'application/json'}, self.store.layer_json
+
+        match = TILE_PATTERN.search(path)
+        if match is None:
+            return '404 Not Found', {}, b''
+        (z, x, y) = (int(v) for v in match.groups())
+        tile = self.store.get_tile(z, x, y)
+        if tile is None:
+            return '404 Not Found', {}, b''
+
+        response_headers = {'Content-Type': self.store.content_type}
+        # tiles are stored gzipped, send them as they are
+        if tile[:2] == GZIP_MAGIC:
+            # caches must not hand the body of one encoding to a client asking for the other
+            response_headers['Vary'] = 'Accept-Encoding'
+            if accepts_gzip(headers.get('accept-encoding', '')):
+                response_headers['Content-Encoding'] = 'gzip'
+            else:
+                tile = gzip.decompress(tile)
+        return '200 OK', response_headers, tile
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                parts = lines[0].split(' ')
+                if len(parts) != 3:
+                    break
+                (method, path, version) = parts
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                if self.executor is not None:
+                    status, response_headers, body = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self.handle_request, method, path, headers)
+                else:
+                    status, response_headers, body = self.handle_request(method, path, headers)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                response_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                self.__response(writer, status, response_headers, body, method != 'HEAD')
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='serve terrain tiles of a terrainmaker output directory')
+    parser.add_argument('root', help='terrainmaker output directory, or its terrain.mbtiles')
+    parser.add_argument('-host', default='0.0.0.0')
+    parser.add_argument('-port', type=int, default=8000)
+    parser.add_argument('-max_open', type=int, default=256, help='number of bundle files kept open')
+    parser.add_argument('-read_threads', type=int, default=READ_THREADS,
+                        help='threads reading tiles of single and sqlite outputs, default is {0}'.format(READ_THREADS))
+    args = parser.parse_args(argv)
+
+    store = TileStore(args.root, args.max_open)
+    print('serving {0} on http://{1}:{2}/'.format(args.root, args.host, args.port))
+    try:
+        asyncio.run(TileServer(store, args.read_threads).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
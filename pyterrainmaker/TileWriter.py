@@ -0,0 +1,162 @@
+#
+# TileWriter
+# write the tile files of single mode on background threads, behind a bounded queue
+#
+
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from .TerrainTile import TerrainTile
+
+# tiles handed to a writer thread at once
+WRITE_BATCH = 64
+# batches waiting in the queue before put blocks the encoder
+QUEUE_BATCHES = 8
+
+
+class TileWriter(object):
+
+    def __init__(self, location, threads=1, batch=WRITE_BATCH, queue_batches=QUEUE_BATCHES, dedup_links_size=4096):
+        """
+        tiles put by the encoders are written by threads, put blocks while the queue is full.
+        directories created once are not checked again.
+        :param location: output directory, tiles are written to {level}/{x}/{y}.terrain in it
+        :param threads: writer threads, 0 writes each batch in the calling thread
+        :param batch: tiles queued together
+        :param queue_batches: batches queued at most
+        :param dedup_links_size: tile files remembered by content digest for hardlinking
+        """
+        self.location = location
+        self.threads = threads
+        self.batch = batch
+        self.dirs = set()
+        # bounded OrderedDict of content digest -> tile file
+        self.dedup_links = OrderedDict()
+        self.dedup_links_size = dedup_links_size
+        self.seconds = 0.0
+        self.error = None
+        self.__pending = []
+        self.__lock = threading.Lock()
+        self.__queue = queue.Queue(queue_batches)
+        self.__threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.__run, name='TileWriter-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def put(self, level, x, y, binary, digest=None):
+        """
+        queue a tile file
+        :param digest: content digest, an identical tile written before is hardlinked
+        """
+        self.__pending.append((level, x, y, binary, digest))
+        if len(self.__pending) >= self.batch:
+            self.__submit()
+
+    def __submit(self):
+        if self.error is not None:
+            self.__raise_error()
+        (batch, self.__pending) = (self.__pending, [])
+        if self.threads == 0:
+            self.__write_batch(batch)
+        else:
+            self.__queue.put(batch)
+
+    def flush(self):
+        """
+        wait until every tile put is written
+        :return: seconds spent writing since the last flush, summed over the threads
+        """
+        if self.__pending:
+            self.__submit()
+        self.__queue.join()
+        if self.error is not None:
+            self.__raise_error()
+        with self.__lock:
+            (seconds, self.seconds) = (self.seconds, 0.0)
+        return seconds
+
+    def __raise_error(self):
+        """
+        drop the tiles not written yet and raise the first error, the writer is usable again after it
+        """
+        self.__pending = []
+        self.__queue.join()
+        (error, self.error) = (self.error, None)
+        raise Exception('writing tiles failed: {0}'.format(error))
+
+    def close(self):
+        for thread in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def __run(self):
+        while True:
+            batch = self.__queue.get()
+            try:
+                if batch is None:
+                    return
+                if self.error is None:
+                    self.__write_batch(batch)
+            except Exception as e:
+                self.error = '{0}: {1}'.format(type(e).__name__, e)
+            finally:
+                self.__queue.task_done()
+
+    def __write_batch(self, batch):
+        start = time.perf_counter()
+        for level, x, y, binary, digest in batch:
+            terrain_level_loc = os.path.join(self.location, str(level))
+            terrain_x_loc = os.path.join(terrain_level_loc, str(x))
+            if terrain_x_loc not in self.dirs:
+                os.makedirs(terrain_x_loc, exist_ok=True)
+                self.dirs.add(terrain_x_loc)
+            path = TerrainTile.tile_path(terrain_level_loc, x, y)
+            if digest is None:
+                self.__write(path, binary)
+            else:
+                self.__write_dedup(path, binary, digest)
+        elapsed = time.perf_counter() - start
+        with self.__lock:
+            self.seconds += elapsed
+
+    @staticmethod
+    def __write(path, binary):
+        """
+        write a tile file aside and rename it over the existing one, which may be
+        a hardlink shared with other tiles
+        """
+        with open(path + '.tmp', 'wb') as f:
+            f.write(binary)
+        os.replace(path + '.tmp', path)
+
+    def __write_dedup(self, path, binary, digest):
+        """
+        hardlink path to an identical tile file, or write it and remember it
+        """
+        with self.__lock:
+            source_path = self.dedup_links.get(digest)
+            if source_path is not None:
+                self.dedup_links.move_to_end(digest)
+        if source_path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            try:
+                os.link(source_path, path)
+                return
+            except OSError:
+                # the source was removed or is written by another thread, or the file system can not link
+                pass
+        self.__write(path, binary)
+        with self.__lock:
+            self.dedup_links[digest] = path
+            if len(self.dedup_links) > self.dedup_links_size:
+                self.dedup_links.popitem(last=False)
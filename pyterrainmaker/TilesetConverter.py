@@ -0,0 +1,308 @@
+#
+# TilesetConverter
+# copy the tiles of an output to single, compact or sqlite storage with a pool of workers,
+# tile payloads are copied as stored, without decompressing them
+#
+
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from .BundleFile import BundleReader, BundleWriter, bundle_origin, bundle_file_name
+from .TileDatabase import TileDatabase, database_path, is_database, layer_metadata
+from .TileWriter import TileWriter
+
+STORAGE_MODES = ('single', 'compact', 'sqlite')
+# columns of single and sqlite inputs read by one task, and the tiles per side of new compact bundles
+STRIP_WIDTH = 32
+# tiles inserted into an output database per transaction
+DATABASE_BATCH = 4096
+
+# state of a convert worker process, set by _init_worker
+_worker = {}
+
+
+def storage_mode(loc):
+    """
+    :param loc: output directory of terrainmaker, or a tile database
+    :return: single, compact or sqlite
+    """
+    if is_database(database_path(loc)):
+        return 'sqlite'
+    if os.path.exists(os.path.join(loc, 'bundle.json')):
+        return 'compact'
+    return 'single'
+
+
+def read_layer_json(loc):
+    if is_database(database_path(loc)):
+        with TileDatabase(database_path(loc), readonly=True) as db:
+            return json.loads(db.get_metadata('json'))
+    with open(os.path.join(loc, 'layer.json')) as f:
+        return json.load(f)
+
+
+def parse_levels(text):
+    """
+    :param text: level, or first and last level as 'from-to'
+    :return: (first level, last level)
+    """
+    parts = text.split('-')
+    if len(parts) > 2 or not all(part.isdigit() for part in parts):
+        raise Exception('levels must be a level or a range like 10-14: {0}'.format(text))
+    return int(parts[0]), int(parts[-1])
+
+
+def _init_worker(context):
+    _worker.clear()
+    _worker.update(context)
+    _worker['in_db'] = None
+    if context['in_mode'] == 'sqlite':
+        _worker['in_db'] = TileDatabase(database_path(context['in_loc']), readonly=True)
+    _worker['out_db'] = None
+    _worker['tile_writer'] = None
+    if context['out_mode'] == 'sqlite':
+        _worker['out_db'] = TileDatabase(database_path(context['out_loc']))
+    else:
+        # compact outputs keep level 0 as tile files
+        _worker['tile_writer'] = TileWriter(context['out_loc'], 1)
+
+
+def _close_worker():
+    for key in ('in_db', 'out_db'):
+        if _worker.get(key) is not None:
+            _worker[key].close()
+    if _worker.get('tile_writer') is not None:
+        _worker['tile_writer'].close()
+    _worker.clear()
+
+
+def _iter_unit(unit):
+    """
+    yield (x, y, tile bytes) of a task, the tiles of one output bundle are consecutive
+    :param unit: (level, first column, bundle file or None)
+    """
+    (level, min_x, path) = unit
+    if path is not None:
+        with BundleReader(path, use_mmap=True) as reader:
+            for x, y, data in reader.iter_tiles():
+                yield x, y, bytes(data)
+        return
+    max_x = min_x + STRIP_WIDTH - 1
+    if _worker['in_db'] is not None:
+        for _, x, y, data in _worker['in_db'].iter_tiles(level, min_x, max_x):
+            yield x, y, data
+        return
+    level_loc = os.path.join(_worker['in_loc'], str(level))
+    tiles = []
+    for x in range(min_x, max_x + 1):
+        column_loc = os.path.join(level_loc, str(x))
+        if not os.path.isdir(column_loc):
+            continue
+        for name in os.listdir(column_loc):
+            if name.endswith('.terrain') and name[:-8].isdigit():
+                tiles.append((x, int(name[:-8])))
+    if _worker['in_bundle_info'] is not None:
+        # a compact output serves the tiles of its bundles before tile files
+        tiles = [(x, y) for x, y in tiles if not _in_bundle(level, x, y)]
+    # north row first, as bundles are aligned to strips
+    for x, y in sorted(tiles, key=lambda tile: (-tile[1], tile[0])):
+        with open(os.path.join(level_loc, str(x), '{0}.terrain'.format(y)), 'rb') as f:
+            yield x, y, f.read()
+
+
+def _in_bundle(level, x, y):
+    path = os.path.join(_worker['in_loc'], str(level),
+                        bundle_file_name(bundle_origin(_worker['in_bundle_info'], level, x, y)))
+    if not os.path.exists(path):
+        return False
+    with BundleReader(path) as reader:
+        return reader.locate(x, y) is not None
+
+
+def _convert_unit(unit):
+    """
+    copy the tiles of a task to the output
+    :return: (task, error message or None, tiles, bytes)
+    """
+    level = unit[0]
+    (tiles, size) = (0, 0)
+    bundle = None
+    try:
+        out_db = _worker['out_db']
+        compact = _worker['out_mode'] == 'compact' and level > 0
+        for x, y, data in _iter_unit(unit):
+            digest = hashlib.sha1(data).digest() if _worker['dedup'] else None
+            if compact:
+                origin = bundle_origin(_worker['bundle_info'], level, x, y)
+                if bundle is None or tuple(bundle.from_tile) != origin:
+                    if bundle is not None:
+                        bundle.close()
+                    bundle_size = _worker['bundle_info'].get('bundle_sizes', {}).get(
+                        str(level), _worker['bundle_info'].get('bundle_size', 32))
+                    level_loc = os.path.join(_worker['out_loc'], str(level))
+                    os.makedirs(level_loc, exist_ok=True)
+                    bundle = BundleWriter(os.path.join(level_loc, bundle_file_name(origin)), level, origin,
+                                          bundle_size)
+                bundle.write_tile(x, y, data, digest)
+            elif out_db is not None:
+                out_db.put(level, x, y, data, digest)
+                if (tiles + 1) % DATABASE_BATCH == 0:
+                    out_db.flush()
+            else:
+                _worker['tile_writer'].put(level, x, y, data, digest)
+            tiles += 1
+            size += len(data)
+        if bundle is not None:
+            bundle.close()
+            bundle = None
+        if out_db is not None:
+            out_db.flush()
+        else:
+            _worker['tile_writer'].flush()
+    except Exception:
+        if bundle is not None:
+            bundle.abort()
+        return unit, traceback.format_exc(), tiles, size
+    return unit, None, tiles, size
+
+
+def _level_dirs(loc, min_level, max_level):
+    levels = []
+    for name in os.listdir(loc):
+        if name.isdigit() and min_level <= int(name) <= max_level and os.path.isdir(os.path.join(loc, name)):
+            levels.append(int(name))
+    return sorted(levels)
+
+
+def _units(in_loc, in_mode, min_level, max_level):
+    """
+    tasks of the input: its bundle files, and strips of STRIP_WIDTH columns of its single tiles or database
+    :return: list of (level, first column, bundle file or None)
+    """
+    units = []
+    if in_mode == 'sqlite':
+        with TileDatabase(database_path(in_loc), readonly=True) as db:
+            for level in sorted(db.levels()):
+                if min_level <= level <= max_level:
+                    strips = sorted(set(x // STRIP_WIDTH * STRIP_WIDTH for x in db.columns(level)))
+                    units.extend((level, min_x, None) for min_x in strips)
+        return units
+    for level in _level_dirs(in_loc, min_level, max_level):
+        level_loc = os.path.join(in_loc, str(level))
+        strips = set()
+        for name in sorted(os.listdir(level_loc)):
+            if name.endswith('.bundle'):
+                units.append((level, None, os.path.join(level_loc, name)))
+            elif name.isdigit():
+                # single tiles, and the level 0 tiles of compact outputs
+                strips.add(int(name) // STRIP_WIDTH * STRIP_WIDTH)
+        units.extend((level, min_x, None) for min_x in sorted(strips))
+    return units
+
+
+def _output_bundle_info(in_loc, in_mode, layer_json):
+    """
+    bundle.json of a compact output: bundles of a compact input are copied as they are,
+    others are aligned to strips
+    """
+    if in_mode == 'compact':
+        with open(os.path.join(in_loc, 'bundle.json')) as f:
+            return json.load(f)
+    bounds = layer_json['bounds']
+    return {
+        'width': 128,
+        'height': 128,
+        'extent': {'x_min': bounds[0], 'x_max': bounds[2], 'y_min': bounds[1], 'y_max': bounds[3]},
+        'bundle_size': STRIP_WIDTH,
+        'aligned': True
+    }
+
+
+def convert(in_loc, out_loc, out_mode, levels=None, jobs=multiprocessing.cpu_count(), dedup=False):
+    """
+    copy the tiles and layer.json of an output to another storage mode
+    :param in_loc: output directory of terrainmaker, or a tile database
+    :param out_loc: output directory, created if it does not exist
+    :param out_mode: single, compact or sqlite
+    :param levels: (first level, last level) to copy, None for all
+    :param jobs: number of worker processes, 1 runs in the current process
+    :param dedup: store identical tiles once, as terrainmaker --dedup does
+    :return: list of (task, error message) of failed tasks
+    """
+    if out_mode not in STORAGE_MODES:
+        raise Exception('unknown storage mode {0}'.format(out_mode))
+    in_mode = storage_mode(in_loc)
+    (min_level, max_level) = levels if levels is not None else (0, sys.maxsize)
+    layer_json = read_layer_json(in_loc)
+    os.makedirs(out_loc, exist_ok=True)
+
+    bundle_info = None
+    if out_mode == 'compact':
+        bundle_info = _output_bundle_info(in_loc, in_mode, layer_json)
+        with open(os.path.join(out_loc, 'bundle.json'), 'w') as f:
+            json.dump(bundle_info, f)
+    if out_mode == 'sqlite':
+        name = os.path.splitext(os.path.basename(os.path.abspath(in_loc)))[0]
+        with TileDatabase(database_path(out_loc), create=True, dedup=dedup) as db:
+            db.set_metadata(layer_metadata(name, layer_json))
+    else:
+        with open(os.path.join(out_loc, 'layer.json'), 'w') as f:
+            f.write(json.dumps(layer_json, indent=4))
+
+    units = _units(in_loc, in_mode, min_level, max_level)
+    print('converting {0} tasks of {1} output {2} to {3} output {4}'.format(len(units), in_mode, in_loc, out_mode,
+                                                                            out_loc))
+    in_bundle_info = None
+    if in_mode == 'compact':
+        with open(os.path.join(in_loc, 'bundle.json')) as f:
+            in_bundle_info = json.load(f)
+    context = {'in_loc': in_loc, 'in_mode': in_mode, 'out_loc': out_loc, 'out_mode': out_mode,
+               'in_bundle_info': in_bundle_info, 'bundle_info': bundle_info, 'dedup': dedup}
+    start = time.perf_counter()
+    # level -> [tiles, bytes]
+    level_stats = {}
+    failures = []
+    pool = None
+    try:
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(context,))
+            results = pool.imap_unordered(_convert_unit, units)
+        else:
+            _init_worker(context)
+            results = map(_convert_unit, units)
+        for finished, (unit, error, tiles, size) in enumerate(results, 1):
+            stats = level_stats.setdefault(unit[0], [0, 0])
+            stats[0] += tiles
+            stats[1] += size
+            if error is not None:
+                failures.append((unit, error))
+            sys.stdout.flush()
+            print('  {0}/{1} ({2:.0f}%)'.format(finished, len(units), finished * 100.0 / max(len(units), 1)), end='\r')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        _close_worker()
+    if out_mode == 'sqlite':
+        # the last connection folds the write ahead log into the database
+        with TileDatabase(database_path(out_loc)) as db:
+            db.remove_orphans()
+    seconds = time.perf_counter() - start
+
+    print('\r\n  level      tiles         MB')
+    for level, (tiles, size) in sorted(level_stats.items()):
+        print('  {0:>5} {1:>10} {2:>10.2f}'.format(level, tiles, size / 1024.0 / 1024))
+    total_tiles = sum(stats[0] for stats in level_stats.values())
+    total_size = sum(stats[1] for stats in level_stats.values())
+    print('  {0} tiles, {1:.2f} MB in {2:.2f} s: {3:.0f} tiles/s, {4:.2f} MB/s'.format(
+        total_tiles, total_size / 1024.0 / 1024, seconds, total_tiles / max(seconds, 1e-9),
+        total_size / 1024.0 / 1024 / max(seconds, 1e-9)))
+    for unit, error in failures:
+        print('\r\n  task {0} failed:'.format(unit))
+        print(error)
+    return failures
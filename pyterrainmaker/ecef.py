@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 wgs84_a = 6378137.0     # Semi-major axis
 wgs84_b = 6356752.3142451793    # Semi-minor axis
@@ -10,33 +11,41 @@ degree_per_radians = 180.0 / math.pi
 
 
 def LLH2ECEF(lon, lat, alt):
-    lat *= radians_per_degree
-    lon *= radians_per_degree
-
-    def n(x):
-        return wgs84_a / (math.sqrt(1 - wgs84_e2 * (math.sin(x) ** 2)))
-
-    x = (n(lat) + alt) * math.cos(lat) * math.cos(lon)
-    y = (n(lat) + alt) * math.cos(lat) * math.sin(lon)
-    z = (n(lat) * (1 - wgs84_e2) + alt) * math.sin(lat)
+    """
+    scalars or NumPy arrays of the same shape, arrays are not modified
+    :return: [x, y, z]
+    """
+    lat = np.multiply(lat, radians_per_degree)
+    lon = np.multiply(lon, radians_per_degree)
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    n = wgs84_a / np.sqrt(1 - wgs84_e2 * sin_lat ** 2)
+
+    x = (n + alt) * cos_lat * np.cos(lon)
+    y = (n + alt) * cos_lat * np.sin(lon)
+    z = (n * (1 - wgs84_e2) + alt) * sin_lat
 
     return [x, y, z]
 
 
 def ECEF2LLH(x, y, z):
+    """
+    scalars or NumPy arrays of the same shape
+    :return: [lon, lat, alt]
+    """
     ep = math.sqrt((wgs84_a2 - wgs84_b2) / wgs84_b2)
-    p = math.sqrt(x ** 2 + y ** 2)
-    th = math.atan2(wgs84_a * z, wgs84_b * p)
-    lon = math.atan2(y, x)
-    lat = math.atan2(
-        z + ep ** 2 * wgs84_b * math.sin(th) ** 3,
-        p - wgs84_e2 * wgs84_a * math.cos(th) ** 3
+    p = np.sqrt(np.square(x) + np.square(y))
+    th = np.arctan2(wgs84_a * np.asarray(z), wgs84_b * p)
+    lon = np.arctan2(y, x)
+    lat = np.arctan2(
+        z + ep ** 2 * wgs84_b * np.sin(th) ** 3,
+        p - wgs84_e2 * wgs84_a * np.cos(th) ** 3
     )
-    N = wgs84_a / math.sqrt(1 - wgs84_e2 * math.sin(lat) ** 2)
-    alt = p / math.cos(lat) - N
+    N = wgs84_a / np.sqrt(1 - wgs84_e2 * np.sin(lat) ** 2)
+    alt = p / np.cos(lat) - N
 
-    lon *= degree_per_radians
-    lat *= degree_per_radians
+    lon = lon * degree_per_radians
+    lat = lat * degree_per_radians
 
     return [lon, lat, alt]
 
@@ -2,15 +2,20 @@
 from __future__ import print_function
 import argparse
 import gzip
+import multiprocessing
 import numpy
-import struct
 import sys
 import os
+import time
 from osgeo import gdal
 from osgeo import gdalconst
 from osgeo import osr
 
 from  pyterrainmaker.GlobalGeodetic import GlobalGeodetic
+from pyterrainmaker.BundleFile import BundleReader
+from pyterrainmaker.TileDatabase import TileDatabase, is_database
+from pyterrainmaker.TilesetConverter import STORAGE_MODES, convert, parse_levels
+from pyterrainmaker.TileMosaic import WINDOW_TILES, mosaic
 
 
 try:
@@ -28,9 +33,11 @@ class Terrain_Util(object):
             usage='''terrain_util.py <command> [<args>]
 
 The most commonly used commands are:
-   dt     decode terrain file to GeoTiff
+   dt     decode terrain file, or a tile of a tile database, to GeoTiff
    da     decode terrain file to ASCII
-   ex     explode a bundle file to single terrain files
+   ex     explode a bundle file, or a whole output or tile database to single terrain files
+   cv     convert an output between single, compact and sqlite storage
+   mosaic decode the heightmap tiles of a level, or of an area of it, into one GeoTiff
 ''')
         parser.add_argument('command', help='Subcommand to run')
         args = parser.parse_args(sys.argv[1:2])
@@ -47,7 +54,7 @@ The most commonly used commands are:
         parser.add_argument('z', action='store', type=int)
         parser.add_argument('x', action='store', type=int)
         parser.add_argument('y', action='store', type=int)
-        parser.add_argument('in_file')
+        parser.add_argument('in_file', help='terrain file, or a tile database holding tile z/x/y')
         parser.add_argument('out_loc', nargs='?', default='.')
 
         args = parser.parse_args(sys.argv[2:])
@@ -57,6 +64,16 @@ The most commonly used commands are:
         y = args.y
         level = args.z
 
+        if is_database(in_file):
+            with TileDatabase(in_file, readonly=True) as db:
+                tile = db.get_tile(level, x, y)
+            if tile is None:
+                print('tile {0}/{1}/{2} is not found in {3}'.format(level, x, y, in_file))
+                exit(1)
+            grid = self.decode_buffer(gzip.decompress(tile))
+            self.write_grid_to_tif(grid, out_loc, x, y, level)
+            return
+
         with gzip.open(in_file, 'rb') as in_zip:
             terrain_buffer = in_zip.read()
             grid = self.decode_buffer(terrain_buffer)
@@ -79,25 +96,77 @@ The most commonly used commands are:
             numpy.savetxt(out_file, grid, '%.1f')
 
     def ex(self):
-        """explode a bundle file to single terrain files"""
+        """explode a bundle file, or a whole output or tile database to single terrain files"""
         parser = argparse.ArgumentParser(
-            description='explode a bundle file to single terrain files')
+            description='explode a bundle file to {x}_{y}.terrain files, or a compact output directory '
+                        'or a tile database to {z}/{x}/{y}.terrain')
         parser.add_argument('in_bundle')
         parser.add_argument('-out_loc', help='output terrain files location', default='.')
+        parser.add_argument('-levels', help='level or range of levels of an output to explode, like 10-14')
+        parser.add_argument('-jobs', type=int, default=multiprocessing.cpu_count(),
+                            help='worker processes exploding an output, default is CPU count')
 
         args = parser.parse_args(sys.argv[2:])
         bundle_file = args.in_bundle
         out_loc = args.out_loc
-        with open(bundle_file, 'rb') as b_f:
-            header = b_f.read(12)
-            while header:
-                (tile_x, tile_y, tile_len) = struct.unpack('<3i', header)
-                print('writing ', tile_x, tile_y)
-                t_b = b_f.read(tile_len)
+        if os.path.isdir(bundle_file) or is_database(bundle_file):
+            levels = parse_levels(args.levels) if args.levels else None
+            failures = convert(bundle_file, out_loc, 'single', levels, args.jobs)
+            exit(1 if failures else 0)
+
+        start = time.perf_counter()
+        (tiles, size) = (0, 0)
+        with BundleReader(bundle_file, use_mmap=True) as reader:
+            for (tile_x, tile_y, t_b) in reader.iter_tiles():
                 filename = '{0}_{1}.terrain'.format(tile_x, tile_y)
                 with open(os.path.join(out_loc, filename), 'wb') as t_f:
                     t_f.write(t_b)
-                header = b_f.read(12)
+                tiles += 1
+                size += len(t_b)
+        seconds = time.perf_counter() - start
+        print('{0} tiles, {1:.2f} MB in {2:.2f} s: {3:.0f} tiles/s'.format(
+            tiles, size / 1024.0 / 1024, seconds, tiles / max(seconds, 1e-9)))
+
+    def cv(self):
+        """convert an output to another storage mode"""
+        parser = argparse.ArgumentParser(
+            description='copy the tiles of an output to single, compact or sqlite storage, tiles are not '
+                        'decompressed')
+        parser.add_argument('in_loc', help='output directory of terrainmaker, or a tile database')
+        parser.add_argument('out_loc', help='output directory')
+        parser.add_argument('-mode', required=True, choices=STORAGE_MODES, help='output storage mode')
+        parser.add_argument('-levels', help='level or range of levels to convert, like 10-14, default is all')
+        parser.add_argument('-jobs', type=int, default=multiprocessing.cpu_count(),
+                            help='number of worker processes, default is CPU count')
+        parser.add_argument('-dedup', action='store_true', help='store identical tiles once')
+
+        args = parser.parse_args(sys.argv[2:])
+        levels = parse_levels(args.levels) if args.levels else None
+        failures = convert(args.in_loc, args.out_loc, args.mode, levels, args.jobs, args.dedup)
+        exit(1 if failures else 0)
+
+    def mosaic(self):
+        """mosaic a level of heightmap tiles into one tif file"""
+        parser = argparse.ArgumentParser(
+            description='decode the heightmap tiles of a level into one tiled, compressed GeoTiff, window by window')
+        parser.add_argument('in_loc', help='output directory of terrainmaker, or a tile database')
+        parser.add_argument('level', type=int, help='level of the tiles')
+        parser.add_argument('out_tif', help='output tif file')
+        parser.add_argument('-bbox', help='min_x,min_y,max_x,max_y area to mosaic in degrees, default is the level')
+        parser.add_argument('-window', type=int, default=WINDOW_TILES,
+                            help='tiles per side of the windows decoded at once, default is {0}'.format(WINDOW_TILES))
+
+        args = parser.parse_args(sys.argv[2:])
+        bbox = None
+        if args.bbox:
+            bbox = tuple(float(v) for v in args.bbox.split(','))
+            if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+                print('-bbox must be min_x,min_y,max_x,max_y')
+                exit(1)
+        if args.window < 1:
+            print('-window must be a positive integer')
+            exit(1)
+        mosaic(args.in_loc, args.level, args.out_tif, bbox, args.window)
 
     def write_grid_to_tif(self, in_grid, out_loc, x, y, level):
         mem_drv = gdal.GetDriverByName('GTiff')
@@ -2,8 +2,12 @@
 import sys
 import os
 import getopt
+import multiprocessing
 
 from pyterrainmaker.TileScheme import TileScheme
+from pyterrainmaker.Resample import RESAMPLE_METHODS
+from pyterrainmaker.Metrics import JsonLinesProgress, print_percent
+from pyterrainmaker.SourceMosaic import is_mosaic, list_sources
 
 try:
     from osgeo import gdal
@@ -12,12 +16,12 @@ except:
     sys.exit(1)
 
 
-def check_tif(in_tif):
+def check_tif(in_tif, need_overview=True):
     if os.path.exists(in_tif) is False:
         return False, 'is not found.'
 
     in_ds = gdal.Open(in_tif, gdal.GA_ReadOnly)
-    if in_ds.RasterXSize > 2000 or in_ds.RasterYSize > 2000:
+    if need_overview and (in_ds.RasterXSize > 2000 or in_ds.RasterYSize > 2000):
         band = in_ds.GetRasterBand(1)
         ov_count = band.GetOverviewCount()
         if ov_count == 0:
@@ -40,7 +44,10 @@ def check_loc(loc):
 def print_usage():
 
     print('''
-    Usage: python terrainmaker.py [options] GDAL_DATASOURCE
+    Usage: python terrainmaker.py [options] GDAL_DATASOURCE [GDAL_DATASOURCE ...]
+
+    Several rasters, or a directory of rasters, are read as their mosaic: the extent and levels
+    cover their union, and each bundle reads only the rasters it intersects.
     
     Options:
         -v, --version           output program version
@@ -49,14 +56,49 @@ def print_usage():
         -o, --out_dir <dir>     output directory for terrains
         -f, --format <format>   terrain format: heightmap/mesh, default is heightmap
         -e, --max_error <float> maximum triangulation error (float [=0.001])
-        -m, --mode <mode>       output storage mode: compact/single, default is single
+        --error-curve <float>   scale max_error of each level by (level resolution / max level resolution)
+                                to this power, 1 makes it proportional to the ground sample distance,
+                                default is 0: max_error at every level
+        -m, --mode <mode>       output storage mode: compact/single/sqlite, default is single,
+                                sqlite writes all tiles into terrain.mbtiles in the output directory
+        -j, --jobs <int>        number of worker processes, default is CPU count
+        -p, --pyramid           read only the max level from source, build lower levels
+                                from their child bundles (no overviews required)
+        --compression-level <int>  gzip level of tiles 0-9, default is 9
+        --compress-threads <int>   threads compressing tiles of a bundle in each worker, default is 1
+        --write-threads <int>   threads writing tile files in each worker in single mode while tiles
+                                are encoded, 0 writes them inline, default is 1
+        --dedup                 store identical tiles once: shared in compact bundles, hardlinked in single mode,
+                                in an images table of a new sqlite database
+        --resume                skip bundles completed by a previous run into the same output directory
+        --source-cache <MB>     source blocks cached by each worker, 0 disables the cache, default is 256
+        --open-sources <int>    rasters of a mosaic kept open by each worker, default is 64
+        --resampling <method>   resampling of source data: nearest/bilinear/average, default is nearest
+        --memory-limit <MB>     memory shared by all workers, bundles are made smaller to fit it and
+                                arrays beyond it are memory mapped to scratch files
+        --scratch-dir <dir>     directory of the scratch files, default is the system temp directory
+        --water-mask <raster>   add the water mask extension to mesh terrains, water is where the raster
+                                is not 0, or where GDAL_DATASOURCE has no data if the raster is nodata
+        --update <min_x,min_y,max_x,max_y>
+                                update an existing output: rewrite only the tiles of every level
+                                touching this changed area of GDAL_DATASOURCE
+        --update-from <raster>  update an existing output in the area where GDAL_DATASOURCE differs
+                                from this previous version of it
+        --metrics-json <file>   write bundles, tiles, bytes and throughput by level, seconds by stage,
+                                source cache and mesh stats of the run as JSON
+        --progress-json <file>  append a JSON line of progress with throughput and ETA by level every
+                                5 seconds and when done, - writes them to stdout instead of the percentage
+                                and prints the other messages to stderr
     ''')
 
 
 def main(argv):
 
     try:
-        opts, args = getopt.getopt(argv, "hvl:o:f:e:m:", ['help=', 'version=', 'fill=', 'out_dir=', 'format=', 'max_error=','mode='])
+        opts, args = getopt.getopt(argv, "hvl:o:f:e:m:j:p", ['help=', 'version=', 'fill=', 'out_dir=', 'format=', 'max_error=','mode=', 'jobs=', 'pyramid',
+                                                          'compression-level=', 'compress-threads=', 'dedup', 'resume', 'update=', 'update-from=', 'source-cache=', 'resampling=',
+                                                          'memory-limit=', 'scratch-dir=', 'water-mask=', 'error-curve=',
+                                                          'metrics-json=', 'progress-json=', 'write-threads=', 'open-sources='])
     except getopt.GetoptError:
         print_usage()
         sys.exit(2)
@@ -66,6 +108,24 @@ def main(argv):
     terrain_format = 'heightmap'
     fill_raster = None
     max_error = 0.01
+    error_curve = 0.0
+    jobs = multiprocessing.cpu_count()
+    pyramid = False
+    compression_level = 9
+    compress_threads = 1
+    write_threads = 1
+    dedup = False
+    resume = False
+    update_region = None
+    previous_tif = None
+    source_cache = 256
+    open_sources = 64
+    resampling = 'nearest'
+    memory_limit = None
+    scratch_dir = None
+    water_mask = None
+    metrics_json = None
+    progress_json = None
     for opt, arg in opts:
         if opt == '-h':
             print_usage()
@@ -74,6 +134,15 @@ def main(argv):
             out_loc = arg
         elif opt in ('-e', '--max_error'):
             max_error = arg
+        elif opt == '--error-curve':
+            try:
+                error_curve = float(arg)
+            except ValueError:
+                error_curve = -1
+            if error_curve < 0:
+                print('--error-curve parameter must be a non-negative float.')
+                print_usage()
+                sys.exit()
         elif opt in ('-v', '--verion'):
             print('1.0.0')
             sys.exit()
@@ -92,11 +161,122 @@ def main(argv):
                 sys.exit()
             terrain_format = arg
         elif opt in ('-m', '--mode'):
-            if arg not in ['single','compact']:
+            if arg not in ['single','compact','sqlite']:
                 print('-m parameter is invalid.')
                 print_usage()
                 sys.exit()
             storage_mode = arg
+        elif opt in ('-j', '--jobs'):
+            try:
+                jobs = int(arg)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print('-j parameter must be a positive integer.')
+                print_usage()
+                sys.exit()
+        elif opt in ('-p', '--pyramid'):
+            pyramid = True
+        elif opt == '--compression-level':
+            if arg not in [str(x) for x in range(0, 10)]:
+                print('--compression-level parameter must be an integer in [0 - 9].')
+                print_usage()
+                sys.exit()
+            compression_level = int(arg)
+        elif opt == '--compress-threads':
+            try:
+                compress_threads = int(arg)
+            except ValueError:
+                compress_threads = 0
+            if compress_threads < 1:
+                print('--compress-threads parameter must be a positive integer.')
+                print_usage()
+                sys.exit()
+        elif opt == '--write-threads':
+            try:
+                write_threads = int(arg)
+            except ValueError:
+                write_threads = -1
+            if write_threads < 0:
+                print('--write-threads parameter must be a non-negative integer.')
+                print_usage()
+                sys.exit()
+        elif opt == '--dedup':
+            dedup = True
+        elif opt == '--resume':
+            resume = True
+        elif opt == '--source-cache':
+            try:
+                source_cache = int(arg)
+            except ValueError:
+                source_cache = -1
+            if source_cache < 0:
+                print('--source-cache parameter must be a non-negative integer.')
+                print_usage()
+                sys.exit()
+        elif opt == '--open-sources':
+            try:
+                open_sources = int(arg)
+            except ValueError:
+                open_sources = 0
+            if open_sources < 1:
+                print('--open-sources parameter must be a positive integer.')
+                print_usage()
+                sys.exit()
+        elif opt == '--resampling':
+            if arg not in RESAMPLE_METHODS:
+                print('--resampling parameter is invalid.')
+                print_usage()
+                sys.exit()
+            resampling = arg
+        elif opt == '--memory-limit':
+            try:
+                memory_limit = int(arg)
+            except ValueError:
+                memory_limit = 0
+            if memory_limit < 1:
+                print('--memory-limit parameter must be a positive integer.')
+                print_usage()
+                sys.exit()
+        elif opt == '--scratch-dir':
+            status, msg = check_loc(arg)
+            if status is False:
+                print(arg, msg)
+                print_usage()
+                sys.exit()
+            scratch_dir = arg
+        elif opt == '--water-mask':
+            if arg != 'nodata':
+                status, msg = check_tif(arg)
+                if status is False:
+                    print(arg, msg)
+                    print_usage()
+                    sys.exit()
+            water_mask = arg
+        elif opt == '--update':
+            try:
+                update_region = tuple(float(v) for v in arg.split(','))
+            except ValueError:
+                update_region = ()
+            if len(update_region) != 4 or update_region[0] > update_region[2] or update_region[1] > update_region[3]:
+                print('--update parameter must be min_x,min_y,max_x,max_y.')
+                print_usage()
+                sys.exit()
+        elif opt == '--update-from':
+            if not os.path.exists(arg):
+                print(arg, 'is not found.')
+                print_usage()
+                sys.exit()
+            previous_tif = arg
+        elif opt == '--metrics-json':
+            metrics_json = arg
+        elif opt == '--progress-json':
+            progress_json = arg
+
+    json_stream = sys.stdout
+    if progress_json == '-':
+        # stdout carries only the JSON lines, messages for people go to stderr
+        sys.stdout = sys.stderr
 
     if len(args) < 1:
         print('Error: The GDAL_DATASOURCE must be specified.')
@@ -110,10 +290,20 @@ def main(argv):
         print('max_error must be float type. [0 - 1]')
         sys.exit()
 
-    in_tif = args[0]
-    status, msg = check_tif(in_tif)
-    if status is False:
-        print(in_tif, msg)
+    in_tif = args[0] if len(args) == 1 else args
+    sources = list_sources(in_tif)
+    if not sources:
+        print(in_tif, 'has no raster.')
+        print_usage()
+        sys.exit()
+    for source in sources:
+        status, msg = check_tif(source, need_overview=not pyramid)
+        if status is False:
+            print(source, msg)
+            print_usage()
+            sys.exit()
+    if previous_tif and is_mosaic(in_tif):
+        print('--update-from needs a single GDAL_DATASOURCE raster, use --update with the changed area.')
         print_usage()
         sys.exit()
 
@@ -126,12 +316,48 @@ def main(argv):
     is_compact = True if storage_mode == 'compact' else False
 
     ts = TileScheme(in_tif, is_compact)
+    ts.is_sqlite = storage_mode == 'sqlite'
     ts.out_no_data = 0
+    ts.pyramid = pyramid
+    ts.compression_level = compression_level
+    ts.compress_threads = compress_threads
+    ts.write_threads = write_threads
+    ts.dedup = dedup
+    ts.source_cache_size = source_cache * 1024 * 1024
+    ts.max_open_sources = open_sources
+    ts.resampling = resampling
+    if memory_limit is not None:
+        ts.memory_limit = memory_limit * 1024 * 1024
+    ts.scratch_dir = scratch_dir
+    ts.water_mask = water_mask
+    ts.error_curve = error_curve
     if fill_raster:
         ts.set_fill_raster(fill_raster)
+    if previous_tif:
+        update_region = ts.diff_region(previous_tif)
+        if update_region is None:
+            print('{0} has no change from {1}'.format(in_tif, previous_tif))
+            sys.exit()
+        print('updating changed area {0}'.format(','.join(str(v) for v in update_region)))
+    ts.update_region = update_region
     ts.generate_scheme()
 
-    ts.make_bundles(out_loc, decode_type=terrain_format, mesh_max_error=max_error)
+    progress_file = None
+    if progress_json == '-':
+        ts.metrics_listeners = [JsonLinesProgress(json_stream)]
+    elif progress_json:
+        progress_file = open(progress_json, 'a')
+        ts.metrics_listeners = [print_percent, JsonLinesProgress(progress_file)]
+
+    failures = ts.make_bundles(out_loc, decode_type=terrain_format, mesh_max_error=max_error, thread_count=jobs,
+                               resume=resume)
+    if progress_file is not None:
+        progress_file.close()
+    if metrics_json:
+        ts.metrics.write_json(metrics_json)
+    if failures:
+        print("\r\n   done, {0} bundles failed".format(len(failures)))
+        sys.exit(1)
     print("\r\n   done")
 
 
@@ -0,0 +1,195 @@
+import os
+import struct
+
+import pytest
+
+from pyterrainmaker.BundleFile import (BundleReader, BundleUpdater, BundleWriter, BUNDLE_MAGIC, BUNDLE_VERSION, HEADER_FORMAT,
+                                       HEADER_SIZE, INDEX_FORMAT, INDEX_ENTRY_SIZE, LEGACY_HEADER_FORMAT)
+
+FROM_TILE = (100, 63)
+TILES = {(100, 63): b'north west', (100, 60): b'south west', (103, 63): b'north east', (102, 61): b'middle'}
+
+
+def write_bundle(path, tiles, bundle_size=4, digests=None):
+    with BundleWriter(path, 7, FROM_TILE, bundle_size) as writer:
+        for (x, y), data in tiles.items():
+            writer.write_tile(x, y, data, None if digests is None else digests[(x, y)])
+
+
+def write_legacy_bundle(path, tiles):
+    with open(path, 'wb') as f:
+        for (x, y), data in tiles.items():
+            f.write(struct.pack(LEGACY_HEADER_FORMAT, x, y, len(data)))
+            f.write(data)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_round_trip(tmp_path, use_mmap):
+    path = str(tmp_path / 'b.bundle')
+    write_bundle(path, TILES)
+    with BundleReader(path, use_mmap) as reader:
+        assert (reader.version, reader.level, reader.from_tile, reader.bundle_size) == (BUNDLE_VERSION, 7, FROM_TILE, 4)
+        assert reader.tiles() == list(TILES)
+        assert dict(((x, y), data) for x, y, data in reader.iter_tiles()) == TILES
+        assert reader.get_tile(101, 62) is None
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_layout(tmp_path):
+    path = str(tmp_path / 'b.bundle')
+    write_bundle(path, TILES)
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert struct.unpack_from(HEADER_FORMAT, data) == (BUNDLE_MAGIC, BUNDLE_VERSION, 4, 7, 100, 63)
+    index = list(struct.iter_unpack(INDEX_FORMAT, data[HEADER_SIZE:HEADER_SIZE + 16 * INDEX_ENTRY_SIZE]))
+    for (x, y), tile in TILES.items():
+        (offset, length) = index[(x - 100) * 4 + (63 - y)]
+        assert data[offset:offset + length] == tile
+    assert sum(1 for _, length in index if length > 0) == len(TILES)
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_legacy_bundles(tmp_path, use_mmap):
+    path = str(tmp_path / 'b.bundle')
+    write_legacy_bundle(path, TILES)
+    with BundleReader(path, use_mmap) as reader:
+        assert reader.version == 0
+        assert reader.tiles() == list(TILES)
+        assert reader.get_tile(102, 61) == b'middle'
+        assert reader.get_tile(101, 62) is None
+        assert reader.get_tile(0, 0) is None
+
+
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_empty_bundles(tmp_path, use_mmap):
+    path = str(tmp_path / 'b.bundle')
+    write_bundle(path, {})
+    assert os.path.getsize(path) == HEADER_SIZE + 16 * INDEX_ENTRY_SIZE
+    legacy_path = str(tmp_path / 'legacy.bundle')
+    write_legacy_bundle(legacy_path, {})
+    for bundle_path in (path, legacy_path):
+        with BundleReader(bundle_path, use_mmap) as reader:
+            assert reader.tiles() == []
+            assert list(reader.iter_tiles()) == []
+            assert reader.get_tile(100, 63) is None
+
+
+def test_dedup_tiles_share_their_data(tmp_path):
+    path = str(tmp_path / 'b.bundle')
+    digests = {(100, 63): b'sea', (100, 60): b'land', (103, 63): b'sea', (102, 61): b'sea'}
+    tiles = dict((tile, digest * 10) for tile, digest in digests.items())
+    write_bundle(path, tiles, digests=digests)
+    with BundleReader(path) as reader:
+        assert reader.locate(100, 63) == reader.locate(103, 63) == reader.locate(102, 61)
+        assert reader.locate(100, 60) != reader.locate(100, 63)
+        assert dict(((x, y), data) for x, y, data in reader.iter_tiles()) == tiles
+    assert os.path.getsize(path) == HEADER_SIZE + 16 * INDEX_ENTRY_SIZE + 70
+
+
+def test_tiles_outside_the_bundle(tmp_path):
+    path = str(tmp_path / 'b.bundle')
+    with BundleWriter(path, 7, FROM_TILE, 4) as writer:
+        for (x, y) in ((99, 63), (104, 63), (100, 64), (100, 59)):
+            with pytest.raises(Exception):
+                writer.write_tile(x, y, b'outside')
+    with BundleReader(path) as reader:
+        for (x, y) in ((99, 63), (104, 63), (100, 64), (100, 59)):
+            assert reader.get_tile(x, y) is None
+
+
+def test_failed_writes_leave_no_bundle(tmp_path):
+    path = str(tmp_path / 'b.bundle')
+    with pytest.raises(ValueError):
+        with BundleWriter(path, 7, FROM_TILE, 4) as writer:
+            writer.write_tile(100, 63, b'tile')
+            raise ValueError()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def updated(tiles):
+    result = dict(TILES)
+    result.update(tiles)
+    return result
+
+
+def read_tiles(path):
+    with BundleReader(path) as reader:
+        return dict(((x, y), data) for x, y, data in reader.iter_tiles())
+
+
+def test_updates_patch_bundles_in_place(tmp_path):
+    path = str(tmp_path / 'b.bundle')
+    write_bundle(path, TILES)
+    size = os.path.getsize(path)
+    inode = os.stat(path).st_ino
+    old_reader = BundleReader(path, use_mmap=True)
+    with BundleUpdater(path, 7, FROM_TILE, 4) as updater:
+        updater.write_tile(102, 61, b'updated', b'digest')
+        updater.write_tile(101, 62, b'updated', b'digest')
+        updater.write_tile(101, 61, b'new')
+    assert os.stat(path).st_ino == inode
+    # replaced data stays in the file, tiles of one digest are appended once
+    assert os.path.getsize(path) == size + len(b'updated') + len(b'new')
+    assert read_tiles(path) == updated({(102, 61): b'updated', (101, 62): b'updated', (101, 61): b'new'})
+    with BundleReader(path) as reader:
+        assert reader.locate(102, 61) == reader.locate(101, 62)
+    # a reader opened before the update keeps the old index
+    assert old_reader.get_tile(102, 61) == b'middle'
+    assert old_reader.get_tile(101, 61) is None
+    old_reader.close()
+
+
+def test_aborted_updates_restore_the_bundle(tmp_path):
+    path = str(tmp_path / 'b.bundle')
+    write_bundle(path, TILES)
+    with open(path, 'rb') as f:
+        before = f.read()
+    with pytest.raises(ValueError):
+        with BundleUpdater(path, 7, FROM_TILE, 4) as updater:
+            updater.write_tile(102, 61, b'updated')
+            updater.write_tile(101, 61, b'new')
+            raise ValueError()
+    with open(path, 'rb') as f:
+        assert f.read() == before
+
+
+def test_updates_rewrite_legacy_bundles(tmp_path):
+    path = str(tmp_path / 'b.bundle')
+    write_legacy_bundle(path, TILES)
+    with BundleUpdater(path, 7, FROM_TILE, 4) as updater:
+        updater.write_tile(102, 61, b'updated')
+        updater.write_tile(101, 61, b'new')
+    with BundleReader(path) as reader:
+        assert (reader.version, reader.level, reader.from_tile, reader.bundle_size) == (BUNDLE_VERSION, 7, FROM_TILE, 4)
+    assert read_tiles(path) == updated({(102, 61): b'updated', (101, 61): b'new'})
+
+
+def test_aborted_rewrites_keep_the_legacy_bundle(tmp_path):
+    path = str(tmp_path / 'b.bundle')
+    write_legacy_bundle(path, TILES)
+    with pytest.raises(ValueError):
+        with BundleUpdater(path, 7, FROM_TILE, 4) as updater:
+            updater.write_tile(102, 61, b'updated')
+            raise ValueError()
+    with BundleReader(path) as reader:
+        assert reader.version == 0
+    assert read_tiles(path) == TILES
+    assert os.listdir(str(tmp_path)) == ['b.bundle']
+
+
+@pytest.mark.parametrize('level, bundle_size', [(8, 4), (7, 8)])
+def test_updates_rewrite_mismatched_bundles(tmp_path, level, bundle_size):
+    path = str(tmp_path / 'b.bundle')
+    write_bundle(path, TILES)
+    with BundleUpdater(path, level, FROM_TILE, bundle_size) as updater:
+        updater.write_tile(102, 61, b'updated')
+    with BundleReader(path) as reader:
+        assert (reader.level, reader.bundle_size) == (level, bundle_size)
+    assert read_tiles(path) == updated({(102, 61): b'updated'})
+
+
+def test_updates_create_missing_bundles(tmp_path):
+    path = str(tmp_path / 'b.bundle')
+    with BundleUpdater(path, 7, FROM_TILE, 4) as updater:
+        updater.write_tile(101, 61, b'new')
+    assert read_tiles(path) == {(101, 61): b'new'}
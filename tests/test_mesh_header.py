@@ -0,0 +1,38 @@
+import struct
+from io import BytesIO
+
+import numpy as np
+import quantized_mesh_encoder
+
+from pyterrainmaker.MeshHeader import MESH_HEADER_FORMAT, SCALED_SPACE, bundle_headers, pack_header
+
+RES = 0.02 / 64
+
+
+def test_headers_match_quantized_mesh_encoder():
+    # a mesh of every grid point of a tile has the header of the whole tile
+    (rows, cols) = np.mgrid[0:129, 0:129]
+    heights = (np.sin(cols / 9.0) * 400 + rows * 15 + 200).astype(np.float32)
+    x_offsets = np.array([0, 64, 0, 64])
+    y_offsets = np.array([0, 0, 64, 64])
+    headers = bundle_headers(heights, 10.0, 45.04, RES, x_offsets, y_offsets)
+    for header, x_offset, y_offset in zip(headers, x_offsets, y_offsets):
+        (lat, lon) = np.mgrid[0:65, 0:65]
+        positions = np.stack([10.0 + (x_offset + lon) * RES, 45.04 - (y_offset + lat) * RES,
+                              heights[y_offset:y_offset + 65, x_offset:x_offset + 65]], axis=-1).reshape(-1, 3)
+        triangles = np.array([0, 1, 65], dtype=np.uint32)
+        encoded = BytesIO()
+        quantized_mesh_encoder.encode(encoded, positions, triangles, sphere_method='naive')
+        fields = struct.unpack_from(MESH_HEADER_FORMAT, encoded.getvalue())
+        # the encoder reads positions as float32, a hundredth of a second of arc
+        np.testing.assert_allclose(header[0:3], fields[0:3], atol=1.0)
+        np.testing.assert_allclose(header[3], fields[8], atol=1.0)
+        # the encoder writes the occlusion point in earth centered meters, Cesium reads it in the
+        # ellipsoid scaled frame of bundle_headers. both are on the line through the center
+        occlusion = header[4:7] * SCALED_SPACE
+        np.testing.assert_allclose(occlusion / np.linalg.norm(occlusion),
+                                   np.array(fields[9:12]) / np.linalg.norm(fields[9:12]), atol=1e-7)
+        assert 1.0 < np.linalg.norm(header[4:7]) < 1.01
+
+        packed = pack_header(np.array(fields[0:3] + fields[8:12]), fields[3], fields[4])
+        assert packed == encoded.getvalue()[:struct.calcsize(MESH_HEADER_FORMAT)]
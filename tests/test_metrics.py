@@ -0,0 +1,46 @@
+import io
+import json
+import time
+
+from pyterrainmaker.Metrics import JsonLinesProgress, Metrics
+
+
+def task_stats(level, tiles):
+    return {'cache_hits': 0, 'cache_misses': 1, 'stage_times': {'read': 0.5}, 'mesh_stats': {},
+            'levels': {level: [1, tiles, tiles * 100]}}
+
+
+def test_ticker_reports_while_no_task_finishes():
+    stream = io.StringIO()
+    metrics = Metrics({10: 4})
+    metrics.add_listener(JsonLinesProgress(stream, interval=0.05))
+    metrics.start_level(10)
+    metrics.record(1, task_stats(10, 8))
+    metrics.start_ticker(0.01)
+    time.sleep(0.5)
+    metrics.stop_ticker()
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    # a task of the run is still working, the lines keep coming
+    assert len(lines) >= 4
+    assert all(line['event'] == 'progress' and line['bundles'] == 1 for line in lines)
+    assert lines[-1]['elapsed'] > lines[0]['elapsed']
+
+    count = len(lines)
+    time.sleep(0.1)
+    assert len(stream.getvalue().splitlines()) == count
+    metrics.notify(final=True)
+    done = json.loads(stream.getvalue().splitlines()[-1])
+    assert done['event'] == 'done'
+    assert done['levels']['10']['tiles'] == 8
+    assert done['eta'] is not None
+
+
+def test_progress_lines_are_rate_limited():
+    stream = io.StringIO()
+    metrics = Metrics({10: 100})
+    metrics.add_listener(JsonLinesProgress(stream, interval=60))
+    for _ in range(50):
+        metrics.record(1, task_stats(10, 1))
+    metrics.notify(final=True)
+    events = [json.loads(line)['event'] for line in stream.getvalue().splitlines()]
+    assert events == ['progress', 'done']
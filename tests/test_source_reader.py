@@ -0,0 +1,93 @@
+import numpy as np
+
+from pyterrainmaker.SourceReader import BlockCache, SourceReader
+
+
+class ArrayBand(object):
+    """
+    band lookalike of an array, counting the reads
+    """
+
+    def __init__(self, array, block_size=(64, 64)):
+        self.array = array
+        self.XSize = array.shape[1]
+        self.YSize = array.shape[0]
+        self.block_size = block_size
+        self.reads = 0
+
+    def GetBlockSize(self):
+        return list(self.block_size)
+
+    def ReadAsArray(self, xoff, yoff, win_xsize, win_ysize):
+        self.reads += 1
+        return self.array[yoff:yoff + win_ysize, xoff:xoff + win_xsize].copy()
+
+
+def make_reader(rows=600, cols=700, cache_size=64 * 1024 * 1024):
+    array = np.arange(rows * cols, dtype=np.int32).reshape(rows, cols).astype(np.int16)
+    band = ArrayBand(array)
+    return array, band, SourceReader(band, BlockCache(cache_size), 0)
+
+
+def test_windows_match_the_band():
+    (array, _, reader) = make_reader()
+    for (xoff, yoff, width, height) in ((0, 0, 700, 600), (10, 20, 300, 257), (255, 255, 2, 2), (699, 599, 1, 1)):
+        window = reader.ReadAsArray(xoff, yoff, width, height)
+        assert window.dtype == array.dtype
+        np.testing.assert_array_equal(window, array[yoff:yoff + height, xoff:xoff + width])
+
+
+def test_empty_windows_are_empty_arrays():
+    # a bundle touching the source only on its edge reads an empty window, chunks are 256 pixels
+    (array, _, reader) = make_reader(rows=512, cols=768)
+    for (xoff, yoff, width, height) in ((0, 512, 768, 0), (768, 0, 0, 512), (256, 256, 0, 0), (768, 512, 0, 0),
+                                        (100, 100, 0, 0)):
+        window = reader.ReadAsArray(xoff, yoff, width, height)
+        assert window is not None
+        assert window.shape == (height, width)
+        assert window.dtype == array.dtype
+
+
+def test_windows_outside_the_band_are_none():
+    (_, _, reader) = make_reader()
+    assert reader.ReadAsArray(-1, 0, 10, 10) is None
+    assert reader.ReadAsArray(695, 0, 10, 10) is None
+    assert reader.ReadAsArray(0, 601, 10, 0) is None
+
+
+def test_chunks_are_read_once():
+    (_, band, reader) = make_reader()
+    reader.ReadAsArray(0, 0, 700, 600)
+    reads = band.reads
+    reader.ReadAsArray(10, 10, 500, 500)
+    assert band.reads == reads
+
+
+def test_read_points():
+    (array, _, reader) = make_reader()
+    xs = np.array([0, 699, 300, 5, 256])
+    ys = np.array([0, 599, 300, 590, 255])
+    np.testing.assert_array_equal(reader.read_points(xs, ys), array[ys, xs])
+
+
+def test_bundle_on_the_south_edge_of_the_source():
+    # the source ends on 45 degrees, a tile boundary at every level: the bundle whose north
+    # tiles touch it has source data on its north row only
+    from pyterrainmaker.TerrainBundle import TerrainBundle
+
+    res = 1.0 / 4096
+    array = np.full((2048, 2048), 100, dtype=np.int16)
+    reader = SourceReader(ArrayBand(array), BlockCache(64 * 1024 * 1024), 0)
+    bundle = TerrainBundle(reader, 32, True)
+    bundle.level = 14
+    bundle.resolution = 180.0 / 2 ** 14 / 64
+    bundle.from_tile = (17280, 12287)
+    bundle.no_data = -32768
+    bundle.out_no_data = 0
+    bundle.has_next_level = False
+    bundle.source_range = (10.0, 45.0, 10.0 + 2048 * res, 45.0 + 2048 * res)
+    bundle.calculate_tiles()
+    assert len(bundle.tiles.x) > 0
+    assert (bundle.tiles.y == 12287).all()
+    assert (bundle.bundle_array[0, 64 * 16:] == 100).all()
+    assert not bundle.bundle_array[1:].any()
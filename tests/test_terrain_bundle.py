@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from pyterrainmaker.SourceReader import BlockCache, SourceReader
+from pyterrainmaker.TerrainBundle import TerrainBundle
+
+from .test_source_reader import ArrayBand
+
+RES = 1.0 / 4096
+SOURCE_RANGE = (10.0, 19.75, 10.0 + 1500 * RES, 19.75 + 1000 * RES)
+
+
+def make_source():
+    (rows, cols) = np.mgrid[0:1000, 0:1500]
+    array = (rows * 0.7 + cols * 0.3 + np.sin(cols / 17.0) * 50).astype(np.int16)
+    array[100:120, 300:340] = -32768
+    return array
+
+
+def make_bundle(array, from_tile, bundle_size, resampling, level=14):
+    bundle = TerrainBundle(SourceReader(ArrayBand(array), BlockCache(64 * 1024 * 1024), 0), bundle_size, True)
+    bundle.level = level
+    bundle.resolution = 180.0 / 2 ** level / 64
+    bundle.from_tile = from_tile
+    bundle.no_data = -32768
+    bundle.out_no_data = 0
+    bundle.has_next_level = False
+    bundle.resampling = resampling
+    bundle.source_range = SOURCE_RANGE
+    bundle.calculate_tiles()
+    return bundle
+
+
+@pytest.mark.parametrize('resampling', ['nearest', 'bilinear', 'average'])
+def test_heights_do_not_depend_on_bundle_size(resampling):
+    # a memory limit splits bundles, the heights of a tile must stay the same
+    array = make_source()
+    big = make_bundle(array, (17294, 10012), 8, resampling)
+    for (dx, dy) in ((0, 0), (2, 2), (6, 4), (2, 6)):
+        small = make_bundle(array, (17294 + dx, 10012 - dy), 2, resampling)
+        expected = big.bundle_array[dy * 64:dy * 64 + small.bundle_array.shape[0],
+                                    dx * 64:dx * 64 + small.bundle_array.shape[1]]
+        np.testing.assert_array_equal(small.bundle_array, expected)
+
+
+def test_heights_of_a_lower_level():
+    # every point of the level grid reads the source pixels under it
+    array = make_source()
+    bundle = make_bundle(array, (8647, 5005), 1, 'nearest', level=13)
+    step = 180.0 / 2 ** 13 / 64
+    x = -180.0 + (8647 * 64 + np.arange(65)) * step
+    y = -90.0 + (5006 * 64 - np.arange(65)) * step
+    cols = np.floor((x - SOURCE_RANGE[0]) / RES).astype(int)
+    rows = np.floor((SOURCE_RANGE[3] - y) / RES).astype(int)
+    inside_x = (cols >= 0) & (cols < 1500)
+    inside_y = (rows >= 0) & (rows < 1000)
+    expected = array[np.ix_(rows[inside_y], cols[inside_x])].astype(np.float32)
+    expected[expected == -32768] = 0
+    np.testing.assert_array_equal(bundle.bundle_array[np.ix_(inside_y, inside_x)], expected)
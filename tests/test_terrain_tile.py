@@ -0,0 +1,66 @@
+import gzip
+import os
+import struct
+from io import BytesIO
+
+import numpy as np
+import quantized_mesh_encoder
+from pydelatin import Delatin
+from pydelatin.util import rescale_positions
+
+from pyterrainmaker.MeshHeader import MESH_HEADER_FORMAT
+from pyterrainmaker.TerrainTile import TerrainTile, decode_heightmap_tiles, encode_heightmap_bundle
+
+
+def test_save_binary_does_not_write_through_hardlinks(tmp_path):
+    location = str(tmp_path)
+    TerrainTile.save_binary(location, 5, 7, b'shared')
+    os.makedirs(os.path.join(location, '6'))
+    os.link(TerrainTile.tile_path(location, 5, 7), TerrainTile.tile_path(location, 6, 7))
+
+    TerrainTile.save_binary(location, 5, 7, b'updated')
+    with open(TerrainTile.tile_path(location, 5, 7), 'rb') as f:
+        assert f.read() == b'updated'
+    with open(TerrainTile.tile_path(location, 6, 7), 'rb') as f:
+        assert f.read() == b'shared'
+    assert os.listdir(os.path.join(location, '5')) == ['7.terrain']
+
+
+def test_bundle_payloads_match_the_tiles():
+    bundle_array = (np.arange(129 * 193, dtype=np.float32).reshape(129, 193) % 997) - 300
+    x_offsets = np.array([0, 64, 128, 0, 128])
+    y_offsets = np.array([0, 0, 0, 64, 64])
+    flags = np.array([0, 1, 2, 4, 15], dtype=np.uint8)
+    payloads = encode_heightmap_bundle(bundle_array, x_offsets, y_offsets, flags)
+    for payload, x_offset, y_offset, flag in zip(payloads, x_offsets, y_offsets, flags):
+        tile = TerrainTile(int(x_offset), int(y_offset), int(flag), None, None)
+        tile.encode(bundle_array)
+        assert gzip.decompress(tile.binary) == payload.tobytes()
+        assert payload[-2:].tolist() == [flag, 0]
+    heights = decode_heightmap_tiles([payload.tobytes() for payload in payloads])
+    np.testing.assert_array_equal(heights[4], bundle_array[64:129, 128:193])
+
+
+def mesh_positions():
+    (rows, cols) = np.mgrid[0:65, 0:65]
+    heights = (np.sin(cols / 9.0) * 40 + rows * 1.5 + 200).astype(np.float32)
+    tin = Delatin(heights, max_error=0.5)
+    return rescale_positions(tin.vertices, (10.0, 45.0, 10.02, 45.02)), tin.triangles
+
+
+def test_write_mesh_matches_quantized_mesh_encoder():
+    # write_mesh uses helpers of quantized_mesh_encoder.encode which are not its public api,
+    # the output must stay the output of encode with the same header
+    (positions, triangles) = mesh_positions()
+    expected = BytesIO()
+    quantized_mesh_encoder.encode(expected, positions, triangles, sphere_method='naive')
+    expected = expected.getvalue()
+    fields = struct.unpack_from(MESH_HEADER_FORMAT, expected)
+    # the naive bounding sphere is centered on the tile center, as pack_header writes it
+    assert fields[5:8] == fields[0:3]
+
+    tile = TerrainTile(0, 0, 0, None, None)
+    tile.header = np.array(fields[0:3] + fields[8:12])
+    written = BytesIO()
+    tile.write_mesh(written, positions, triangles)
+    assert written.getvalue() == expected
@@ -0,0 +1,85 @@
+import sqlite3
+
+import pytest
+
+from pyterrainmaker.TileDatabase import TileDatabase, database_path, is_database, DATABASE_NAME
+
+TILES = [(5, 10, 3, b'sea'), (5, 11, 3, b'land'), (5, 12, 3, b'sea'), (6, 20, 7, b'sea'), (6, 21, 6, b'hill')]
+
+
+def make_database(path, dedup):
+    db = TileDatabase(path, create=True, dedup=dedup)
+    for level, x, y, data in TILES:
+        db.put(level, x, y, data)
+    db.flush()
+    return db
+
+
+def count_rows(path, table):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT count(*) FROM {0}'.format(table)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_round_trip(tmp_path, dedup):
+    path = str(tmp_path / DATABASE_NAME)
+    with make_database(path, dedup) as db:
+        db.set_metadata({'json': '{}', 'maxzoom': 6})
+    assert is_database(path)
+    assert database_path(str(tmp_path)) == path
+    with TileDatabase(path, readonly=True) as db:
+        assert db.dedup == dedup
+        for level, x, y, data in TILES:
+            assert db.get_tile(level, x, y) == data
+            assert db.has_tile(level, x, y)
+        assert db.get_tile(5, 13, 3) is None
+        assert not db.has_tile(5, 13, 3)
+        assert sorted(db.levels()) == [5, 6]
+        assert db.columns(6) == [20, 21]
+        assert db.get_metadata('maxzoom') == '6'
+        assert sorted(db.iter_tiles()) == sorted(TILES)
+        # north row first
+        assert [(x, y) for _, x, y, _ in db.iter_tiles(6)] == [(20, 7), (21, 6)]
+        assert [x for _, x, _, _ in db.iter_tiles(5, 11, 12)] == [11, 12]
+
+
+def test_dedup_layout_stores_tiles_once(tmp_path):
+    path = str(tmp_path / DATABASE_NAME)
+    make_database(path, True).close()
+    assert count_rows(path, 'images') == 3
+    assert count_rows(path, 'map') == len(TILES)
+    # an existing database keeps its layout
+    with TileDatabase(path, create=True, dedup=False) as db:
+        assert db.dedup
+
+
+def test_puts_replace_tiles(tmp_path):
+    for dedup in (False, True):
+        path = str(tmp_path / '{0}.mbtiles'.format(dedup))
+        with make_database(path, dedup) as db:
+            db.put(5, 10, 3, b'land')
+            db.put(5, 13, 3, b'new')
+            db.flush()
+            assert db.get_tile(5, 10, 3) == b'land'
+            assert db.get_tile(5, 13, 3) == b'new'
+            assert len(list(db.iter_tiles())) == len(TILES) + 1
+
+
+def test_remove_orphans(tmp_path):
+    path = str(tmp_path / DATABASE_NAME)
+    with make_database(path, True) as db:
+        # the hill tile is no longer referenced, sea still is
+        db.put(6, 21, 6, b'land')
+        db.put(5, 10, 3, b'land')
+        db.flush()
+        assert count_rows(path, 'images') == 3
+        assert db.remove_orphans() == 1
+        assert db.remove_orphans() == 0
+        assert count_rows(path, 'images') == 2
+        assert sorted(db.iter_tiles()) == sorted([(5, 10, 3, b'land'), (5, 11, 3, b'land'), (5, 12, 3, b'sea'),
+                                                  (6, 20, 7, b'sea'), (6, 21, 6, b'land')])
+    with make_database(str(tmp_path / 'plain.mbtiles'), False) as db:
+        assert db.remove_orphans() == 0
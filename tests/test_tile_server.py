@@ -0,0 +1,95 @@
+import asyncio
+import gzip
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pyterrainmaker.TerrainTile import TerrainTile
+from pyterrainmaker.TileDatabase import TileDatabase, DATABASE_NAME
+from pyterrainmaker.TileServer import TileServer, TileStore, accepts_gzip
+
+
+def test_accepts_gzip():
+    assert accepts_gzip('gzip')
+    assert accepts_gzip('deflate, gzip;q=0.5')
+    assert accepts_gzip('GZIP ; Q=1')
+    assert accepts_gzip('x-gzip')
+    assert accepts_gzip('br, *')
+    assert not accepts_gzip('')
+    assert not accepts_gzip('identity')
+    assert not accepts_gzip('gzip;q=0')
+    assert not accepts_gzip('gzip;q=0.000, deflate')
+    assert not accepts_gzip('*;q=1, gzip;q=0')
+    assert not accepts_gzip('*;q=0')
+    assert not accepts_gzip('gzip;q=x')
+
+
+def test_tiles_are_decompressed_unless_gzip_is_accepted(tmp_path):
+    location = str(tmp_path)
+    with open(tmp_path / 'layer.json', 'w') as f:
+        json.dump({'format': 'heightmap-1.0', 'available': []}, f)
+    TerrainTile.save_binary(str(tmp_path / '3'), 5, 2, gzip.compress(b'heights'))
+    server = TileServer(TileStore(location))
+
+    (status, headers, body) = server.handle_request('GET', '/3/5/2.terrain', {'accept-encoding': 'gzip, br'})
+    assert status == '200 OK'
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(body) == b'heights'
+    for accept_encoding in ('gzip;q=0', 'identity'):
+        (status, headers, body) = server.handle_request('GET', '/3/5/2.terrain', {'accept-encoding': accept_encoding})
+        assert 'Content-Encoding' not in headers
+        assert headers['Vary'] == 'Accept-Encoding'
+        assert body == b'heights'
+    assert server.handle_request('GET', '/3/5/3.terrain', {})[0] == '404 Not Found'
+
+
+def make_database_store(tmp_path):
+    path = str(tmp_path / DATABASE_NAME)
+    with TileDatabase(path, create=True) as db:
+        for x in range(16):
+            db.put(3, x, 2, gzip.compress(str(x).encode()))
+        db.flush()
+        db.set_metadata({'json': json.dumps({'format': 'heightmap-1.0', 'available': []})})
+    return TileStore(str(tmp_path))
+
+
+def test_database_tiles_are_read_from_any_thread(tmp_path):
+    store = make_database_store(tmp_path)
+    assert store.blocking_reads
+    with ThreadPoolExecutor(4) as executor:
+        tiles = list(executor.map(lambda x: store.get_tile(3, x, 2), list(range(16)) * 8))
+    assert [gzip.decompress(tile) for tile in tiles] == [str(x).encode() for x in range(16)] * 8
+    store.close()
+
+
+def test_slow_reads_do_not_stall_other_connections(tmp_path):
+    store = make_database_store(tmp_path)
+    get_tile = store.get_tile
+
+    def slow_get_tile(z, x, y):
+        if x == 0:
+            time.sleep(0.5)
+        return get_tile(z, x, y)
+
+    store.get_tile = slow_get_tile
+    server = TileServer(store)
+
+    async def request(port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('GET {0} HTTP/1.1\r\nConnection: close\r\n\r\n'.format(path).encode())
+        response = await reader.read()
+        writer.close()
+        return response.split(b'\r\n\r\n', 1)[1], time.perf_counter()
+
+    async def run():
+        tcp_server = await asyncio.start_server(server.handle_connection, '127.0.0.1', 0)
+        port = tcp_server.sockets[0].getsockname()[1]
+        async with tcp_server:
+            return await asyncio.gather(request(port, '/3/0/2.terrain'), request(port, '/3/5/2.terrain'))
+
+    ((slow, slow_end), (fast, fast_end)) = asyncio.run(run())
+    assert (slow, fast) == (b'0', b'5')
+    assert fast_end < slow_end - 0.3
+    server.executor.shutdown()
+    store.close()
@@ -0,0 +1,46 @@
+import os
+
+from pyterrainmaker.TerrainTile import TerrainTile
+from pyterrainmaker.TileWriter import TileWriter
+
+
+def read_tile(location, level, x, y):
+    with open(TerrainTile.tile_path(os.path.join(location, str(level)), x, y), 'rb') as f:
+        return f.read()
+
+
+def test_dedup_tiles_are_hardlinked(tmp_path):
+    location = str(tmp_path)
+    writer = TileWriter(location, threads=0)
+    for x in range(5):
+        writer.put(10, x, 3, b'sea', b'digest')
+    writer.put(10, 5, 3, b'land', b'other')
+    writer.flush()
+    inodes = set(os.stat(TerrainTile.tile_path(os.path.join(location, '10'), x, 3)).st_ino for x in range(5))
+    assert len(inodes) == 1
+    assert read_tile(location, 10, 4, 3) == b'sea'
+    assert read_tile(location, 10, 5, 3) == b'land'
+
+
+def test_threads_write_every_tile(tmp_path):
+    # threads writing the same content at once may each write a copy, the tiles stay right
+    location = str(tmp_path)
+    writer = TileWriter(location, threads=2, batch=2)
+    for x in range(20):
+        writer.put(10, x, 3, b'sea' if x % 2 else b'land', b'sea' if x % 2 else b'land')
+    writer.flush()
+    writer.close()
+    assert [read_tile(location, 10, x, 3) for x in range(20)] == [b'land', b'sea'] * 10
+
+
+def test_writes_do_not_go_through_hardlinks(tmp_path):
+    # an update without dedup rewrites tiles that a dedup run hardlinked
+    location = str(tmp_path)
+    writer = TileWriter(location, threads=0)
+    for x in range(3):
+        writer.put(10, x, 3, b'sea', b'digest')
+    writer.flush()
+    writer.put(10, 1, 3, b'land')
+    writer.flush()
+    assert [read_tile(location, 10, x, 3) for x in range(3)] == [b'sea', b'land', b'sea']
+    assert sorted(os.listdir(os.path.join(location, '10', '1'))) == ['3.terrain']